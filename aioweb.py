@@ -0,0 +1,198 @@
+"""The registration push API as an aiohttp application.
+
+Serves the same routes and API key check as web.py, but runs on an asyncio
+event loop, so it can share the bot's loop and process instead of running a
+separate eventlet process. Database access goes through async_records, on the
+same worker thread as the bot's own queries, so there is a single SQLite
+writer.
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import traceback
+import aiohttp.web
+import async_records
+import config
+import idempotency
+import ingest
+import metrics
+import records
+import regindex
+import writebehind
+
+# Batch bodies can be much larger than aiohttp's 1 MiB default
+_CLIENT_MAX_SIZE = 16 * 1024 * 1024
+
+# Runs write-behind log appends, which write to disk, off the event loop
+_write_behind_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='write-behind')
+
+_ADD_RESPONSE_ENTRY = {
+    'participant': async_records.add_participant_response_entry,
+    'mentor': async_records.add_mentor_response_entry,
+    'judge': async_records.add_judge_response_entry,
+}
+
+
+def _check_api_key(request: aiohttp.web.Request):
+    if request.headers.get('api-key') != config.web_api_key:
+        raise aiohttp.web.HTTPForbidden()
+
+
+@aiohttp.web.middleware
+async def _idempotency(request: aiohttp.web.Request, handler) -> aiohttp.web.Response:
+    # Replays the recorded response to a repeated Idempotency-Key (see
+    # idempotency.py)
+    key = request.headers.get('Idempotency-Key')
+    if key is None or not request.path.startswith('/push/'):
+        return await handler(request)
+    _check_api_key(request)
+    try:
+        idempotency.check_key(key)
+    except ValueError as error:
+        raise aiohttp.web.HTTPBadRequest(text=str(error))
+
+    request_description = idempotency.describe_request(request.method, request.path)
+    recorded = await async_records.get_idempotent_response(key, config.web_idempotency_key_ttl)
+    if recorded is not None:
+        try:
+            body = idempotency.replayed_response(recorded, request_description)
+        except idempotency.KeyReused as error:
+            raise aiohttp.web.HTTPUnprocessableEntity(text=str(error))
+        return aiohttp.web.Response(text=body, content_type='application/json',
+                                    headers={'Idempotent-Replayed': 'true'})
+
+    response = await handler(request)
+    if response.status == 200:
+        await async_records.add_idempotent_response(
+            key, request_description, response.text, config.web_idempotency_key_ttl)
+    return response
+
+
+async def _push(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    _check_api_key(request)
+    try:
+        data = await request.json()
+        role = request.match_info['role']
+        write_behind = request.app['write_behind']
+        if write_behind is None:
+            await _ADD_RESPONSE_ENTRY[role](
+                str(data['email']).lower(), data['discord_username'])
+            regindex.request_refresh()
+        # Appending writes to the log file (and may sync it), so it runs off
+        # the event loop
+        elif await asyncio.get_running_loop().run_in_executor(
+                _write_behind_executor, write_behind.append, role, str(data['email']).lower(), data['discord_username']):
+            request.app['write_behind_due'].set()
+        return aiohttp.web.json_response(
+            {'email': str(data['email']).lower(), 'discord_username': data['discord_username'].lower()})
+    except Exception:
+        raise aiohttp.web.HTTPBadRequest()
+
+
+async def _push_batch(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    _check_api_key(request)
+    role = request.match_info['role']
+    if role not in records.REGISTRATION_ROLES:
+        raise aiohttp.web.HTTPNotFound()
+    try:
+        items = ingest.parse_batch(
+            io.BytesIO(await request.read()), request.content_type)
+    except ValueError as error:
+        raise aiohttp.web.HTTPBadRequest(text=str(error))
+    result = await async_records.run(ingest.add_batch, role, items)
+    if result['added']:
+        regindex.request_refresh()
+    return aiohttp.web.json_response(result)
+
+
+async def _metrics(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    # Served from the bot process, so its own metrics are all there is
+    return aiohttp.web.Response(
+        body=metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def _flush_write_behind_log(app: aiohttp.web.Application):
+    while True:
+        try:
+            await asyncio.wait_for(app['write_behind_due'].wait(), config.web_write_behind_interval)
+        except asyncio.TimeoutError:
+            pass
+        app['write_behind_due'].clear()
+        try:
+            if await async_records.run(app['write_behind'].flush):
+                regindex.request_refresh()
+        except Exception:
+            traceback.print_exc()
+
+
+async def _start_write_behind(app: aiohttp.web.Application):
+    if app['write_behind'] is not None:
+        app['write_behind_task'] = asyncio.get_running_loop().create_task(
+            _flush_write_behind_log(app))
+
+
+async def _stop_write_behind(app: aiohttp.web.Application):
+    if app['write_behind'] is not None:
+        app['write_behind_task'].cancel()
+        await async_records.run(app['write_behind'].flush)
+        app['write_behind'].close()
+
+
+def create_app(write_behind: writebehind.WriteBehindLog = None) -> aiohttp.web.Application:
+    """Create the push API application.
+
+    Args:
+        write_behind (writebehind.WriteBehindLog): Log to acknowledge single
+            pushes from, flushed every config.web_write_behind_interval
+            seconds, or None to record each one in its own transaction
+
+    Returns:
+        aiohttp.web.Application: The application
+    """
+
+    app = aiohttp.web.Application(client_max_size=_CLIENT_MAX_SIZE, middlewares=[_idempotency])
+    app['write_behind'] = write_behind
+    app['write_behind_due'] = asyncio.Event()
+    app.on_startup.append(_start_write_behind)
+    app.on_cleanup.append(_stop_write_behind)
+    app.router.add_post('/push/{role:participant|mentor|judge}', _push)
+    app.router.add_post('/push/{role}/batch', _push_batch)
+    app.router.add_get('/metrics', _metrics)
+    return app
+
+
+async def serve(host: str = '0.0.0.0', port: int = None, write_behind_log: str = None) -> aiohttp.web.AppRunner:
+    """Start serving the push API on the running event loop.
+
+    Connections are kept alive between requests, so clients pushing many
+    entries do not pay for a new connection each time.
+
+    Args:
+        host (str): Address to listen on
+        port (int): Port to listen on, config.web_port by default
+        write_behind_log (str): Path of a write-behind log for single pushes,
+            or None to record each one in its own transaction
+
+    Returns:
+        aiohttp.web.AppRunner: The runner, for cleanup on shutdown
+    """
+
+    write_behind = None
+    if write_behind_log is not None:
+        # Replaying leftover entries queries the database
+        await async_records.run(writebehind.replay_all, write_behind_log)
+        write_behind = await async_records.run(
+            writebehind.WriteBehindLog, write_behind_log,
+            config.web_write_behind_max_rows, config.web_write_behind_fsync)
+    runner = aiohttp.web.AppRunner(create_app(write_behind), access_log=None)
+    await runner.setup()
+    try:
+        await aiohttp.web.TCPSite(
+            runner, host, config.web_port if port is None else port).start()
+    except BaseException:
+        # E.g. the port is in use
+        await runner.cleanup()
+        raise
+    return runner
@@ -0,0 +1,130 @@
+"""Asynchronous wrappers around the records module.
+
+Each function runs its records counterpart on a dedicated worker thread, so
+that SQLite queries and fsyncs never block the bot's event loop. records keeps
+a single connection and cursor, so the executor has exactly one worker, which
+also serializes every query issued from the event loop.
+
+The synchronous records API stays available for scripts that have no event
+loop, such as csvToSQL.py and exportData.py.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import sqlite3
+import records
+
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='records')
+
+
+async def run(function, *args, **kwargs):
+    """Run a function on the records worker thread.
+
+    Useful for grouping several records calls into one trip off the event
+    loop. The function runs in a copy of the caller's context, so context
+    variables set by the caller are visible to it.
+
+    Args:
+        function (Callable): The function to run
+        *args: Positional arguments for the function
+        **kwargs: Keyword arguments for the function
+
+    Returns:
+        Any: The return value of the function
+    """
+
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, functools.partial(context.run, function, *args, **kwargs))
+
+
+async def snapshot() -> bool:
+    """Write the in-memory database to its file, if it changed since the
+    last snapshot (see records.snapshot()).
+
+    Only the copy is made on the records worker thread; writing it to disk
+    runs on another thread, so queries do not wait for it.
+
+    Returns:
+        bool: If a snapshot was written, False with the "file" backend
+    """
+
+    copy = await run(records.take_snapshot)
+    if copy is None:
+        return False
+    await asyncio.get_running_loop().run_in_executor(None, records.write_snapshot, copy)
+    return True
+
+
+async def snapshot_periodically(interval: float):
+    """Write snapshots of the in-memory database until cancelled.
+
+    Args:
+        interval (float): Seconds between snapshots
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await snapshot()
+        except (OSError, sqlite3.Error) as error:
+            print(f'ERROR: Could not write records snapshot: {error}')
+
+
+def _wrap(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await run(function, *args, **kwargs)
+    return wrapper
+
+
+add_participant_response_entry = _wrap(records.add_participant_response_entry)
+add_mentor_response_entry = _wrap(records.add_mentor_response_entry)
+add_judge_response_entry = _wrap(records.add_judge_response_entry)
+get_response_entries_since = _wrap(records.get_response_entries_since)
+get_idempotent_response = _wrap(records.get_idempotent_response)
+add_idempotent_response = _wrap(records.add_idempotent_response)
+participant_response_exists = _wrap(records.participant_response_exists)
+mentor_response_exists = _wrap(records.mentor_response_exists)
+judge_response_exists = _wrap(records.judge_response_exists)
+add_participant = _wrap(records.add_participant)
+add_mentor = _wrap(records.add_mentor)
+add_judge = _wrap(records.add_judge)
+add_verified_users = _wrap(records.add_verified_users)
+get_participants = _wrap(records.get_participants)
+get_mentor_ids = _wrap(records.get_mentor_ids)
+get_judge_ids = _wrap(records.get_judge_ids)
+is_verified_participant = _wrap(records.is_verified_participant)
+is_verified_mentor = _wrap(records.is_verified_mentor)
+is_verified_judge = _wrap(records.is_verified_judge)
+get_max_team_id = _wrap(records.get_max_team_id)
+create_team = _wrap(records.create_team)
+drop_team = _wrap(records.drop_team)
+remove_team_deadlines = _wrap(records.remove_team_deadlines)
+get_team_deadlines = _wrap(records.get_team_deadlines)
+reserve_team_category = _wrap(records.reserve_team_category)
+release_team_category = _wrap(records.release_team_category)
+add_team_category = _wrap(records.add_team_category)
+remove_team_category = _wrap(records.remove_team_category)
+get_team_category_count = _wrap(records.get_team_category_count)
+get_team_categories = _wrap(records.get_team_categories)
+recount_team_categories = _wrap(records.recount_team_categories)
+is_team_name_used = _wrap(records.is_team_name_used)
+is_participant_in_team = _wrap(records.is_participant_in_team)
+get_team_id = _wrap(records.get_team_id)
+add_to_team = _wrap(records.add_to_team)
+remove_from_team = _wrap(records.remove_from_team)
+get_team_size = _wrap(records.get_team_size)
+get_team_name = _wrap(records.get_team_name)
+get_team_role_id = _wrap(records.get_team_role_id)
+get_team_category_channel_id = _wrap(records.get_team_category_channel_id)
+get_team_text_channel_id = _wrap(records.get_team_text_channel_id)
+team_exists = _wrap(records.team_exists)
+get_team_members = _wrap(records.get_team_members)
+get_team = _wrap(records.get_team)
+get_team_for_member = _wrap(records.get_team_for_member)
+get_teams = _wrap(records.get_teams)
+get_all_teams = _wrap(records.get_all_teams)
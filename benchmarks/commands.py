@@ -0,0 +1,250 @@
+"""Load harness for the slash command handlers.
+
+Drives the real handlers in discord.py (verify, mentify, createteam,
+addmember, leaveteam) with fake interactions against a fake guild
+(benchmarks.fakediscord) whose API calls take --latency seconds and are rate
+limited per route, and a temporary records database.
+
+The default scenario replays a kickoff: --participants participants verify at
+random times over --duration seconds (compressed by --speed) and form
+--teams teams of up to four, the creator running createteam once their
+teammates are verified and then addmember for each; --mentors mentors run
+mentify, and a --leave fraction of team members leave again.
+
+Reports p50/p95/p99 latency, failures and database queries per command, and
+event loop lag while the scenario runs.
+
+Before the scenario, checks that obulkverify resolves CSV rows by username
+only: a member whose nickname is another member's username must not be
+verified in their place, and a username shared by two cached members must be
+reported rather than guessed. The run fails (exit status 1) if not.
+
+Must be run from a directory with a config.ini, since discord.py reads it.
+
+Usage:
+    python -m benchmarks.commands [--participants 2000] [--teams 500]
+        [--mentors 50] [--duration 600] [--speed 10] [--latency 0.05]
+        [--rate-limit 50] [--leave 0.05]
+"""
+
+import argparse
+import asyncio
+import collections
+import contextvars
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+import config
+import discord
+import mutations
+import records
+from benchmarks import fakediscord
+
+_current_command = contextvars.ContextVar('current_command', default=None)
+
+
+class _Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.failures = collections.Counter()
+        self.queries = collections.Counter()
+        self.loop_lag = []
+
+    def count_query(self, statement: str):
+        # Runs on the records worker thread, in the calling command's context
+        command = _current_command.get()
+        if command is not None:
+            self.queries[command] += 1
+
+
+async def _invoke(stats: _Stats, command_name: str, interaction, **kwargs):
+    command = getattr(discord, command_name)
+    token = _current_command.set(command_name)
+    start_time = time.perf_counter()
+    try:
+        await command.callback(interaction, **kwargs)
+    except Exception:
+        if not stats.failures:
+            traceback.print_exc()
+        stats.failures[command_name] += 1
+    finally:
+        stats.latencies[command_name].append(time.perf_counter() - start_time)
+        _current_command.reset(token)
+
+
+async def _measure_loop_lag(stats: _Stats, interval: float = 0.01):
+    while True:
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(time.perf_counter() - start_time - interval)
+
+
+def _build_guild(api: fakediscord.FakeAPI) -> fakediscord.FakeGuild:
+    guild = fakediscord.FakeGuild(api, config.discord_guild_id)
+    for name, role_id in [
+            ('Organizer', config.discord_organizer_role_id),
+            ('Participant', config.discord_participant_role_id),
+            ('Mentor', config.discord_mentor_role_id),
+            ('Judge', config.discord_judge_role_id),
+            ('Team Assigned', config.discord_team_assigned_role_id),
+            ('All Access Pass', config.discord_all_access_pass_role_id),
+            ('Verified', config.discord_verified_role_id)]:
+        guild.add_role(name, role_id)
+    guild.add_channel('start-here', config.discord_start_here_channel_id)
+    guild.add_channel('ask-an-organizer', config.discord_ask_an_organizer_channel_id)
+    return guild
+
+
+async def _participant(stats, guild, member, arrival, verified, team, leave):
+    await asyncio.sleep(arrival)
+    await _invoke(stats, 'verify', fakediscord.FakeInteraction(guild, member),
+                  email=f'{member.name}@example.com')
+    verified[member.id].set()
+
+    if team is None or team[0] is not member:
+        return
+
+    # Team creator: wait for the teammates, then form the team
+    for teammate in team:
+        await verified[teammate.id].wait()
+    await _invoke(stats, 'createteam', fakediscord.FakeInteraction(guild, member),
+                  name=f'team-{member.name}')
+    for teammate in team[1:]:
+        await _invoke(stats, 'addmember', fakediscord.FakeInteraction(guild, member),
+                      member=teammate)
+    for teammate in team[1:]:
+        if random.random() < leave:
+            await _invoke(stats, 'leaveteam', fakediscord.FakeInteraction(guild, teammate))
+
+
+async def _mentor(stats, guild, member, arrival):
+    await asyncio.sleep(arrival)
+    await _invoke(stats, 'mentify', fakediscord.FakeInteraction(guild, member),
+                  email=f'{member.name}@example.com')
+
+
+async def _check_bulk_verify(guild) -> list:
+    # The impostor joined first, so a lookup that also matched nicknames
+    # would find them before the registrant
+    impostor = guild.add_member('bulk-impostor')
+    impostor.nick = 'bulk-registrant'
+    registrant = guild.add_member('bulk-registrant')
+    duplicates = [guild.add_member('bulk-duplicate') for _ in range(2)]
+    organizer = guild.add_member('bulk-organizer')
+    csv = (b'bulk-registrant,bulk-registrant@example.com,participant\n'
+           b'bulk-duplicate,bulk-duplicate@example.com,participant\n')
+    await discord.obulkverify.callback(fakediscord.FakeInteraction(guild, organizer),
+                                       file=fakediscord.FakeAttachment(csv))
+
+    problems = []
+    if not records.is_verified_participant(registrant.id):
+        problems.append('the member with the username was not verified')
+    if records.is_verified_participant(impostor.id):
+        problems.append('the member with the username as nickname was verified')
+    if any(records.is_verified_participant(member.id) for member in duplicates):
+        problems.append('a member with a username shared by two members was verified')
+    return problems
+
+
+async def _run(args, stats: _Stats) -> tuple:
+    api = fakediscord.FakeAPI(latency=args.latency, rate_limit=args.rate_limit)
+    guild = _build_guild(api)
+
+    # The bot is not connected; resolve its lookups against the fake guild
+    discord._bot.get_channel = guild.get_channel
+    discord._bot.get_guild = lambda guild_id: guild
+    # Pace the mutation queue under the fake API's sliding window limit
+    discord._mutations = mutations.MutationQueue(
+        {route: (args.rate_limit * 0.9, max(1, args.rate_limit // 10), 8)
+         for route in mutations.DEFAULT_ROUTE_LIMITS})
+
+    problems = await _check_bulk_verify(guild)
+
+    participants = [guild.add_member(f'participant{i}') for i in range(args.participants)]
+    mentors = [guild.add_member(f'mentor{i}') for i in range(args.mentors)]
+    records.add_response_entries(
+        'participant', [(f'{member.name}@example.com', member.name) for member in participants])
+    records.add_response_entries(
+        'mentor', [(f'{member.name}@example.com', member.name) for member in mentors])
+
+    random.seed(0)
+    shuffled = random.sample(participants, len(participants))
+    teams = {}
+    for i in range(min(args.teams, len(shuffled) // 2)):
+        team = shuffled[i * 4:i * 4 + 4]
+        for member in team:
+            teams[member.id] = team
+
+    window = args.duration / args.speed
+    verified = {member.id: asyncio.Event() for member in participants}
+    tasks = [_participant(stats, guild, member, random.uniform(0, window), verified,
+                          teams.get(member.id), args.leave)
+             for member in participants]
+    tasks += [_mentor(stats, guild, member, random.uniform(0, window)) for member in mentors]
+
+    lag_task = asyncio.get_running_loop().create_task(_measure_loop_lag(stats))
+    start_time = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start_time
+    lag_task.cancel()
+    return api, elapsed, problems
+
+
+def _percentile(quantiles: list, percent: int) -> float:
+    return quantiles[percent - 1] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--participants', type=int, default=2000)
+    parser.add_argument('--teams', type=int, default=500)
+    parser.add_argument('--mentors', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=600,
+                        help='Scenario length in seconds, before --speed')
+    parser.add_argument('--speed', type=float, default=10,
+                        help='Factor by which the scenario is sped up')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds each fake Discord API call takes')
+    parser.add_argument('--rate-limit', type=int, default=50,
+                        help='Fake Discord API calls allowed per route per second')
+    parser.add_argument('--leave', type=float, default=0.05,
+                        help='Fraction of team members who leave their team')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        records.connect(os.path.join(directory, 'records.db'))
+        stats = _Stats()
+        records._connection.set_trace_callback(stats.count_query)
+        api, elapsed, problems = asyncio.run(_run(args, stats))
+
+    print(f'{args.participants} participants, {args.teams} teams, {args.mentors} mentors '
+          f'in {elapsed:.1f}s ({args.duration:.0f}s scenario at {args.speed}x)')
+    print(f'{sum(api.calls.values())} fake API calls, '
+          f'{sum(api.rate_limited.values())} rate limited')
+    print(f'{"command":>10} {"count":>6} {"fail":>5} {"p50 ms":>9} {"p95 ms":>9} '
+          f'{"p99 ms":>9} {"queries":>8}')
+    for name in ('verify', 'mentify', 'createteam', 'addmember', 'leaveteam'):
+        values = stats.latencies.get(name, [])
+        if len(values) < 2:
+            continue
+        quantiles = statistics.quantiles(values, n=100)
+        print(f'{name:>10} {len(values):>6} {stats.failures[name]:>5} '
+              f'{_percentile(quantiles, 50):>9.1f} {_percentile(quantiles, 95):>9.1f} '
+              f'{_percentile(quantiles, 99):>9.1f} {stats.queries[name] / len(values):>8.1f}')
+    if len(stats.loop_lag) > 1:
+        quantiles = statistics.quantiles(stats.loop_lag, n=100)
+        print(f'event loop lag: p50 {_percentile(quantiles, 50):.2f}ms, '
+              f'p99 {_percentile(quantiles, 99):.2f}ms, max {max(stats.loop_lag) * 1000:.2f}ms')
+
+    for problem in problems:
+        print(f'FAILED obulkverify check: {problem}')
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
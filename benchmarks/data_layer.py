@@ -0,0 +1,384 @@
+"""Micro-benchmarks and query plan checks for every public records function.
+
+For each of --sizes, fills a temporary records.db with that many registration
+responses per role, half as many verified participants, a tenth as many teams
+of up to four members (with their categories and some formation deadlines),
+and a handful of mentors and judges. Then times each public records function
+over --repeats calls and runs EXPLAIN QUERY PLAN on every statement it
+executes.
+
+The caches are disabled, so each call reaches the database. With --backend
+memory, the database is held in memory (see records.connect()), as the bot
+does with the "memory" backend; the baseline is for the "file" backend.
+
+The run fails (exit status 1) when:
+    - a public records function has no benchmark case,
+    - a statement scans a table, outside of the functions in _FULL_READS that
+      read a whole table by design, or
+    - a function's median call time exceeds the --baseline time for the same
+      size by more than --tolerance plus --slack microseconds (calls this
+      short are noisy, so a relative margin alone would flag jitter), or
+    - with the caches enabled, a lookup disagrees with the database after
+      team changes for Discord IDs that are not verified participants.
+
+Usage:
+    python -m benchmarks.data_layer [--sizes 1000,10000,200000] [--repeats 200]
+        [--baseline benchmarks/data_layer_baseline.json] [--save-baseline]
+        [--tolerance 0.5] [--slack 20] [--backend file]
+"""
+
+import argparse
+import inspect
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import records
+
+_DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'data_layer_baseline.json')
+
+# Public functions that are not part of the data layer's per-call cost
+_SKIPPED = {'connect', 'connect_configured', 'close', 'normalize_key', 'vacuum',
+            'take_snapshot', 'write_snapshot', 'snapshot', 'enable_tracing',
+            'disable_tracing', 'trace_stats', 'dump_trace_stats'}
+
+# Functions that read a whole table by design, where a scan is expected
+_FULL_READS = {'get_team_deadlines', 'get_team_category_count', 'iter_team_members',
+               'get_team_categories', 'recount_team_categories', 'get_participants',
+               'get_mentor_ids', 'get_judge_ids', 'get_all_teams'}
+
+# Functions too slow on large tables to call --repeats times
+_REPEATS_OVERRIDE = {'iter_team_members': 3, 'get_all_teams': 3, 'get_participants': 3,
+                     'recount_team_categories': 3}
+
+_TEAM_SIZE = 4
+_CATEGORY_CAPACITY = 50
+
+# Statements that do not touch a table
+_UNPLANNED_PREFIXES = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA')
+
+
+def _populate(size: int) -> dict:
+    participant_count = size // 2
+    team_count = max(1, size // 10)
+    staff_count = max(1, size // 100)
+
+    for role in records.REGISTRATION_ROLES:
+        count = size if role == 'participant' else staff_count
+        records.add_response_entries(
+            role, ((f'{role}{i}@example.com', f'{role}{i}') for i in range(count)))
+
+    # The bulk inserts bypass the public functions, which would take minutes
+    # at the larger sizes
+    connection = records._connection
+    connection.execute('BEGIN')
+    connection.executemany(
+        f'INSERT INTO {records._TEAM_TABLE_NAME} ( id, name, category_channel_id, text_channel_id, role_id ) VALUES ( ?, ?, ?, ?, ? )',
+        ((team_id, f'team{team_id}', team_id // _CATEGORY_CAPACITY,
+          10 ** 6 + team_id, 2 * 10 ** 6 + team_id)
+         for team_id in range(1, team_count + 1)))
+    connection.execute(
+        f'INSERT INTO {records._TEAM_CATEGORY_TABLE_NAME} ( category_channel_id, channel_count ) SELECT category_channel_id, COUNT(*) FROM {records._TEAM_TABLE_NAME} GROUP BY category_channel_id')
+    connection.executemany(
+        f'INSERT INTO {records._TEAM_DEADLINE_TABLE_NAME} ( team_id, deadline ) VALUES ( ?, ? )',
+        ((team_id, time.time() + 60) for team_id in range(1, team_count + 1, 10)))
+    # The first team_count * _TEAM_SIZE participants are in teams
+    connection.executemany(
+        f'INSERT INTO {records._PARTICIPANT_TABLE_NAME} ( discord_id, email, team_id ) VALUES ( ?, ?, ? )',
+        ((discord_id, f'participant{discord_id}@example.com',
+          discord_id // _TEAM_SIZE + 1 if discord_id < team_count * _TEAM_SIZE else None)
+         for discord_id in range(participant_count)))
+    for table in (records._MENTOR_TABLE_NAME, records._JUDGE_TABLE_NAME):
+        connection.executemany(
+            f'INSERT INTO {table} ( discord_id, email ) VALUES ( ?, ? )',
+            ((discord_id, f'{discord_id}@example.com') for discord_id in range(staff_count)))
+    connection.executemany(
+        f'INSERT INTO {records._IDEMPOTENCY_KEY_TABLE_NAME} ( key, request, response, created ) VALUES ( ?, ?, ?, ? )',
+        ((f'key{i}', 'POST /push/participant', '{}', time.time()) for i in range(team_count)))
+    connection.execute('COMMIT')
+    connection.execute('ANALYZE')
+
+    return {'size': size, 'participants': participant_count, 'teams': team_count,
+            'staff': staff_count, 'next_id': 10 ** 9, 'created_teams': [],
+            'created_categories': [], 'reserved_categories': []}
+
+
+def _cases(state: dict) -> dict:
+    # Each case makes one call; reads pick random existing records, writes
+    # use fresh IDs so they never collide
+    def fresh_id():
+        state['next_id'] += 1
+        return state['next_id']
+
+    def participant():
+        return random.randrange(state['participants'])
+
+    def team():
+        return random.randrange(1, state['teams'] + 1)
+
+    def team_member():
+        return random.randrange(min(state['participants'], state['teams'] * _TEAM_SIZE))
+
+    def staff():
+        return random.randrange(state['staff'])
+
+    def response(role, count):
+        i = random.randrange(count)
+        return f'{role}{i}@example.com', f'{role}{i}'
+
+    def create_team():
+        team_id = fresh_id()
+        state['created_teams'].append(records.create_team(f'new{team_id}', 0, team_id, team_id, time.time() + 60))
+
+    def add_team_category():
+        category_channel_id = fresh_id()
+        records.add_team_category(category_channel_id)
+        state['created_categories'].append(category_channel_id)
+
+    def reserve_team_category():
+        state['reserved_categories'].append(records.reserve_team_category(_CATEGORY_CAPACITY))
+
+    def drain(iterator):
+        for _ in iterator:
+            pass
+
+    return {
+        'add_response_entries': lambda: records.add_response_entries(
+            'participant', [(f'{fresh_id()}@example.com', 'new')]),
+        'try_add_response_entries': lambda: records.try_add_response_entries(
+            'participant', [(f'{fresh_id()}@example.com', 'new')]),
+        'add_participant_response_entry': lambda: records.add_participant_response_entry(
+            f'{fresh_id()}@example.com', 'new'),
+        'add_mentor_response_entry': lambda: records.add_mentor_response_entry(
+            f'{fresh_id()}@example.com', 'new'),
+        'add_judge_response_entry': lambda: records.add_judge_response_entry(
+            f'{fresh_id()}@example.com', 'new'),
+        'get_idempotent_response': lambda: records.get_idempotent_response(
+            f'key{random.randrange(state["teams"])}', 86400),
+        'add_idempotent_response': lambda: records.add_idempotent_response(
+            f'new{fresh_id()}', 'POST /push/participant', '{}', 86400),
+        'remove_expired_idempotency_keys': lambda: records.remove_expired_idempotency_keys(86400),
+        'get_response_entries_since': lambda: records.get_response_entries_since(
+            'participant', random.randrange(state['size']), 100),
+        'participant_response_exists': lambda: records.participant_response_exists(
+            *response('participant', state['size'])),
+        'mentor_response_exists': lambda: records.mentor_response_exists(
+            *response('mentor', state['staff'])),
+        'judge_response_exists': lambda: records.judge_response_exists(
+            *response('judge', state['staff'])),
+        'add_participant': lambda: records.add_participant(fresh_id(), 'new@example.com'),
+        'add_mentor': lambda: records.add_mentor(fresh_id(), 'new@example.com'),
+        'add_judge': lambda: records.add_judge(fresh_id(), 'new@example.com'),
+        'add_verified_users': lambda: records.add_verified_users(
+            [(role, fresh_id(), 'new@example.com') for role in records.REGISTRATION_ROLES]),
+        'is_verified_participant': lambda: records.is_verified_participant(participant()),
+        'is_verified_mentor': lambda: records.is_verified_mentor(staff()),
+        'is_verified_judge': lambda: records.is_verified_judge(staff()),
+        'get_max_team_id': records.get_max_team_id,
+        'create_team': create_team,
+        'drop_team': lambda: records.drop_team(state['created_teams'].pop()),
+        'remove_team_deadlines': lambda: records.remove_team_deadlines([team()]),
+        'get_team_deadlines': records.get_team_deadlines,
+        'reserve_team_category': reserve_team_category,
+        'release_team_category': lambda: records.release_team_category(
+            state['reserved_categories'].pop()),
+        'add_team_category': add_team_category,
+        'remove_team_category': lambda: records.remove_team_category(
+            state['created_categories'].pop()),
+        'get_team_category_count': records.get_team_category_count,
+        'get_team_categories': records.get_team_categories,
+        'recount_team_categories': records.recount_team_categories,
+        'get_participants': records.get_participants,
+        'get_mentor_ids': records.get_mentor_ids,
+        'get_judge_ids': records.get_judge_ids,
+        'get_all_teams': records.get_all_teams,
+        'is_team_name_used': lambda: records.is_team_name_used(f'team{team()}'),
+        'is_participant_in_team': lambda: records.is_participant_in_team(participant()),
+        'get_team_id': lambda: records.get_team_id(team_member()),
+        'add_to_team': lambda: records.add_to_team(participant(), team()),
+        'remove_from_team': lambda: records.remove_from_team(participant()),
+        'get_team_size': lambda: records.get_team_size(team()),
+        'get_team_name': lambda: records.get_team_name(team()),
+        'get_team_role_id': lambda: records.get_team_role_id(team()),
+        'get_team_category_channel_id': lambda: records.get_team_category_channel_id(team()),
+        'get_team_text_channel_id': lambda: records.get_team_text_channel_id(team()),
+        'team_exists': lambda: records.team_exists(team()),
+        'get_team_members': lambda: records.get_team_members(team()),
+        'get_team': lambda: records.get_team(team()),
+        'get_team_for_member': lambda: records.get_team_for_member(team_member()),
+        'get_teams': lambda: records.get_teams([team() for _ in range(10)]),
+        'iter_team_members': lambda: drain(records.iter_team_members()),
+        'cache_stats': records.cache_stats,
+    }
+
+
+def _public_functions() -> set:
+    return {name for name, value in vars(records).items()
+            if not name.startswith('_') and inspect.isfunction(value)
+            and value.__module__ == records.__name__} - _SKIPPED
+
+
+def _query_plans(statements: list) -> list:
+    # (statement, plan details) for each distinct statement that touches a
+    # table. The statements are expanded with their parameters, so the plans
+    # are the ones SQLite chose for the actual values.
+    plans = []
+    for statement in dict.fromkeys(statements):
+        if statement.lstrip().upper().startswith(_UNPLANNED_PREFIXES):
+            continue
+        details = [row[3] for row in records._connection.execute(
+            f'EXPLAIN QUERY PLAN {statement}')]
+        plans.append((statement, details))
+    return plans
+
+
+def _scans(plans: list) -> list:
+    return [(statement, detail) for statement, details in plans for detail in details
+            if detail.startswith('SCAN') and detail != 'SCAN CONSTANT ROW']
+
+
+def _run_size(size: int, repeats: int, directory: str, backend: str) -> tuple:
+    # Returns ({function: median seconds}, {function: query plans})
+    database_file = os.path.join(directory, f'records-{size}.db')
+    records.connect(database_file, cache_size=0, backend=backend)
+    state = _populate(size)
+    cases = _cases(state)
+
+    statements = []
+    timings = {}
+    plans = {}
+    random.seed(size)
+    for name, case in cases.items():
+        # Capture the statements of the first call, then time the rest
+        statements.clear()
+        records._connection.set_trace_callback(statements.append)
+        try:
+            case()
+        finally:
+            records._connection.set_trace_callback(None)
+        plans[name] = _query_plans(statements)
+
+        durations = []
+        for _ in range(_REPEATS_OVERRIDE.get(name, repeats)):
+            start_time = time.perf_counter()
+            case()
+            durations.append(time.perf_counter() - start_time)
+        timings[name] = statistics.median(durations)
+
+    # Closed directly, so that the "memory" backend writes no snapshot
+    records._connection.close()
+    records._connection = None
+    if os.path.exists(database_file):
+        os.remove(database_file)
+    return timings, plans
+
+
+def _check_caches(directory: str, backend: str) -> list:
+    # Team changes for an ID without a participant record update no row, and
+    # must not leave the ID cached as a verified participant
+    database_file = os.path.join(directory, 'records-caches.db')
+    records.connect(database_file, backend=backend)
+    team_id = records.create_team('team', 0, 1, 2)
+    unknown_ids = [10 ** 9 + 1, 10 ** 9 + 2]
+    records.remove_from_team(unknown_ids[0])
+    records.add_to_team(unknown_ids[1], team_id)
+
+    failures = []
+    for discord_id in unknown_ids:
+        stored = records._connection.execute(
+            f'SELECT team_id FROM {records._PARTICIPANT_TABLE_NAME} WHERE discord_id=?',
+            (discord_id,)).fetchone()
+        if records.is_verified_participant(discord_id) != (stored is not None):
+            failures.append(f'caches: is_verified_participant({discord_id}) disagrees with the database')
+        if records.get_team_id(discord_id) != (None if stored is None else stored[0]):
+            failures.append(f'caches: get_team_id({discord_id}) disagrees with the database')
+
+    records._connection.close()
+    records._connection = None
+    if os.path.exists(database_file):
+        os.remove(database_file)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,200000',
+                        help='Comma separated registration response counts')
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--baseline', default=_DEFAULT_BASELINE,
+                        help='JSON file of median call times to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Write this run\'s times to --baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Fraction by which a function may be slower than its baseline')
+    parser.add_argument('--slack', type=float, default=20,
+                        help='Microseconds a function may be slower than its baseline, on top of --tolerance')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print the query plan of every statement')
+    parser.add_argument('--backend', choices=records._BACKENDS, default='file',
+                        help='records backend to run against (default: file)')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    baseline = {}
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    failures = []
+    functions = _public_functions()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            timings, plans = _run_size(size, args.repeats, directory, args.backend)
+            results[str(size)] = timings
+            size_baseline = baseline.get(str(size), {})
+
+            print(f'{size} registration responses')
+            print(f'{"function":>30} {"median us":>10} {"baseline us":>12}  plan')
+            for name in sorted(timings):
+                scans = [] if name in _FULL_READS else _scans(plans[name])
+                expected = size_baseline.get(name)
+                slower = expected is not None and \
+                    timings[name] > expected * (1 + args.tolerance) + args.slack / 10 ** 6
+                status = 'SCAN' if scans else 'ok'
+                print(f'{name:>30} {timings[name] * 10 ** 6:>10.1f} '
+                      f'{"-" if expected is None else f"{expected * 10 ** 6:.1f}":>12}  '
+                      f'{status}{"  SLOWER" if slower else ""}')
+                if args.verbose:
+                    for statement, details in plans[name]:
+                        print(f'{"":>32}{statement}')
+                        for detail in details:
+                            print(f'{"":>34}{detail}')
+                for statement, detail in scans:
+                    failures.append(f'{name} at {size}: {detail} in {statement}')
+                if slower:
+                    failures.append(
+                        f'{name} at {size}: {timings[name] * 10 ** 6:.1f}us, '
+                        f'baseline {expected * 10 ** 6:.1f}us')
+            print()
+
+        failures += _check_caches(directory, args.backend)
+
+    for name in sorted(functions - set(results[str(sizes[0])])):
+        failures.append(f'{name}: no benchmark case')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+        print(f'Baseline written to {args.baseline}')
+
+    if failures:
+        print('FAILED')
+        for failure in failures:
+            print(f'  {failure}')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""In-process stand-ins for the parts of a nextcord guild used by the bot.
+
+Every guild mutation goes through a FakeAPI, which adds latency, counts calls
+per route, and raises RateLimited (an HTTP 429 look-alike) when a route is
+used faster than its limit, so that code driving Discord can be measured
+offline.
+"""
+
+import asyncio
+import collections
+import itertools
+import time
+
+ROUTE_MEMBER_ROLES = 'member_roles'
+ROUTE_ROLES = 'roles'
+ROUTE_CHANNELS = 'channels'
+ROUTE_MESSAGES = 'messages'
+# Interaction responses are not subject to the guild's rate limits
+ROUTE_INTERACTIONS = 'interactions'
+
+_ids = itertools.count(10 ** 17)
+
+
+class RateLimited(Exception):
+    """Raised by FakeAPI for a call over its route's rate limit."""
+
+    status = 429
+
+    def __init__(self, route: str, retry_after: float):
+        super().__init__(f'429 Too Many Requests on {route}')
+        self.retry_after = retry_after
+
+
+class FakeAPI:
+    """Simulated Discord API: fixed latency and a per-route rate limit."""
+
+    def __init__(self, latency: float = 0.05, rate_limit: int = 50, window: float = 1.0):
+        """
+        Args:
+            latency (float): Seconds each call takes
+            rate_limit (int): Calls allowed per route in each window, 0 for
+                no limit
+            window (float): Length of the rate limit window in seconds
+        """
+
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.calls = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self._recent = collections.defaultdict(collections.deque)
+
+    async def request(self, route: str):
+        now = time.monotonic()
+        if self.rate_limit and route != ROUTE_INTERACTIONS:
+            recent = self._recent[route]
+            while recent and recent[0] <= now - self.window:
+                recent.popleft()
+            if len(recent) >= self.rate_limit:
+                self.rate_limited[route] += 1
+                raise RateLimited(route, recent[0] + self.window - now)
+            recent.append(now)
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeRole:
+    def __init__(self, guild: 'FakeGuild', name: str, role_id: int = None):
+        self.guild = guild
+        self.id = next(_ids) if role_id is None else role_id
+        self.name = name
+        self.managed = False
+
+    @property
+    def mention(self) -> str:
+        return f'<@&{self.id}>'
+
+    def is_default(self) -> bool:
+        return self.id == self.guild.id
+
+    async def delete(self):
+        await self.guild.api.request(ROUTE_ROLES)
+        self.guild._roles.pop(self.id, None)
+        for member in self.guild.members:
+            if self in member.roles:
+                member.roles.remove(self)
+
+    def __repr__(self) -> str:
+        return f'<FakeRole {self.name}>'
+
+
+class FakeMember:
+    def __init__(self, guild: 'FakeGuild', name: str):
+        self.guild = guild
+        self.id = next(_ids)
+        self.name = name
+        self.nick = None
+        self.bot = False
+        self.roles = [guild.default_role]
+        self.messages = []
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+    @property
+    def display_name(self) -> str:
+        return self.nick or self.name
+
+    def __str__(self) -> str:
+        return self.name
+
+    async def add_roles(self, *roles):
+        # One request per role, like nextcord's atomic add_roles
+        for role in roles:
+            await self.guild.api.request(ROUTE_MEMBER_ROLES)
+            if role not in self.roles:
+                self.roles.append(role)
+
+    async def remove_roles(self, *roles):
+        for role in roles:
+            await self.guild.api.request(ROUTE_MEMBER_ROLES)
+            if role in self.roles:
+                self.roles.remove(role)
+
+    async def edit(self, roles: list = None):
+        await self.guild.api.request(ROUTE_MEMBER_ROLES)
+        if roles is not None:
+            self.roles = [self.guild.default_role] + \
+                [role for role in roles if not role.is_default()]
+        return self
+
+    async def send(self, content: str = None, **kwargs):
+        await self.guild.api.request(ROUTE_MESSAGES)
+        self.messages.append(content)
+
+
+class FakeChannel:
+    def __init__(self, guild: 'FakeGuild', name: str, category: 'FakeChannel' = None):
+        self.guild = guild
+        self.id = next(_ids)
+        self.name = name
+        self.category = category
+        self.channels = []
+        self.overwrites = {}
+
+    @property
+    def text_channels(self) -> list:
+        return list(self.channels)
+
+    @property
+    def mention(self) -> str:
+        return f'<#{self.id}>'
+
+    async def create_text_channel(self, name: str, overwrites: dict = None, **kwargs):
+        channel = await self.guild.create_text_channel(name, overwrites=overwrites, category=self)
+        return channel
+
+    async def edit(self, name: str = None, **kwargs):
+        await self.guild.api.request(ROUTE_CHANNELS)
+        if name is not None:
+            self.name = name
+        return self
+
+    async def delete(self):
+        await self.guild.api.request(ROUTE_CHANNELS)
+        self.guild._channels.pop(self.id, None)
+        if self.category is not None and self in self.category.channels:
+            self.category.channels.remove(self)
+
+    async def send(self, content: str = None, **kwargs):
+        await self.guild.api.request(ROUTE_MESSAGES)
+
+
+class FakeGuild:
+    def __init__(self, api: FakeAPI = None, guild_id: int = None):
+        self.api = FakeAPI() if api is None else api
+        self.id = next(_ids) if guild_id is None else guild_id
+        self.default_role = FakeRole(self, '@everyone', self.id)
+        self._roles = {self.id: self.default_role}
+        self._members = {}
+        self._channels = {}
+
+    @property
+    def roles(self) -> list:
+        return list(self._roles.values())
+
+    @property
+    def members(self) -> list:
+        return list(self._members.values())
+
+    @property
+    def channels(self) -> list:
+        return list(self._channels.values())
+
+    def add_role(self, name: str, role_id: int = None) -> FakeRole:
+        """Add a role without an API call, e.g. for configured roles."""
+
+        role = FakeRole(self, name, role_id)
+        self._roles[role.id] = role
+        return role
+
+    def add_channel(self, name: str, channel_id: int = None) -> FakeChannel:
+        """Add a channel without an API call, e.g. for configured channels."""
+
+        channel = FakeChannel(self, name)
+        if channel_id is not None:
+            channel.id = channel_id
+        self._channels[channel.id] = channel
+        return channel
+
+    def add_member(self, name: str) -> FakeMember:
+        """Add a member without an API call, as if they joined."""
+
+        member = FakeMember(self, name)
+        self._members[member.id] = member
+        return member
+
+    def get_role(self, role_id: int) -> FakeRole:
+        return self._roles.get(role_id)
+
+    def get_member(self, member_id: int) -> FakeMember:
+        return self._members.get(member_id)
+
+    def get_member_named(self, name: str) -> FakeMember:
+        # Like nextcord, the first member with the name as username or nickname
+        for member in self._members.values():
+            if name in (member.name, member.nick):
+                return member
+        return None
+
+    def get_channel(self, channel_id: int) -> FakeChannel:
+        return self._channels.get(channel_id)
+
+    async def create_role(self, name: str, **kwargs) -> FakeRole:
+        await self.api.request(ROUTE_ROLES)
+        return self.add_role(name)
+
+    async def create_category_channel(self, name: str, overwrites: dict = None, **kwargs) -> FakeChannel:
+        await self.api.request(ROUTE_CHANNELS)
+        return self.add_channel(name)
+
+    async def create_text_channel(self, name: str, overwrites: dict = None, category: FakeChannel = None, **kwargs) -> FakeChannel:
+        await self.api.request(ROUTE_CHANNELS)
+        channel = self.add_channel(name)
+        channel.category = category
+        channel.overwrites = dict(overwrites or {})
+        if category is not None:
+            category.channels.append(channel)
+        return channel
+
+
+class FakeResponse:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+
+    async def defer(self, ephemeral: bool = False, **kwargs):
+        await self._interaction.guild.api.request(ROUTE_INTERACTIONS)
+
+
+class FakeMessage:
+    def __init__(self, interaction: 'FakeInteraction', content: str):
+        self._interaction = interaction
+        self.content = content
+
+    async def edit(self, content: str = None, **kwargs):
+        await self._interaction.guild.api.request(ROUTE_INTERACTIONS)
+        self.content = content
+        self._interaction.messages.append(content)
+
+
+class FakeFollowup:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+
+    async def send(self, content: str = None, ephemeral: bool = False, wait: bool = False, **kwargs):
+        await self._interaction.guild.api.request(ROUTE_INTERACTIONS)
+        self._interaction.messages.append(content)
+        if wait:
+            return FakeMessage(self._interaction, content)
+
+
+class FakeAttachment:
+    def __init__(self, data: bytes, filename: str = 'attachment'):
+        self.filename = filename
+        self.size = len(data)
+        self._data = data
+
+    async def read(self) -> bytes:
+        return self._data
+
+
+class FakeInteraction:
+    """A slash command invocation by a member."""
+
+    def __init__(self, guild: FakeGuild, user: FakeMember):
+        self.guild = guild
+        self.user = user
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.messages = []
+
+    async def send(self, content: str = None, ephemeral: bool = False, **kwargs):
+        await self.guild.api.request(ROUTE_INTERACTIONS)
+        self.messages.append(content)
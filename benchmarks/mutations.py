@@ -0,0 +1,130 @@
+"""Throughput and fairness benchmark for the guild mutation queue.
+
+Replays a kickoff-style burst against a fake guild (benchmarks.fakediscord)
+with per-route rate limits: --members participants verify (two roles each,
+high priority) while half of them form teams (a team role plus the team
+assigned role, normal priority) and --cleanup leftover roles are deleted (low
+priority). The same workload runs once calling the API directly, retrying
+429s after the advertised delay plus jitter, and once through mutations.MutationQueue.
+
+Reports elapsed time, API calls and 429s per route, and p50/p99 latency for
+each priority.
+
+Usage:
+    python -m benchmarks.mutations [--members 300] [--cleanup 50]
+        [--latency 0.02] [--rate-limit 50] [--arrival 2]
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import mutations
+from benchmarks import fakediscord
+
+
+async def _direct(function, *args):
+    while True:
+        try:
+            return await function(*args)
+        except fakediscord.RateLimited as error:
+            # Jittered, so that limited callers do not all retry at once
+            await asyncio.sleep(error.retry_after + random.uniform(0, 1))
+
+
+async def _run(queued: bool, args) -> tuple:
+    api = fakediscord.FakeAPI(latency=args.latency, rate_limit=args.rate_limit)
+    guild = fakediscord.FakeGuild(api)
+    participant_role = guild.add_role('Participant')
+    verified_role = guild.add_role('Verified')
+    team_assigned_role = guild.add_role('Team Assigned')
+    members = [guild.add_member(f'user{i}') for i in range(args.members)]
+    leftover_roles = [guild.add_role(f'leftover{i}') for i in range(args.cleanup)]
+
+    # Pace the queue just under the fake API's limit
+    limits = {route: (args.rate_limit * 0.95, args.rate_limit // 2, 8)
+              for route in mutations.DEFAULT_ROUTE_LIMITS}
+    queue = mutations.MutationQueue(limits)
+    latencies = {'high': [], 'normal': [], 'low': []}
+
+    async def timed(kind: str, delay: float, coroutine_function):
+        await asyncio.sleep(delay)
+        start_time = time.perf_counter()
+        await coroutine_function()
+        latencies[kind].append(time.perf_counter() - start_time)
+
+    async def verify(member):
+        if queued:
+            await queue.update_roles(member, add=[participant_role, verified_role],
+                                     priority=mutations.PRIORITY_HIGH)
+        else:
+            await _direct(member.add_roles, participant_role, verified_role)
+
+    async def join_team(member):
+        if queued:
+            team_role = await queue.submit(mutations.ROUTE_ROLES, guild.create_role, name=member.name)
+            await queue.update_roles(member, add=[team_role, team_assigned_role])
+        else:
+            team_role = await _direct(guild.create_role, member.name)
+            await _direct(member.add_roles, team_role, team_assigned_role)
+
+    async def cleanup(role):
+        if queued:
+            await queue.submit(mutations.ROUTE_ROLES, role.delete,
+                               priority=mutations.PRIORITY_LOW)
+        else:
+            await _direct(role.delete)
+
+    random.seed(0)
+    tasks = []
+    for member in members:
+        arrival = random.uniform(0, args.arrival)
+        tasks.append(timed('high', arrival, lambda member=member: verify(member)))
+        if member.id % 2 == 0:
+            tasks.append(timed('normal', arrival + 0.01,
+                               lambda member=member: join_team(member)))
+    for role in leftover_roles:
+        tasks.append(timed('low', 0, lambda role=role: cleanup(role)))
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start_time
+
+    missing = sum(participant_role not in member.roles or verified_role not in member.roles
+                  for member in members)
+    return elapsed, api, latencies, missing, queue.stats()
+
+
+def _report(name: str, elapsed: float, api, latencies: dict, missing: int):
+    print(f'{name}: {elapsed:.2f}s, {sum(api.calls.values())} API calls, '
+          f'{sum(api.rate_limited.values())} rate limited, {missing} members missing roles')
+    for route in sorted(api.calls):
+        print(f'  {route:>13}: {api.calls[route]} calls, {api.rate_limited[route]} rate limited')
+    for kind, values in latencies.items():
+        if len(values) > 1:
+            quantiles = statistics.quantiles(values, n=100)
+            print(f'  {kind:>13}: p50 {quantiles[49] * 1000:8.1f}ms, '
+                  f'p99 {quantiles[98] * 1000:8.1f}ms ({len(values)} requests)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=int, default=300)
+    parser.add_argument('--cleanup', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--rate-limit', type=int, default=50,
+                        help='Fake API calls allowed per route per second')
+    parser.add_argument('--arrival', type=float, default=2,
+                        help='Seconds over which verifications arrive')
+    args = parser.parse_args()
+
+    elapsed, api, latencies, missing, _ = asyncio.run(_run(False, args))
+    _report('direct', elapsed, api, latencies, missing)
+    elapsed, api, latencies, missing, stats = asyncio.run(_run(True, args))
+    _report('queued', elapsed, api, latencies, missing)
+    print(f'  queue stats: {stats}')
+
+
+if __name__ == '__main__':
+    main()
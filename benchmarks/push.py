@@ -0,0 +1,117 @@
+"""Load test comparing single-row and batch registration pushes.
+
+Pushes the same number of synthetic participant registrations through
+/push/participant (one request per row) and through /push/participant/batch
+(--batch-size rows per request) and reports rows per second for each.
+
+Without --url, requests go through Flask's test client against a temporary
+database, which measures the request handling and database cost without the
+network. With --url, they go to a running web server over keep-alive
+connections from --concurrency client threads.
+
+Usage:
+    python -m benchmarks.push [--rows 5000] [--batch-size 500]
+        [--url http://localhost:8080 --api-key KEY] [--concurrency 8]
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+def _rows(prefix: str, count: int) -> list:
+    return [{'email': f'{prefix}{i}@example.com', 'discord_username': f'{prefix}{i}'}
+            for i in range(count)]
+
+
+class _HTTPTransport:
+    def __init__(self, url: str, api_key: str):
+        self._url = urllib.parse.urlsplit(url)
+        self._api_key = api_key
+        self._local = threading.local()
+
+    def post(self, path: str, body: bytes, content_type: str) -> int:
+        # One keep-alive connection per client thread
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = http.client.HTTPConnection(
+                self._url.hostname, self._url.port)
+            self._local.connection = connection
+        connection.request('POST', path, body, {
+            'api-key': self._api_key, 'Content-Type': content_type})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+
+class _TestClientTransport:
+    def __init__(self, api_key: str):
+        import web
+        self._client = web._app.test_client()
+        self._api_key = api_key
+        self._lock = threading.Lock()
+
+    def post(self, path: str, body: bytes, content_type: str) -> int:
+        # records shares one connection, so in-process requests run one at a time
+        with self._lock:
+            return self._client.post(path, data=body, headers={
+                'api-key': self._api_key, 'Content-Type': content_type}).status_code
+
+
+def _run(transport, requests: list, concurrency: int) -> float:
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        statuses = list(executor.map(lambda request: transport.post(*request), requests))
+    elapsed = time.perf_counter() - start_time
+    failures = sum(status != 200 for status in statuses)
+    if failures:
+        print(f'  {failures} of {len(statuses)} requests failed')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--url', help='Base URL of a running web server')
+    parser.add_argument('--api-key', default='', help='API key for --url')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.url is None:
+            import config
+            import records
+            records.connect(os.path.join(directory, 'records.db'))
+            transport = _TestClientTransport(config.web_api_key)
+        else:
+            transport = _HTTPTransport(args.url, args.api_key)
+
+        # Unique prefixes so reruns against a live server are not duplicates
+        run_id = int(time.time())
+
+        single = [('/push/participant', json.dumps(row).encode(), 'application/json')
+                  for row in _rows(f'single{run_id}-', args.rows)]
+        elapsed = _run(transport, single, args.concurrency)
+        print(f'single: {args.rows / elapsed:10.1f} rows/s '
+              f'({len(single)} requests in {elapsed:.2f}s)')
+
+        rows = _rows(f'batch{run_id}-', args.rows)
+        batches = [
+            ('/push/participant/batch',
+             '\n'.join(json.dumps(row) for row in rows[i:i + args.batch_size]).encode(),
+             'application/x-ndjson')
+            for i in range(0, len(rows), args.batch_size)]
+        elapsed = _run(transport, batches, args.concurrency)
+        print(f' batch: {args.rows / elapsed:10.1f} rows/s '
+              f'({len(batches)} requests of up to {args.batch_size} rows in {elapsed:.2f}s)')
+
+
+if __name__ == '__main__':
+    main()
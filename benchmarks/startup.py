@@ -0,0 +1,106 @@
+"""Import-time profile of the bot's entry points and scripts.
+
+Runs each target module in a fresh interpreter with -X importtime, in a
+temporary directory holding a copy of --config (so no records.db is created
+next to the real one), and reports the median wall time of the process and the
+cumulative import time of the target over --repeats runs. With --verbose, the
+slowest imports of each target, by their own import time, are listed too.
+
+Usage:
+    python -m benchmarks.startup [--targets start,discord,web,exportData,csvToSQL,config,records]
+        [--repeats 5] [--config config.ini] [--save DIRECTORY] [--verbose]
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+_REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_DEFAULT_TARGETS = 'start,discord,web,exportData,csvToSQL,config,records'
+
+
+def _parse_importtime(stderr: str) -> list:
+    # (self microseconds, cumulative microseconds, module) for each
+    # "import time:" line
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative_time, module = line[len('import time:'):].split('|')
+        imports.append((int(self_time), int(cumulative_time), module.strip()))
+    return imports
+
+
+def _run(target: str, directory: str) -> tuple:
+    environment = dict(os.environ, PYTHONPATH=_REPOSITORY)
+    start_time = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {target}'],
+        cwd=directory, env=environment, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start_time
+    if process.returncode != 0:
+        # The last line of the traceback, or of the output of a script that
+        # exited on its own
+        output = (process.stderr.strip() or process.stdout.strip()).splitlines()
+        raise RuntimeError(output[-1] if output else f'exit status {process.returncode}')
+    return elapsed, process.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', default=_DEFAULT_TARGETS,
+                        help='Comma separated modules to import')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--config', default='config.ini',
+                        help='Configuration file the targets are run with')
+    parser.add_argument('--save',
+                        help='Directory to write the raw -X importtime output of each target to')
+    parser.add_argument('--verbose', action='store_true',
+                        help='List the slowest imports of each target')
+    args = parser.parse_args()
+
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+
+    print(f'{"target":>12} {"wall ms":>9} {"import ms":>10} {"modules":>8}')
+    failed = False
+    for target in args.targets.split(','):
+        wall_times = []
+        import_times = []
+        for _ in range(args.repeats):
+            with tempfile.TemporaryDirectory() as directory:
+                if os.path.isfile(args.config):
+                    shutil.copy(args.config, os.path.join(directory, 'config.ini'))
+                try:
+                    elapsed, stderr = _run(target, directory)
+                except RuntimeError as error:
+                    print(f'{target:>12} failed: {error}')
+                    failed = True
+                    break
+            imports = _parse_importtime(stderr)
+            wall_times.append(elapsed)
+            import_times.append(next(
+                (cumulative_time for _, cumulative_time, module in imports if module == target), 0))
+        if not wall_times:
+            continue
+
+        print(f'{target:>12} {statistics.median(wall_times) * 1000:>9.1f} '
+              f'{statistics.median(import_times) / 1000:>10.1f} {len(imports):>8}')
+        if args.save:
+            with open(os.path.join(args.save, f'{target}.importtime.txt'), 'w') as file:
+                file.write(stderr)
+        if args.verbose:
+            for self_time, _, module in sorted(imports, reverse=True)[:10]:
+                print(f'{"":>12} {self_time / 1000:>9.1f}  {module}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Cross-process write contention benchmark for records.db.
+
+Runs a bot-like writer (verifications and team changes) and a web-like writer
+(registration responses) as two processes against one database file, the way
+start.py does, and reports commits per second and locked-database failures
+for each.
+
+Usage:
+    python -m benchmarks.storage [--seconds 10] [--journal-mode WAL]
+        [--synchronous NORMAL] [--busy-timeout 5000] [--max-retries 5]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+import records
+
+
+def _bot_writer(
+        storage: dict,
+        team_id: int,
+        seconds: float,
+        results: multiprocessing.Queue):
+    records.connect(**storage)
+    commits = 0
+    failures = 0
+    discord_id = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        discord_id += 1
+        try:
+            records.add_participant(discord_id, f'{discord_id}@example.com')
+            records.add_to_team(discord_id, team_id)
+            commits += 2
+        except sqlite3.OperationalError:
+            failures += 1
+    results.put(('bot', commits, failures))
+
+
+def _web_writer(storage: dict, seconds: float, results: multiprocessing.Queue):
+    records.connect(**storage)
+    commits = 0
+    failures = 0
+    entry = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        entry += 1
+        try:
+            records.add_participant_response_entry(
+                f'{entry}@example.com', f'user{entry}')
+            commits += 1
+        except sqlite3.OperationalError:
+            failures += 1
+    results.put(('web', commits, failures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--journal-mode', default='WAL')
+    parser.add_argument('--synchronous', default='NORMAL')
+    parser.add_argument('--busy-timeout', type=int, default=5000)
+    parser.add_argument('--max-retries', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = {
+            'database_file': os.path.join(directory, 'records.db'),
+            'journal_mode': args.journal_mode,
+            'synchronous': args.synchronous,
+            'busy_timeout': args.busy_timeout,
+            'max_retries': args.max_retries,
+        }
+        # Create the schema up front so neither writer races to initialize it
+        records.connect(**storage)
+        team_id = records.create_team('benchmark', 0, 0, 0)
+
+        # Fresh interpreters, so no SQLite handle is shared across the fork
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        processes = [
+            context.Process(target=_bot_writer, args=(storage, team_id, args.seconds, results)),
+            context.Process(target=_web_writer, args=(storage, args.seconds, results)),
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # A writer that crashed (e.g. locked out while connecting with
+        # retries disabled) reports nothing, rather than hanging the run
+        reports = []
+        while not results.empty():
+            reports.append(results.get())
+
+    print(f'journal_mode={args.journal_mode} synchronous={args.synchronous} '
+          f'busy_timeout={args.busy_timeout}ms max_retries={args.max_retries}')
+    total = 0
+    for name, commits, failures in sorted(reports):
+        total += commits
+        print(f'{name:>5}: {commits / args.seconds:10.1f} commits/s, '
+              f'{failures} locked failures')
+    print(f'total: {total / args.seconds:10.1f} commits/s')
+
+
+if __name__ == '__main__':
+    main()
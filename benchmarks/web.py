@@ -0,0 +1,145 @@
+"""Request rate and latency benchmark for the push API servers.
+
+Starts the eventlet server (web.py) or the aiohttp server (aioweb.py) in its
+own process against a temporary database (the eventlet server with --workers
+worker processes), or targets a running server with --url, then drives it with --connections concurrent keep-alive clients
+pushing single registrations for --seconds. Reports requests per second and
+p50/p99 latency.
+
+With --write-behind, the started server acknowledges pushes from a
+write-behind log and records them in group commits (see writebehind.py),
+using the write_behind_* settings of config.ini. --synchronous sets the
+database's synchronous level, FULL making every commit sync to disk.
+
+Usage:
+    python -m benchmarks.web [--server eventlet|aiohttp] [--workers 1] [--write-behind]
+        [--synchronous NORMAL] [--connections 32] [--seconds 10] [--port 8181] [--url http://host:port --api-key KEY]
+"""
+
+import argparse
+import asyncio
+import functools
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+import aiohttp
+
+
+def _serve_eventlet(database_file: str, port: int, workers: int, write_behind_log: str, synchronous: str):
+    import eventlet
+    from eventlet import wsgi
+    import records
+    import web
+    connect = functools.partial(records.connect, database_file, synchronous=synchronous)
+    if workers > 1:
+        web._supervise(('127.0.0.1', port), workers, connect, log_output=False,
+                       write_behind_log=write_behind_log)
+        return
+    connect()
+    if write_behind_log is not None:
+        web._start_write_behind(write_behind_log)
+    wsgi.server(eventlet.listen(('127.0.0.1', port)), web._app, log_output=False)
+
+
+def _serve_aiohttp(database_file: str, port: int, workers: int, write_behind_log: str, synchronous: str):
+    import records
+    import aioweb
+    records.connect(database_file, synchronous=synchronous)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(aioweb.serve('127.0.0.1', port, write_behind_log))
+    loop.run_forever()
+
+
+_SERVERS = {'eventlet': _serve_eventlet, 'aiohttp': _serve_aiohttp}
+
+
+async def _client(session: aiohttp.ClientSession, url: str, api_key: str,
+                  client_id: int, deadline: float, latencies: list, errors: list):
+    sequence = 0
+    while time.perf_counter() < deadline:
+        sequence += 1
+        start_time = time.perf_counter()
+        async with session.post(f'{url}/push/participant', headers={'api-key': api_key}, json={
+                'email': f'{client_id}-{sequence}@example.com',
+                'discord_username': f'user{client_id}-{sequence}'}) as response:
+            await response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        latencies.append(time.perf_counter() - start_time)
+
+
+async def _load(url: str, api_key: str, connections: int, seconds: float) -> tuple:
+    latencies = []
+    errors = []
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Wait for the server to come up
+        for _ in range(100):
+            try:
+                async with session.post(f'{url}/push/participant') as response:
+                    await response.read()
+                break
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*(
+            _client(session, url, api_key, client_id, deadline, latencies, errors)
+            for client_id in range(connections)))
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=_SERVERS, default='eventlet')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes of the eventlet server')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='Acknowledge pushes from a write-behind log')
+    parser.add_argument('--synchronous', default='NORMAL',
+                        help='SQLite synchronous level of the started server')
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('--url', help='Base URL of a running server to target instead')
+    parser.add_argument('--api-key', help='API key, config.web_api_key by default')
+    args = parser.parse_args()
+
+    api_key = args.api_key
+    if api_key is None:
+        import config
+        api_key = config.web_api_key
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = None
+        url = args.url
+        if url is None:
+            url = f'http://127.0.0.1:{args.port}'
+            server = multiprocessing.get_context('spawn').Process(
+                target=_SERVERS[args.server],
+                args=(os.path.join(directory, 'records.db'), args.port, args.workers,
+                      os.path.join(directory, 'push.log') if args.write_behind else None,
+                      args.synchronous),
+                daemon=True)
+            server.start()
+        try:
+            latencies, errors = asyncio.run(
+                _load(url, api_key, args.connections, args.seconds))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    target = url if args.url is not None else f'{args.server}, {args.workers} workers' if args.server == 'eventlet' else args.server
+    if args.url is None:
+        target += f', synchronous={args.synchronous}' + (', write-behind' if args.write_behind else '')
+    print(f'{target}: {args.connections} connections, {args.seconds:.0f}s')
+    print(f'  {len(latencies) / args.seconds:10.1f} requests/s, {len(errors)} errors')
+    print(f'  p50 {quantiles[49] * 1000:.2f}ms, p99 {quantiles[98] * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import os
+import time
+import records
+
+
+'''
+Remove duplicate registration responses and expired Idempotency-Key responses
+from the records, then rebuild the database file to reclaim their space.
+
+Responses are duplicates when their email address and Discord username match
+once normalized (case and surrounding whitespace ignored); the first one
+recorded is kept. Only databases created before responses were made unique
+can hold duplicates, and upgrading them removes those. Stop the bot and the
+web server first, since rebuilding the file needs it to themselves.
+
+Example:
+    python compactRecords.py
+    python compactRecords.py --database records.db --idempotency-key-ttl 24
+'''
+
+
+def _file_size(database_file: str) -> int:
+    return sum(os.path.getsize(name) for name in (database_file, f'{database_file}-wal')
+               if os.path.isfile(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Remove duplicate registration responses and reclaim their space.')
+    parser.add_argument('--database', default='records.db',
+                        help='Records database file (default: records.db)')
+    parser.add_argument('--idempotency-key-ttl', type=float, default=24,
+                        help='Hours after which Idempotency-Key responses are removed (default: 24)')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        raise SystemExit(f'Database file "{args.database}" not found')
+
+    start_time = time.perf_counter()
+    size_before = _file_size(args.database)
+    # Upgrading the database removes its duplicates
+    removed = records.connect(args.database)
+    expired_keys = records.remove_expired_idempotency_keys(args.idempotency_key_ttl * 3600)
+    records.vacuum()
+    records.close()
+    size_after = _file_size(args.database)
+
+    for role in records.REGISTRATION_ROLES:
+        print(f'{role}: {removed.get(role, 0)} duplicate responses removed')
+    print(f'{expired_keys} expired Idempotency-Key responses removed')
+    elapsed = time.perf_counter() - start_time
+    print(f'Done: {size_before / 1024:.0f} KiB -> {size_after / 1024:.0f} KiB '
+          f'({(size_before - size_after) / 1024:.0f} KiB reclaimed) in {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
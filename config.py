@@ -22,37 +22,173 @@ _REQUIRED_CONFIG_ENTRIES = [
     ('web', 'api_key'),
 ]
 
-_config = configparser.ConfigParser()
+# Optional configuration entries in _CONFIG_FILENAME, a list of tuples of
+# (section: str, option: str, default: str)
+_OPTIONAL_CONFIG_ENTRIES = [
+    ('database', 'file', 'records.db'),
+    ('database', 'journal_mode', 'WAL'),
+    ('database', 'synchronous', 'NORMAL'),
+    ('database', 'busy_timeout', '5000'),
+    ('database', 'max_retries', '5'),
+    ('database', 'cache_size', '10000'),
+    ('database', 'trace', 'no'),
+    ('database', 'slow_query_ms', '100'),
+    ('database', 'backend', 'file'),
+    ('database', 'snapshot_interval', '30'),
+    ('discord', 'auto_verify', 'no'),
+    ('discord', 'auto_verify_poll_interval', '5'),
+    ('discord', 'verify_hints', 'yes'),
+    ('discord', 'organizer_log_channel_id', ''),
+    ('web', 'mode', 'process'),
+    ('web', 'workers', '1'),
+    ('web', 'write_behind', 'no'),
+    ('web', 'write_behind_log', 'push.log'),
+    ('web', 'write_behind_interval_ms', '50'),
+    ('web', 'write_behind_max_rows', '500'),
+    ('web', 'write_behind_fsync', 'no'),
+    ('web', 'idempotency_key_ttl_hours', '24'),
+    ('metrics', 'snapshot_file', 'metrics.json'),
+    ('metrics', 'snapshot_interval', '15'),
+]
+
+_config = None
+
+
+def load():
+    """Read and validate the config file, exiting on errors.
+
+    Called on first access to a setting, so that importing this module is
+    cheap and scripts that use no settings do not need a config file. Entry
+    points call it up front to fail before starting anything.
+    """
+
+    global _config
+
+    if _config is not None:
+        return
+    _config = configparser.ConfigParser()
 
-try:
-    _config.read(_CONFIG_FILENAME)
-except configparser.Error:
-    print("ERROR: Error reading config file")
-    exit(1)
+    try:
+        _config.read(_CONFIG_FILENAME)
+    except configparser.Error:
+        print("ERROR: Error reading config file")
+        exit(1)
+
+    for _entry in _REQUIRED_CONFIG_ENTRIES:
+        _entry_value = _config.get(_entry[0], _entry[1])
+        if _entry_value is None:
+            print(
+                f'ERROR: Missing required config entry "{_entry[1]}" in section "{_entry[0]}"')
+            exit(1)
+
+    for _entry in _OPTIONAL_CONFIG_ENTRIES:
+        if not _config.has_section(_entry[0]):
+            _config.add_section(_entry[0])
+        if not _config.has_option(_entry[0], _entry[1]):
+            _config.set(_entry[0], _entry[1], _entry[2])
+
+    if _config['web']['mode'] not in ('process', 'bot'):
+        print(
+            f'ERROR: Invalid config entry "mode" in section "web", must be "process" or "bot"')
+        exit(1)
 
-for entry in _REQUIRED_CONFIG_ENTRIES:
-    entry_value = _config.get(entry[0], entry[1])
-    if entry_value is None:
+    if _config['database']['backend'] not in ('file', 'memory'):
         print(
-            f'ERROR: Missing required config entry "{entry[1]}" in section "{entry[0]}"')
+            f'ERROR: Invalid config entry "backend" in section "database", must be "file" or "memory"')
         exit(1)
 
-discord_guild_id = int(_config['discord']['guild_id'])
-discord_token = _config['discord']['token']
-discord_start_here_channel_id = int(
-    _config['discord']['start_here_channel_id'])
-discord_ask_an_organizer_channel_id = int(
-    _config['discord']['ask_an_organizer_channel_id'])
-discord_organizer_role_id = int(_config['discord']['organizer_role_id'])
-discord_participant_role_id = int(_config['discord']['participant_role_id'])
-discord_mentor_role_id = int(_config['discord']['mentor_role_id'])
-discord_judge_role_id = int(_config['discord']['judge_role_id'])
-discord_team_assigned_role_id = int(
-    _config['discord']['team_assigned_role_id'])
-discord_all_access_pass_role_id = int(
-    _config['discord']['all_access_pass_role_id'])
-discord_verified_role_id = int(_config['discord']['verified_role_id'])
-contact_registration_link = _config['contact']['registration_link']
-contact_organizer_email = _config['contact']['organizer_email']
-web_port = int(_config['web']['port'])
-web_api_key = _config['web']['api_key']
+    if _config['database']['backend'] == 'memory' and _config['web']['mode'] != 'bot':
+        print(
+            f'ERROR: The "memory" database backend requires "bot" web mode, since only the bot process can see it')
+        exit(1)
+
+    if _config['database']['backend'] == 'memory' and _config.getboolean('web', 'write_behind'):
+        print(
+            f'ERROR: The "memory" database backend cannot be used with "write_behind", since acknowledged pushes would only be in memory until the next snapshot')
+        exit(1)
+
+    if not _config['web']['workers'].isdigit() or int(_config['web']['workers']) < 1:
+        print(
+            f'ERROR: Invalid config entry "workers" in section "web", must be a positive integer')
+        exit(1)
+
+    discord_guild_id = int(_config['discord']['guild_id'])
+    discord_token = _config['discord']['token']
+    discord_start_here_channel_id = int(
+        _config['discord']['start_here_channel_id'])
+    discord_ask_an_organizer_channel_id = int(
+        _config['discord']['ask_an_organizer_channel_id'])
+    discord_organizer_role_id = int(_config['discord']['organizer_role_id'])
+    discord_participant_role_id = int(_config['discord']['participant_role_id'])
+    discord_mentor_role_id = int(_config['discord']['mentor_role_id'])
+    discord_judge_role_id = int(_config['discord']['judge_role_id'])
+    discord_team_assigned_role_id = int(
+        _config['discord']['team_assigned_role_id'])
+    discord_all_access_pass_role_id = int(
+        _config['discord']['all_access_pass_role_id'])
+    discord_verified_role_id = int(_config['discord']['verified_role_id'])
+    # Verify members as they join when their username matches a registration,
+    # picking up new registrations every auto_verify_poll_interval seconds
+    discord_auto_verify = _config.getboolean('discord', 'auto_verify')
+    discord_auto_verify_poll_interval = float(
+        _config['discord']['auto_verify_poll_interval'])
+    # Tell members whose /verify or /mentify fails whether a registration was
+    # made with their Discord username (also polled every
+    # auto_verify_poll_interval seconds)
+    discord_verify_hints = _config.getboolean('discord', 'verify_hints')
+    # Channel where organizers are shown the registrations closest to failed
+    # verifications, if any
+    discord_organizer_log_channel_id = int(
+        _config['discord']['organizer_log_channel_id'] or 0) or None
+    contact_registration_link = _config['contact']['registration_link']
+    contact_organizer_email = _config['contact']['organizer_email']
+    web_port = int(_config['web']['port'])
+    web_api_key = _config['web']['api_key']
+    # "process" serves the push API from its own eventlet process (web.py), "bot"
+    # serves it from the bot's event loop (aioweb.py)
+    web_mode = _config['web']['mode']
+    # Processes serving the push API in "process" mode, sharing one listening
+    # socket, each with its own database connection
+    web_workers = int(_config['web']['workers'])
+    # Acknowledge single pushes once appended to write_behind_log, recording
+    # them in group commits every write_behind_interval_ms milliseconds or
+    # write_behind_max_rows entries (see writebehind.py)
+    web_write_behind = _config.getboolean('web', 'write_behind')
+    web_write_behind_log = _config['web']['write_behind_log']
+    web_write_behind_interval = float(
+        _config['web']['write_behind_interval_ms']) / 1000
+    web_write_behind_max_rows = int(_config['web']['write_behind_max_rows'])
+    web_write_behind_fsync = _config.getboolean('web', 'write_behind_fsync')
+    # How long the response to a push with an Idempotency-Key header is
+    # replayed to retries with the same key, in seconds
+    web_idempotency_key_ttl = float(
+        _config['web']['idempotency_key_ttl_hours']) * 3600
+    database_file = _config['database']['file']
+    database_journal_mode = _config['database']['journal_mode']
+    database_synchronous = _config['database']['synchronous']
+    database_busy_timeout = int(_config['database']['busy_timeout'])
+    database_max_retries = int(_config['database']['max_retries'])
+    database_cache_size = int(_config['database']['cache_size'])
+    # Opt-in SQL tracing, logging statements slower than slow_query_ms
+    database_trace = _config.getboolean('database', 'trace')
+    database_slow_query_ms = float(_config['database']['slow_query_ms'])
+    # "memory" keeps the records in memory, writing them to the database file
+    # every snapshot_interval seconds when they changed, and on shutdown. It
+    # needs web.mode "bot", and web.write_behind off.
+    database_backend = _config['database']['backend']
+    database_snapshot_interval = float(_config['database']['snapshot_interval'])
+    # Where the bot process writes its metrics for the web process to serve, and
+    # how often in seconds
+    metrics_snapshot_file = _config['metrics']['snapshot_file']
+    metrics_snapshot_interval = float(_config['metrics']['snapshot_interval'])
+
+    # Settings are the local names without a leading underscore
+    globals().update((name, value) for name, value in locals().items() if not name.startswith('_'))
+
+
+def __getattr__(name: str):
+    if not name.startswith('_') and _config is None:
+        load()
+        if name in globals():
+            return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
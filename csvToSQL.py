@@ -1,69 +1,85 @@
-import records
+import argparse
 import csv
+import itertools
+import time
+import records
 
 
 '''
-- Pull Data from CSV file
-- For every entry, call the add_participant() method
-'''
-
+Import registration responses from a CSV export into the records.
 
-FILENAME = "leaders.csv" 
-ATTR_DIS = "Discord is required"
-ATTR_EMAIL = "Q3"
+Rows are streamed from the file and added in batched transactions, skipping
+rows without an email address or Discord username and rows that are already
+in the records.
 
-# FILENAME = "participants.csv" 
-# ATTR_DIS = "Discord Username"
-# ATTR_EMAIL = "Email"
+Example:
+    python csvToSQL.py participants.csv --role participant --email-column Email --username-column "Discord Username"
+    python csvToSQL.py leaders.csv --role mentor --email-column Q3 --username-column "Discord is required"
+    python csvToSQL.py judges.csv --role judge --email-column Email --username-column Discord --database /srv/hackathon/records.db
+'''
 
-with open(FILENAME, 'r') as csv_file:
 
-    #Find delimiter of csv
+def _read_entries(csv_file, email_column: str, username_column: str, stats: dict):
+    #Find delimiter of csv ("," or ";")
     try:
-        dialect = csv.Sniffer().sniff(csv_file.read(1024))    #Find type of delimiter "; or ,"
-    except: 
-        raise BaseException("Cannot determine iterator in csv file (; or ,)")
+        dialect = csv.Sniffer().sniff(csv_file.read(4096), delimiters=',;')
+    except csv.Error:
+        raise SystemExit("Cannot determine delimiter in csv file (; or ,)")
     csv_file.seek(0)
 
-    #Attempt to Read file
-    try:
-        reader = csv.DictReader(csv_file, delimiter=",")
-    except:
-        raise BaseException("Cannot read/import csv file. Check format and resubmit")
-    
-    #Search through file for relevant user data
-    userArr = []
-    for user in reader:
-        userData = {}
-        
-        #Gather email and discord_username
-        for attr in user:
-
-            #Find attributes and add them to user profile
-            if(attr == ATTR_DIS and user[attr] != ""):
-                userData['discord_username'] = user[attr]
-
-            if(attr == ATTR_EMAIL and user[attr] != ""):
-                userData['email'] = user[attr]
-
-        if('email' in userData and 'discord_username' in userData):
-            userArr.append(userData)
-        
-    #Add userArr Data to DB
-    for i in range(len(userArr)):
-        if ("participants" in FILENAME):
-            if not (records.participant_response_exists(userArr[i]['email'].lower(), userArr[i]['discord_username'].lower())):
-                try:
-                    records.add_participant_response_entry(userArr[i]['email'].lower(), userArr[i]['discord_username'].lower())
-                    print(f'User {i}: Added')
-                except:
-                    print("Error adding data to DB")
-                    break
-        elif ("leaders" in FILENAME):
-            if not (records.mentor_response_exists(userArr[i]['email'].lower(), userArr[i]['discord_username'].lower())):
-                try:
-                    records.add_mentor_response_entry(userArr[i]['email'].lower(), userArr[i]['discord_username'].lower())
-                    print(f'Leader {i}: Added')
-                except:
-                    print("Error adding data to DB")
-                    break
\ No newline at end of file
+    reader = csv.DictReader(csv_file, dialect=dialect)
+    for column in (email_column, username_column):
+        if column not in (reader.fieldnames or []):
+            raise SystemExit(f'Column "{column}" not found in csv file. Columns are: {reader.fieldnames}')
+
+    for row in reader:
+        stats['read'] += 1
+        email = (row[email_column] or '').strip()
+        discord_username = (row[username_column] or '').strip()
+        if email == '' or discord_username == '':
+            stats['skipped'] += 1
+            continue
+        yield email, discord_username
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import registration responses from a CSV export.')
+    parser.add_argument('filename', help='CSV file to import')
+    parser.add_argument('--role', required=True, choices=records.REGISTRATION_ROLES,
+                        help='Registration role of every row in the file')
+    parser.add_argument('--email-column', required=True,
+                        help='Header of the email address column')
+    parser.add_argument('--username-column', required=True,
+                        help='Header of the Discord username column')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='Rows added per transaction (default: 5000)')
+    parser.add_argument('--database', default='records.db',
+                        help='Records database file (default: records.db)')
+    args = parser.parse_args()
+
+    records.connect(args.database)
+
+    stats = {'read': 0, 'skipped': 0, 'added': 0}
+    start_time = time.perf_counter()
+
+    with open(args.filename, 'r', newline='', encoding='utf-8-sig') as csv_file:
+        entries = _read_entries(
+            csv_file, args.email_column, args.username_column, stats)
+        while True:
+            batch = list(itertools.islice(entries, args.batch_size))
+            if not batch:
+                break
+            stats['added'] += records.add_response_entries(args.role, batch)
+            print(f'{stats["read"]} rows read, {stats["added"]} added')
+
+    elapsed = time.perf_counter() - start_time
+    duplicates = stats['read'] - stats['skipped'] - stats['added']
+    print(f'Done: {stats["read"]} rows read, {stats["added"]} added, '
+          f'{duplicates} already recorded, {stats["skipped"]} skipped as incomplete '
+          f'in {elapsed:.2f}s ({stats["read"] / elapsed:.0f} rows/s)')
+    records.close()
+
+
+if __name__ == '__main__':
+    main()
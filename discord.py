@@ -1,8 +1,21 @@
 import asyncio
+import functools
+import os
+import tempfile
+import time
+import traceback
 import nextcord
 from nextcord.ext import commands, application_checks
+import async_records
 import records
 import config
+import export
+import ingest
+import metrics
+import mutations
+import reconcile
+import regindex
+import scheduler
 
 _intents = nextcord.Intents.default()
 _intents.members = True
@@ -10,9 +23,91 @@ _intents.members = True
 _bot = commands.Bot(intents=_intents)
 _bot.default_guild_ids.append(config.discord_guild_id)
 
+# All guild mutations go through this queue, for pacing and prioritization
+_mutations = mutations.MutationQueue()
+
 _MAX_TEAM_SIZE = 4
+# Discord allows at most 50 channels in a category
+_TEAM_CATEGORY_CAPACITY = 50
 _TEAM_FORMATION_TIMEOUT = 60
 
+# Reconciliation passes must not overlap
+_reconcile_lock = asyncio.Lock()
+# With the "memory" backend, the records loaded on startup are the last
+# snapshot, which misses whatever changed between it and a crash. The first
+# pass after loading it only reports, rather than deleting the channels and
+# roles of the teams created since; /oreconcile applies its fixes.
+_reconciled_since_load = False
+# Held shared while teams are created or changed, and exclusively by
+# reconciliation passes
+_team_changes = reconcile.SharedLock()
+
+# Roles given to verified users, by registration role
+_VERIFICATION_ROLE_IDS = {
+    'participant': [config.discord_participant_role_id, config.discord_verified_role_id],
+    'mentor': [config.discord_mentor_role_id, config.discord_all_access_pass_role_id, config.discord_verified_role_id],
+    'judge': [config.discord_judge_role_id, config.discord_all_access_pass_role_id, config.discord_verified_role_id],
+}
+
+# Registrations by Discord username and email, for verifying members as they
+# join and for finding the registrations closest to failed verifications.
+# Judges verify through organizers only.
+_registrations = regindex.RegistrationIndex(['participant', 'mentor'])
+_registrations_task = None
+# Serves the push API from the bot's event loop in "bot" web mode
+_web_task = None
+_REGISTRATIONS_ENABLED = (config.discord_auto_verify or config.discord_verify_hints
+                          or config.discord_organizer_log_channel_id is not None)
+
+_BULK_VERIFY_MAX_FILE_SIZE = 1024 * 1024
+# Members whose roles are being changed at once by a bulk verification
+_BULK_VERIFY_CONCURRENCY = 10
+# Seconds between progress updates of a bulk verification
+_BULK_VERIFY_PROGRESS_INTERVAL = 2
+
+_COMMAND_DURATION = metrics.Histogram(
+    'command_duration_seconds',
+    'Time taken by each slash command handler',
+    ['command'])
+_COMMAND_ERRORS = metrics.Counter(
+    'command_errors_total',
+    'Slash command handlers that raised an exception',
+    ['command'])
+metrics.Counter(
+    'discord_api_calls_total',
+    'Discord API calls made through the mutation queue',
+    ['route'],
+    function=lambda: {(route,): stats['calls'] for route, stats in _mutations.stats().items()})
+metrics.Counter(
+    'discord_api_rate_limited_total',
+    'Discord API calls through the mutation queue that got a 429 response',
+    ['route'],
+    function=lambda: {(route,): stats['rate_limited'] for route, stats in _mutations.stats().items()})
+metrics.Gauge(
+    'discord_api_queued',
+    'Discord API calls waiting in the mutation queue',
+    ['route'],
+    function=lambda: {(route,): stats['queued'] for route, stats in _mutations.stats().items()})
+metrics.Gauge(
+    'team_formation_deadlines_pending',
+    'Teams waiting for their formation deadline',
+    function=lambda: _team_formation_scheduler.pending)
+
+
+def _instrumented(function):
+    # Times the command handler, and attributes the queries it makes to it
+    # when tracing
+    timed = metrics.timed(_COMMAND_DURATION, _COMMAND_ERRORS)(function)
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        token = records.calling_command.set(function.__name__)
+        try:
+            return await timed(*args, **kwargs)
+        finally:
+            records.calling_command.reset(token)
+    return wrapper
+
 
 async def _handle_permission_error(interaction: nextcord.Interaction, error: nextcord.ApplicationError):
     if isinstance(error, application_checks.errors.ApplicationMissingRole):
@@ -22,30 +117,226 @@ async def _handle_permission_error(interaction: nextcord.Interaction, error: nex
         raise error
 
 
-async def _handle_team_formation_timeout(interaction: nextcord.Interaction, team_id: int):
-    if records.team_exists(team_id) and records.get_team_size(team_id) <= 1:
-        for record in records.get_team_members(team_id):
-            await interaction.guild.get_member(record[0]).remove_roles(interaction.guild.get_role(config.discord_team_assigned_role_id))
-            records.remove_from_team(record[0])
-        await _delete_team(interaction.guild, team_id)
-        await interaction.followup.send(ephemeral=True,
-                                        content='Team formation timed out. Teams must have at least two members 1 minute after creation to be saved. You must re-create your team and use the `/addmember` command to add members to your team within one minute of using the `/createteam` command.')
-
-
-async def _delete_team(guild: nextcord.Guild, team_id: int):
-    await guild.get_role(records.get_team_role_id(team_id)).delete()
-    await guild.get_channel(records.get_team_text_channel_id(team_id)).delete()
-    # await guild.get_channel(records.get_team_category_channel_id(team_id)).delete()
-    records.drop_team(team_id)
+async def _handle_team_formation_timeouts(team_ids: list):
+    async with _team_changes.shared():
+        await _disband_unformed_teams(team_ids)
+
+
+async def _disband_unformed_teams(team_ids: list):
+    guild = _bot.get_guild(config.discord_guild_id)
+    handled_team_ids = list(team_ids)
+    for team in await async_records.get_teams(team_ids):
+        if team.size > 1:
+            continue
+        try:
+            await _disband_unformed_team(guild, team)
+        except Exception:
+            # Keep the deadline record, so the team is retried after a restart
+            handled_team_ids.remove(team.id)
+            traceback.print_exc()
+    await async_records.remove_team_deadlines(handled_team_ids)
+
+
+async def _disband_unformed_team(guild: nextcord.Guild, team: records.Team):
+    for member_id in team.member_ids:
+        member = guild.get_member(member_id)
+        await async_records.remove_from_team(member_id)
+        if member is None:
+            continue
+        await _mutations.update_roles(member, remove=[guild.get_role(config.discord_team_assigned_role_id)], priority=mutations.PRIORITY_LOW)
+        try:
+            await member.send(content='Team formation timed out. Teams must have at least two members 1 minute after creation to be saved. You must re-create your team and use the `/addmember` command to add members to your team within one minute of using the `/createteam` command.')
+        except nextcord.HTTPException:
+            # Member does not accept direct messages
+            pass
+    await _delete_team(guild, team)
+
+
+_team_formation_scheduler = scheduler.DeadlineScheduler(
+    _handle_team_formation_timeouts)
+
+
+async def _delete_team(guild: nextcord.Guild, team: records.Team):
+    await _mutations.submit(mutations.ROUTE_ROLES, guild.get_role(team.role_id).delete, priority=mutations.PRIORITY_LOW)
+    await _mutations.submit(mutations.ROUTE_CHANNELS, guild.get_channel(team.text_channel_id).delete, priority=mutations.PRIORITY_LOW)
+    # await _mutations.submit(mutations.ROUTE_CHANNELS, guild.get_channel(team.category_channel_id).delete, priority=mutations.PRIORITY_LOW)
+    await async_records.drop_team(team.id)
+    _team_formation_scheduler.cancel(team.id)
+
+
+async def _remove_unused_team_category(category_channel: nextcord.CategoryChannel):
+    # Other teams may have reserved a slot in the category meanwhile, in which
+    # case it stays
+    if await async_records.remove_team_category(category_channel.id, only_if_empty=True):
+        await _mutations.submit(mutations.ROUTE_CHANNELS, category_channel.delete, priority=mutations.PRIORITY_LOW)
+
+
+async def _undo_team_creation(
+        team_role: nextcord.Role,
+        category_channel: nextcord.CategoryChannel,
+        category_created: bool,
+        text_channel: nextcord.TextChannel,
+        team_id: int):
+    # Removes what a failed /createteam made, each argument being None if it
+    # got no further, and category_created being whether the category was
+    # opened for this team rather than reused. Dropping the team record frees
+    # its category slot. Failures are only logged, so that the error that
+    # stopped the creation is the one raised.
+    steps = []
+    if team_id is not None:
+        steps.append(functools.partial(async_records.drop_team, team_id))
+    elif category_channel is not None:
+        steps.append(functools.partial(async_records.release_team_category, category_channel.id))
+    if text_channel is not None:
+        steps.append(functools.partial(_mutations.submit, mutations.ROUTE_CHANNELS, text_channel.delete, priority=mutations.PRIORITY_LOW))
+    if category_created:
+        steps.append(functools.partial(_remove_unused_team_category, category_channel))
+    if team_role is not None:
+        steps.append(functools.partial(_mutations.submit, mutations.ROUTE_ROLES, team_role.delete, priority=mutations.PRIORITY_LOW))
+    for step in steps:
+        try:
+            await step()
+        except Exception:
+            traceback.print_exc()
+
+
+def _verification_hint(role: str, discord_username: str) -> str:
+    # What looks wrong with details matching no registration for the role.
+    # Only the registrations made with the member's own Discord username are
+    # looked at, and nothing from them is shown, so the hint cannot be used to
+    # find out whether someone else's email address is registered.
+    if not config.discord_verify_hints or _registrations_task is None:
+        return ''
+    if any(registration_role == role for registration_role, _ in _registrations.lookup(discord_username)):
+        return f' A {role} registration with your Discord username exists, but with a different email address. Check the email address for typos, and use the one you registered with.'
+    return f' No {role} registration has your Discord username. Make sure you registered with your Discord username (`{discord_username}`), not your display name.'
+
+
+def _format_matches(matches: list) -> str:
+    if not matches:
+        return 'No close registrations.'
+    return '\n'.join(f'- {match.role}: `<{match.email}>`, `{match.discord_username}` ({match.similarity:.0%} similar)'
+                     for match in matches)
+
+
+async def _log_verification_failure(command: str, user: nextcord.Member, role: str, email: str):
+    # Show organizers the closest registrations, to sort out the member's
+    # problem without a back and forth
+    if config.discord_organizer_log_channel_id is None or _registrations_task is None:
+        return
+    matches = _registrations.closest(email, user.name, role=role)
+    try:
+        await _bot.get_channel(config.discord_organizer_log_channel_id).send(
+            content=f'`/{command}` failed for {user.mention} (`{user.name}`) with `<{email}>`. Closest registrations:\n{_format_matches(matches)}'[:2000])
+    except (AttributeError, nextcord.HTTPException):
+        print(f'ERROR: Could not log a failed verification to channel {config.discord_organizer_log_channel_id}')
+
+
+def _members_by_username(guild: nextcord.Guild) -> dict:
+    # Lowercase username to the guild's members with it. Nicknames are left
+    # out, since anyone can set theirs to another member's username.
+    members = {}
+    for member in guild.members:
+        members.setdefault(member.name.lower(), []).append(member)
+    return members
+
+
+def _resolve_members(guild: nextcord.Guild, members_by_username: dict, user: str) -> list:
+    # The members that a mention, a Discord ID, or a username could refer to,
+    # from the guild's member cache
+    user_id = user.removeprefix('<@').removeprefix('!').removesuffix('>')
+    if user_id.isdigit():
+        member = guild.get_member(int(user_id))
+        return [] if member is None else [member]
+    return members_by_username.get(user.lower(), [])
+
+
+async def _reserve_team_category(guild: nextcord.Guild) -> tuple:
+    # Reuse a team category with space if there is one, otherwise open a new
+    # one. Either way, a channel slot in the category is reserved. Returns the
+    # category, and whether it was opened by this call.
+    while True:
+        category_channel_id = await async_records.reserve_team_category(_TEAM_CATEGORY_CAPACITY)
+        if category_channel_id is None:
+            break
+        category_channel = guild.get_channel(category_channel_id)
+        if category_channel is not None:
+            return category_channel, False
+        # Category was deleted from the server, forget it and try another
+        await async_records.remove_team_category(category_channel_id)
+
+    category_number = await async_records.get_team_category_count() + 1
+    category_channel = await _mutations.submit(mutations.ROUTE_CHANNELS, guild.create_category_channel, name=f'Teams {category_number}',
+                                               overwrites={
+                                                   guild.get_role(config.discord_all_access_pass_role_id): nextcord.PermissionOverwrite(view_channel=True)
+                                               })
+    try:
+        await async_records.add_team_category(category_channel.id)
+    except BaseException:
+        # Nothing records the category yet, so nothing else would remove it
+        try:
+            await _mutations.submit(mutations.ROUTE_CHANNELS, category_channel.delete, priority=mutations.PRIORITY_LOW)
+        except Exception:
+            traceback.print_exc()
+        raise
+    return category_channel, True
 
 
 @_bot.event
 async def on_ready():
+    global _registrations_task, _reconciled_since_load
+
+    if _REGISTRATIONS_ENABLED and _registrations_task is None:
+        await _registrations.refresh()
+        _registrations_task = _bot.loop.create_task(
+            _registrations.run(config.discord_auto_verify_poll_interval))
+        print(f'STATUS: Loaded {len(_registrations)} registrations for matching')
+
+    # Pick up team formation deadlines that were pending when the bot last
+    # stopped; any that have passed are handled right away
+    for team_id, deadline in await async_records.get_team_deadlines():
+        _team_formation_scheduler.schedule(team_id, deadline)
+    _team_formation_scheduler.start()
+
     print(
         f'STATUS: Connected to Discord as "{ _bot.user }", ID { _bot.user.id }')
 
+    # Catch up on changes made while the bot was down
+    dry_run = config.database_backend == 'memory' and not _reconciled_since_load
+    async with _reconcile_lock, _team_changes.exclusive():
+        report = await reconcile.reconcile(_bot.get_guild(config.discord_guild_id), _mutations, dry_run=dry_run)
+    _reconciled_since_load = True
+    if dry_run:
+        print(f'STATUS: Compared the records loaded from the last snapshot with the server, run /oreconcile to fix them\n{report.summary()}')
+    else:
+        print(f'STATUS: Reconciled records with the server\n{report.summary()}')
+
+
+@_bot.event
+async def on_member_join(member: nextcord.Member):
+    if not config.discord_auto_verify or member.bot:
+        return
+
+    # Only an unambiguous match is verified; anyone else uses /verify
+    registrations = _registrations.lookup(member.name)
+    if len(registrations) != 1:
+        return
+    (role, email), = registrations
+
+    added, = await async_records.add_verified_users([(role, member.id, email)])
+    if not added:
+        return
+    await _mutations.update_roles(member, add=[member.guild.get_role(role_id) for role_id in _VERIFICATION_ROLE_IDS[role]],
+                                  priority=mutations.PRIORITY_HIGH)
+    try:
+        await member.send(content=f'Welcome! You have been verified automatically as a {role} using your registration with `<{email}>`. Head over to the {_bot.get_channel(config.discord_start_here_channel_id).mention} channel for instructions on your next steps.')
+    except nextcord.HTTPException:
+        # Member does not accept direct messages
+        pass
+
 
 @_bot.slash_command(description="Verify your Discord account as a participant for this event")
+@_instrumented
 async def verify(
     interaction: nextcord.Interaction,
     email: str = nextcord.SlashOption(
@@ -55,27 +346,30 @@ async def verify(
     await interaction.response.defer(ephemeral=True)
 
     # User is already verified as a participant
-    if records.is_verified_participant(interaction.user.id):
+    if await async_records.is_verified_participant(interaction.user.id):
         await interaction.followup.send(ephemeral=True,
                                         content=f'Verification failed. You have already been verified. Head over to the {_bot.get_channel(config.discord_start_here_channel_id).mention} channel for instructions on your next steps.')
         return
 
     # User is not in the registration records
-    if not records.participant_response_exists(
+    if not await async_records.participant_response_exists(
             email.lower(), str(interaction.user.name)):
+        hint = _verification_hint('participant', interaction.user.name)
         await interaction.followup.send(ephemeral=True,
-                                        content=f'Verification failed. No registration record with email address `<{email}>` and Discord username `{interaction.user.name}` could be found. Registration is required to participate in this event. If you have not already registered, please register at {config.contact_registration_link}, then run the `/verify` command again. Please contact an organizer at `<{config.contact_organizer_email}>` or in the {_bot.get_channel(config.discord_ask_an_organizer_channel_id).mention} channel if you believe this is an error.')
+                                        content=f'Verification failed. No registration record with email address `<{email}>` and Discord username `{interaction.user.name}` could be found.{hint} Registration is required to participate in this event. If you have not already registered, please register at {config.contact_registration_link}, then run the `/verify` command again. Please contact an organizer at `<{config.contact_organizer_email}>` or in the {_bot.get_channel(config.discord_ask_an_organizer_channel_id).mention} channel if you believe this is an error.')
+        await _log_verification_failure('verify', interaction.user, 'participant', email)
         return
 
     # Happy case
-    records.add_participant(interaction.user.id, email.lower())
-    await interaction.user.add_roles(interaction.guild.get_role(
-        config.discord_participant_role_id), interaction.guild.get_role(config.discord_verified_role_id))
+    await async_records.add_participant(interaction.user.id, email.lower())
+    await _mutations.update_roles(interaction.user, add=[interaction.guild.get_role(
+        config.discord_participant_role_id), interaction.guild.get_role(config.discord_verified_role_id)], priority=mutations.PRIORITY_HIGH)
     await interaction.followup.send(ephemeral=True,
                                     content=f'Verification succeeded. You now have access to the Discord server. Head over to the {_bot.get_channel(config.discord_start_here_channel_id).mention} channel for instructions on your next steps.')
 
 
 @_bot.slash_command(description="Verify your Discord account as a mentor for this event")
+@_instrumented
 async def mentify(
     interaction: nextcord.Interaction,
     email: str = nextcord.SlashOption(
@@ -85,22 +379,24 @@ async def mentify(
     await interaction.response.defer(ephemeral=True)
 
     # User is already verified as a mentor
-    if records.is_verified_mentor(interaction.user.id):
+    if await async_records.is_verified_mentor(interaction.user.id):
         await interaction.followup.send(ephemeral=True,
                                         content=f'Verification failed. You have already been verified.')
         return
 
     # User is not in the registration records
-    if not records.mentor_response_exists(
+    if not await async_records.mentor_response_exists(
             email.lower(), str(interaction.user.name)):
+        hint = _verification_hint('mentor', interaction.user.name)
         await interaction.followup.send(ephemeral=True,
-                                        content=f'Verification failed. No registration record with email address `<{email}>` and Discord uername `{interaction.user.name}` could be found. Please contact an organizer at `<{config.contact_organizer_email}>` or in the {_bot.get_channel(config.discord_ask_an_organizer_channel_id).mention} channel if you believe this is an error.')
+                                        content=f'Verification failed. No registration record with email address `<{email}>` and Discord uername `{interaction.user.name}` could be found.{hint} Please contact an organizer at `<{config.contact_organizer_email}>` or in the {_bot.get_channel(config.discord_ask_an_organizer_channel_id).mention} channel if you believe this is an error.')
+        await _log_verification_failure('mentify', interaction.user, 'mentor', email)
         return
 
     # Happy case
-    records.add_mentor(interaction.user.id, email.lower())
-    await interaction.user.add_roles(interaction.guild.get_role(
-        config.discord_mentor_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id))
+    await async_records.add_mentor(interaction.user.id, email.lower())
+    await _mutations.update_roles(interaction.user, add=[interaction.guild.get_role(
+        config.discord_mentor_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id)], priority=mutations.PRIORITY_HIGH)
     await interaction.followup.send(ephemeral=True,
                                     content=f'Verification succeeded. You now have access to the Discord server.')
 
@@ -115,27 +411,28 @@ async def mentify(
     # await interaction.response.defer(ephemeral=True)
 
     # # User is already verified as a judge
-    # if records.is_verified_judge(interaction.user.id):
+    # if await async_records.is_verified_judge(interaction.user.id):
     #     await interaction.followup.send(ephemeral=True,
     #                                     content=f'Verification failed. You have already been verified. Head over to the {_bot.get_channel(config.discord_start_here_channel_id).mention} channel for instructions on your next steps.')
     #     return
 
     # # User is not in the registration records
-    # if not records.judge_response_exists(email.lower(), str(interaction.user.name)):
+    # if not await async_records.judge_response_exists(email.lower(), str(interaction.user.name)):
     #     await interaction.followup.send(ephemeral=True,
     #                                     content=f'Verification failed. No registration record with email address `<{email}>` and Discord username `{interaction.user.name}` could be found. Please contact an organizer at `<{config.contact_organizer_email}>` or in the {_bot.get_channel(config.discord_ask_an_organizer_channel_id).mention} channel if you believe this is an error.')
     #     return
 
     # # Happy case
-    # records.add_judge(interaction.user.id, email.lower())
-    # await interaction.user.add_roles(interaction.guild.get_role(
-    #     config.discord_judge_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id))
+    # await async_records.add_judge(interaction.user.id, email.lower())
+    # await _mutations.update_roles(interaction.user, add=[interaction.guild.get_role(
+    #     config.discord_judge_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id)], priority=mutations.PRIORITY_HIGH)
     # await interaction.followup.send(ephemeral=True,
     #                                 content=f'Verification succeeded. You now have access to the Discord server.')
 
 
 @_bot.slash_command(description="Manually verify a Discord account as a participant for this event (Organizers only)")
 @application_checks.has_role(config.discord_organizer_role_id)
+@_instrumented
 async def overify(
         interaction: nextcord.Interaction,
         member: nextcord.Member = nextcord.SlashOption(
@@ -148,15 +445,15 @@ async def overify(
         )):
     
     #User is already verified as a participant
-    if records.is_verified_participant(member.id):
+    if await async_records.is_verified_participant(member.id):
         await interaction.followup.send(ephemeral=True,
                                         content=f'Verification failed. {member} has already been verified.')
         return
 
     await interaction.response.defer(ephemeral=True)
 
-    records.add_participant(member.id, email.lower())
-    await member.add_roles(interaction.guild.get_role(config.discord_participant_role_id), interaction.guild.get_role(config.discord_verified_role_id))
+    await async_records.add_participant(member.id, email.lower())
+    await _mutations.update_roles(member, add=[interaction.guild.get_role(config.discord_participant_role_id), interaction.guild.get_role(config.discord_verified_role_id)])
 
     await interaction.followup.send(ephemeral=True,
                                     content=f'`{member} <{email}>` has been manually verified as a participant.')
@@ -166,6 +463,7 @@ overify.error(_handle_permission_error)
 
 @_bot.slash_command(description="Manually verify a Discord account as a mentor for this event (Organizers only)")
 @application_checks.has_role(config.discord_organizer_role_id)
+@_instrumented
 async def omentify(
         interaction: nextcord.Interaction,
         member: nextcord.Member = nextcord.SlashOption(
@@ -178,16 +476,16 @@ async def omentify(
         )):
 
     #User is already verified as a mentor
-    if records.is_verified_mentor(member.id):
+    if await async_records.is_verified_mentor(member.id):
         await interaction.followup.send(ephemeral=True,
                                         content=f'Verification failed. {member} has already been verified.')
         return
 
     await interaction.response.defer(ephemeral=True)
 
-    records.add_mentor(member.id, email.lower())
-    await member.add_roles(interaction.guild.get_role(
-        config.discord_mentor_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id))
+    await async_records.add_mentor(member.id, email.lower())
+    await _mutations.update_roles(member, add=[interaction.guild.get_role(
+        config.discord_mentor_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id)])
 
     await interaction.followup.send(ephemeral=True,
                                     content=f'`{member} <{email}>` has been manually verified as a mentor.')
@@ -197,6 +495,7 @@ omentify.error(_handle_permission_error)
 
 @_bot.slash_command(description="Manually verify a Discord account as a judge for this event (Organizers only)")
 @application_checks.has_role(config.discord_organizer_role_id)
+@_instrumented
 async def ojudgify(
         interaction: nextcord.Interaction,
         member: nextcord.Member = nextcord.SlashOption(
@@ -209,16 +508,16 @@ async def ojudgify(
         )):
     
     #User is already verified as a judge
-    if records.is_verified_judge(member.id):
+    if await async_records.is_verified_judge(member.id):
         await interaction.followup.send(ephemeral=True,
                                         content=f'Verification failed. <{member}> has already been verified.')
         return
 
     await interaction.response.defer(ephemeral=True)
 
-    records.add_judge(member.id, email.lower())
-    await member.add_roles(interaction.guild.get_role(
-        config.discord_judge_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id))
+    await async_records.add_judge(member.id, email.lower())
+    await _mutations.update_roles(member, add=[interaction.guild.get_role(
+        config.discord_judge_role_id), interaction.guild.get_role(config.discord_all_access_pass_role_id), interaction.guild.get_role(config.discord_verified_role_id)])
 
     await interaction.followup.send(ephemeral=True,
                                     content=f'`{member} <{email}>` has been manually verified as a judge.')
@@ -226,85 +525,257 @@ async def ojudgify(
 ojudgify.error(_handle_permission_error)
 
 
-@_bot.slash_command(description="Create a new team for this event")
-@application_checks.has_role(config.discord_participant_role_id)
-async def createteam(
+@_bot.slash_command(description="Verify Discord accounts in bulk from a CSV file (Organizers only)")
+@application_checks.has_role(config.discord_organizer_role_id)
+@_instrumented
+async def obulkverify(
         interaction: nextcord.Interaction,
-        name: str = nextcord.SlashOption(
-            description="Team name",
+        file: nextcord.Attachment = nextcord.SlashOption(
+            description="CSV file of Discord user, email, and role (participant, mentor, or judge) rows",
             required=True
         )):
 
     await interaction.response.defer(ephemeral=True)
 
-    # Participant is already in a team
-    if records.is_participant_in_team(interaction.user.id):
+    if file.size > _BULK_VERIFY_MAX_FILE_SIZE:
         await interaction.followup.send(ephemeral=True,
-                                        content=f'Team creation failed. You are already in the team {interaction.guild.get_role(records.get_team_role_id(records.get_team_id(interaction.user.id))).mention}. To create a new team, you must not currently be in a team.')
+                                        content=f'Bulk verification failed. The file exceeds {_BULK_VERIFY_MAX_FILE_SIZE // 1024} KiB.')
         return
-
-    if len(name) > 90:
+    try:
+        rows = ingest.parse_verification_csv(await file.read())
+    except ValueError as error:
         await interaction.followup.send(ephemeral=True,
-                                        content=f'Team creation failed. The team name `{name}` exceeds 90 characters. Team names must be between 1 and 90 characters long.')
+                                        content=f'Bulk verification failed. {error}')
         return
 
-    # Team name is taken
-    if records.is_team_name_used(name):
+    errors = []
+    entries = []
+    members_by_username = _members_by_username(interaction.guild)
+    for row in rows:
+        if isinstance(row, ingest.InvalidEntry):
+            errors.append(str(row))
+            continue
+        line, user, email, role = row
+        members = _resolve_members(interaction.guild, members_by_username, user)
+        if not members:
+            errors.append(f'Line {line}: no member `{user}` in the server')
+            continue
+        if len(members) > 1:
+            errors.append(f'Line {line}: more than one member `{user}` in the server, use their Discord ID')
+            continue
+        entries.append((members[0], email, role))
+
+    # All records in one transaction, then the roles, which are also given to
+    # users who were already verified but are missing them
+    added = await async_records.add_verified_users(
+        [(role, member.id, email) for member, email, role in entries])
+    progress = await interaction.followup.send(ephemeral=True, wait=True,
+                                               content=f'Recorded {sum(added)} verifications. Assigning roles to {len(entries)} members...')
+
+    semaphore = asyncio.Semaphore(_BULK_VERIFY_CONCURRENCY)
+    assigned = []
+
+    async def assign_roles(member: nextcord.Member, role: str):
+        async with semaphore:
+            try:
+                await _mutations.update_roles(member, add=[interaction.guild.get_role(role_id) for role_id in _VERIFICATION_ROLE_IDS[role]])
+            except Exception as error:
+                errors.append(f'Failed to assign roles to `{member}`: {error}')
+            else:
+                assigned.append(member)
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(_BULK_VERIFY_PROGRESS_INTERVAL)
+            try:
+                await progress.edit(content=f'Recorded {sum(added)} verifications. Assigned roles to {len(assigned)} of {len(entries)} members...')
+            except Exception:
+                # The next update may succeed, and the summary is sent regardless
+                traceback.print_exc()
+
+    progress_task = asyncio.get_running_loop().create_task(report_progress())
+    try:
+        await asyncio.gather(*(assign_roles(member, role) for member, _, role in entries))
+    finally:
+        progress_task.cancel()
+        try:
+            await progress_task
+        except asyncio.CancelledError:
+            pass
+
+    summary = f'Bulk verification complete. {sum(added)} verified, {len(entries) - sum(added)} already verified, roles assigned to {len(assigned)} members, {len(errors)} errors.'
+    if errors:
+        summary += '\n' + '\n'.join(errors)
+    # Discord messages are limited to 2000 characters
+    await progress.edit(content=summary[:2000])
+
+obulkverify.error(_handle_permission_error)
+
+
+@_bot.slash_command(description="Find the registrations closest to an email address or Discord username (Organizers only)")
+@application_checks.has_role(config.discord_organizer_role_id)
+@_instrumented
+async def omatch(
+        interaction: nextcord.Interaction,
+        email: str = nextcord.SlashOption(
+            description="Email address to match",
+            default=None,
+            required=False
+        ),
+        username: str = nextcord.SlashOption(
+            description="Discord username to match",
+            default=None,
+            required=False
+        ),
+        role: str = nextcord.SlashOption(
+            description="Registration role to match",
+            choices=['participant', 'mentor'],
+            default=None,
+            required=False
+        )):
+
+    await interaction.response.defer(ephemeral=True)
+
+    if _registrations_task is None:
+        await interaction.followup.send(ephemeral=True,
+                                        content='Matching failed. Registrations are not indexed, enable `auto_verify`, `verify_hints` or `organizer_log_channel_id` in the bot\'s config.')
+        return
+    if email is None and username is None:
         await interaction.followup.send(ephemeral=True,
-                                        content=f'Team creation failed. There is already a team with the name `{name}`.')
+                                        content='Matching failed. Give an email address, a Discord username, or both.')
         return
 
+    matches = _registrations.closest(email, username, role=role, limit=10, min_similarity=0.3)
+    await interaction.followup.send(ephemeral=True,
+                                    content=f'Closest registrations out of {len(_registrations)}:\n{_format_matches(matches)}'[:2000])
 
-    team_role = await interaction.guild.create_role(name=name)
-    
-    #If new channel needs to be made
-    team_id = records.get_max_team_id() + 1
-    max_category_num = 50
-    while(team_id > max_category_num):
-        max_category_num += 50
-
-    if (team_id == max_category_num - 49):
-        category_channel = await interaction.guild.create_category_channel(name=f'Teams {max_category_num-49}-{max_category_num}',
-                                                                        overwrites={
-                                                                            team_role: nextcord.PermissionOverwrite(view_channel=True),
-                                                                            interaction.guild.get_role(config.discord_all_access_pass_role_id): nextcord.PermissionOverwrite(view_channel=True)
-                                                                            
-                                                                            })
-    else:
-        #Find valid team below team id
-        search_team_id = team_id - 1
-        while(not records.team_exists(search_team_id)):
-            search_team_id -= 1
-
-        category_channel = interaction.guild.get_channel(records.get_team_category_channel_id(search_team_id))
-
-    text_channel = await category_channel.create_text_channel(name=f'##-{name.lower().replace(" ", "-")}-text',
-                                                                overwrites={
-                                                                team_role: nextcord.PermissionOverwrite(view_channel=True),
-                                                                interaction.guild.get_role(config.discord_all_access_pass_role_id): nextcord.PermissionOverwrite(view_channel=True),
-                                                                interaction.guild.default_role:  nextcord.PermissionOverwrite(view_channel=False)})
-
-    team_id = records.create_team(
-        name,
-        category_channel.id,
-        text_channel.id,
-        team_role.id)
-    
-    records.add_to_team(interaction.user.id, team_id)
-    await text_channel.edit(name=f'{team_id}-{name.lower().replace(" ", "-")}-text')
-    await interaction.user.add_roles(team_role, interaction.guild.get_role(config.discord_team_assigned_role_id))
+omatch.error(_handle_permission_error)
+
+
+@_bot.slash_command(description="Export all teams with their members (Organizers only)")
+@application_checks.has_role(config.discord_organizer_role_id)
+@_instrumented
+async def oexport(
+        interaction: nextcord.Interaction,
+        format: str = nextcord.SlashOption(
+            description="Export file format",
+            choices=list(export.FORMATS),
+            default='csv',
+            required=False
+        )):
+
+    await interaction.response.defer(ephemeral=True)
+
+    # The export is written on the records worker thread, straight to a
+    # temporary file, then uploaded from there
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, f'team_export.{format}')
+        teams = await async_records.run(export.export_teams, filename, format)
+        await interaction.followup.send(ephemeral=True,
+                                        content=f'Exported {teams} teams.',
+                                        file=nextcord.File(filename))
+
+oexport.error(_handle_permission_error)
+
+
+@_bot.slash_command(description="Fix differences between the records and the server (Organizers only)")
+@application_checks.has_role(config.discord_organizer_role_id)
+@_instrumented
+async def oreconcile(
+        interaction: nextcord.Interaction,
+        dry_run: bool = nextcord.SlashOption(
+            description="Only report what would be fixed",
+            default=False,
+            required=False
+        )):
+
+    await interaction.response.defer(ephemeral=True)
+
+    if _reconcile_lock.locked():
+        await interaction.followup.send(ephemeral=True,
+                                        content='Reconciliation failed. Another reconciliation is already running.')
+        return
+
+    async with _reconcile_lock, _team_changes.exclusive():
+        report = await reconcile.reconcile(interaction.guild, _mutations, dry_run=dry_run)
+    # Discord messages are limited to 2000 characters
     await interaction.followup.send(ephemeral=True,
-                                    content=f'Team creation succeeded. {team_role.mention} created. Make sure to add members to your team using the `/addmember` command. Teams with fewer than 2 members will be deleted after 1 minute.')
+                                    content=f'Reconciliation complete.\n{report.summary()}'[:2000])
+
+oreconcile.error(_handle_permission_error)
 
-    # Start team formation timer
-    await asyncio.sleep(_TEAM_FORMATION_TIMEOUT)
-    await _handle_team_formation_timeout(interaction, team_id)
+
+@_bot.slash_command(description="Create a new team for this event")
+@application_checks.has_role(config.discord_participant_role_id)
+@_instrumented
+async def createteam(
+        interaction: nextcord.Interaction,
+        name: str = nextcord.SlashOption(
+            description="Team name",
+            required=True
+        )):
+
+    await interaction.response.defer(ephemeral=True)
+
+    async with _team_changes.shared():
+        # Participant is already in a team
+        team = await async_records.get_team_for_member(interaction.user.id)
+        if team is not None:
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Team creation failed. You are already in the team {interaction.guild.get_role(team.role_id).mention}. To create a new team, you must not currently be in a team.')
+            return
+
+        if len(name) > 90:
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Team creation failed. The team name `{name}` exceeds 90 characters. Team names must be between 1 and 90 characters long.')
+            return
+
+        # Team name is taken
+        if await async_records.is_team_name_used(name):
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Team creation failed. There is already a team with the name `{name}`.')
+            return
+
+
+        # Whatever was created before a failure is removed again
+        team_role = category_channel = text_channel = team_id = None
+        category_created = False
+        try:
+            team_role = await _mutations.submit(mutations.ROUTE_ROLES, interaction.guild.create_role, name=name)
+
+            category_channel, category_created = await _reserve_team_category(interaction.guild)
+            text_channel = await _mutations.submit(mutations.ROUTE_CHANNELS, category_channel.create_text_channel, name=f'##-{name.lower().replace(" ", "-")}-text',
+                                                   overwrites={
+                                                   team_role: nextcord.PermissionOverwrite(view_channel=True),
+                                                   interaction.guild.get_role(config.discord_all_access_pass_role_id): nextcord.PermissionOverwrite(view_channel=True),
+                                                   interaction.guild.default_role:  nextcord.PermissionOverwrite(view_channel=False)})
+
+            # The formation deadline is recorded with the team, so that the
+            # team is disbanded even if the bot stops before scheduling it
+            deadline = time.time() + _TEAM_FORMATION_TIMEOUT
+            team_id = await async_records.create_team(
+                name,
+                category_channel.id,
+                text_channel.id,
+                team_role.id,
+                deadline)
+
+            await async_records.add_to_team(interaction.user.id, team_id)
+        except BaseException:
+            await _undo_team_creation(team_role, category_channel, category_created, text_channel, team_id)
+            raise
+        _team_formation_scheduler.schedule(team_id, deadline)
+        await _mutations.submit(mutations.ROUTE_CHANNELS, text_channel.edit, name=f'{team_id}-{name.lower().replace(" ", "-")}-text')
+        await _mutations.update_roles(interaction.user, add=[team_role, interaction.guild.get_role(config.discord_team_assigned_role_id)])
+        await interaction.followup.send(ephemeral=True,
+                                        content=f'Team creation succeeded. {team_role.mention} created. Make sure to add members to your team using the `/addmember` command. Teams with fewer than 2 members will be deleted after 1 minute.')
 
 createteam.error(_handle_permission_error)
 
 
 @_bot.slash_command(description="Add a member to your team")
 @application_checks.has_role(config.discord_participant_role_id)
+@_instrumented
 async def addmember(
         interaction: nextcord.Interaction,
         member: nextcord.Member = nextcord.SlashOption(
@@ -314,67 +785,106 @@ async def addmember(
 
     await interaction.response.defer(ephemeral=True)
 
-    # Not in a team
-    if not records.is_participant_in_team(interaction.user.id):
-        await interaction.followup.send(ephemeral=True,
-                                        content=f'Failed to add team member. You are not currently in a team. You must be in a team to add a team member.')
-        return
-
-    # Team is full
-    if records.get_team_size(records.get_team_id(
-            interaction.user.id)) > _MAX_TEAM_SIZE:
-        await interaction.followup.send(ephemeral=True,
-                                        content=f'Failed to add team member. There is no space in your team. Teams can have a maximum of {_MAX_TEAM_SIZE} members.')
-        return
-
-    # Unverified member
-    if not records.is_verified_participant(member.id):
+    async with _team_changes.shared():
+        # Not in a team
+        team = await async_records.get_team_for_member(interaction.user.id)
+        if team is None:
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Failed to add team member. You are not currently in a team. You must be in a team to add a team member.')
+            return
+
+        # Team is full
+        if team.size > _MAX_TEAM_SIZE:
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Failed to add team member. There is no space in your team. Teams can have a maximum of {_MAX_TEAM_SIZE} members.')
+            return
+
+        # Unverified member
+        if not await async_records.is_verified_participant(member.id):
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Failed to add team member. `{member}` is not a verified participant. All team members must be verified participants.')
+            return
+
+        # Member already in a team
+        if await async_records.is_participant_in_team(member.id):
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Failed to add team member. {member.mention} is already in a team. To join your team, they must leave their current team.')
+            return
+
+        # Happy path
+        team_role = interaction.guild.get_role(team.role_id)
+        await async_records.add_to_team(member.id, team.id)
+        await _mutations.update_roles(member, add=[team_role, interaction.guild.get_role(config.discord_team_assigned_role_id)])
         await interaction.followup.send(ephemeral=True,
-                                        content=f'Failed to add team member. `{member}` is not a verified participant. All team members must be verified participants.')
-        return
-
-    # Member already in a team
-    if records.is_participant_in_team(member.id):
-        await interaction.followup.send(ephemeral=True,
-                                        content=f'Failed to add team member. {member.mention} is already in a team. To join your team, they must leave their current team.')
-        return
-
-    # Happy path
-    team_id = records.get_team_id(interaction.user.id)
-    team_role = interaction.guild.get_role(records.get_team_role_id(team_id))
-    records.add_to_team(member.id, team_id)
-    await member.add_roles(team_role, interaction.guild.get_role(config.discord_team_assigned_role_id))
-    await interaction.followup.send(ephemeral=True,
-                                    content=f'Team member added successfully. {member.mention} has been added to {team_role.mention}.')
+                                        content=f'Team member added successfully. {member.mention} has been added to {team_role.mention}.')
 addmember.error(_handle_permission_error)
 
 
 @_bot.slash_command(description="Leave your current team")
 @application_checks.has_role(config.discord_participant_role_id)
+@_instrumented
 async def leaveteam(
         interaction: nextcord.Interaction):
 
     await interaction.response.defer(ephemeral=True)
 
-    # Not in a team
-    if not records.is_participant_in_team(interaction.user.id):
+    async with _team_changes.shared():
+        # Not in a team
+        team = await async_records.get_team_for_member(interaction.user.id)
+        if team is None:
+            await interaction.followup.send(ephemeral=True,
+                                            content=f'Failed to leave team. You are not currently in a team.')
+            return
+
+        # Happy path
+        # Counted when leaving rather than from the snapshot, since /addmember
+        # can add a member in between
+        remaining = await async_records.remove_from_team(interaction.user.id)
+        await _mutations.update_roles(interaction.user, remove=[interaction.guild.get_role(team.role_id), interaction.guild.get_role(config.discord_team_assigned_role_id)])
+        if remaining == 0:
+            await _delete_team(interaction.guild, team)
+
         await interaction.followup.send(ephemeral=True,
-                                        content=f'Failed to leave team. You are not currently in a team.')
-        return
+                                        content=f'Team left successfully. You have left `{team.name}`.')
 
-    # Happy path
-    team_id = records.get_team_id(interaction.user.id)
-    team_name = records.get_team_name(team_id)
-    records.remove_from_team(interaction.user.id)
-    await interaction.user.remove_roles(interaction.guild.get_role(records.get_team_role_id(team_id)), interaction.guild.get_role(config.discord_team_assigned_role_id))
-    if records.get_team_size(team_id) == 0:
-        await _delete_team(interaction.guild, team_id)
+leaveteam.error(_handle_permission_error)
 
-    await interaction.followup.send(ephemeral=True,
-                                    content=f'Team left successfully. You have left `{team_name}`.')
 
-leaveteam.error(_handle_permission_error)
+async def _serve_web():
+    # Serves the push API until the task is cancelled on shutdown (the bot's
+    # run() cancels every task before closing the loop), then stops it,
+    # flushing any write-behind log
+    import aioweb
+    runner = await aioweb.serve(
+        write_behind_log=config.web_write_behind_log if config.web_write_behind else None)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def _log_web_failure(task: asyncio.Task):
+    # E.g. the port being in use, which would otherwise go unnoticed
+    if not task.cancelled() and task.exception() is not None:
+        print(f'ERROR: The push API failed: {task.exception()!r}')
+        traceback.print_exception(task.exception())
 
 
 def start():
+    global _web_task
+
+    metrics.set_process('bot')
+    records.connect_configured(config)
+    if config.web_mode == 'bot':
+        _web_task = _bot.loop.create_task(_serve_web())
+        _web_task.add_done_callback(_log_web_failure)
+    # In "process" mode the web process serves the bot's metrics from snapshots
+    _bot.loop.create_task(metrics.monitor_event_loop(
+        snapshot_file=config.metrics_snapshot_file if config.web_mode == 'process' else None,
+        snapshot_interval=config.metrics_snapshot_interval))
+    if config.database_backend == 'memory':
+        _bot.loop.create_task(async_records.snapshot_periodically(config.database_snapshot_interval))
     _bot.run(config.discord_token)
+    # The push API has been stopped by now, so this writes the last snapshot
+    # of an in-memory database with everything it recorded
+    records.close()
@@ -0,0 +1,72 @@
+"""Streaming export of teams and their members.
+
+Teams are read with records.iter_team_members() and written as they are read,
+so exports use constant memory however many teams there are.
+"""
+
+import csv
+import itertools
+import json
+import records
+
+FORMATS = ('csv', 'jsonl')
+
+_CSV_HEADERS = ['Team ID', 'Team name', 'Team role ID',
+                'Member Discord ID', 'Member email']
+
+
+def write_teams(file, format: str) -> int:
+    """Write every team and its members to a file.
+
+    The csv format has one row per team member. The jsonl format has one JSON
+    object per team, with its members in a "members" list.
+
+    Args:
+        file (TextIO): The file to write to, opened with newline=''
+        format (str): The export format, one of FORMATS
+
+    Returns:
+        int: The number of teams written
+    """
+
+    rows = records.iter_team_members()
+    teams = 0
+
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(_CSV_HEADERS)
+        for team_id, team_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            writer.writerows(team_rows)
+            teams += 1
+
+    elif format == 'jsonl':
+        for team_id, team_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            team_rows = list(team_rows)
+            file.write(json.dumps({
+                'team_id': team_id,
+                'name': team_rows[0][1],
+                'role_id': team_rows[0][2],
+                'members': [{'discord_id': row[3], 'email': row[4]}
+                            for row in team_rows if row[3] is not None],
+            }) + '\n')
+            teams += 1
+
+    else:
+        raise ValueError(f'Unknown export format "{format}"')
+
+    return teams
+
+
+def export_teams(filename: str, format: str) -> int:
+    """Export every team and its members to a file.
+
+    Args:
+        filename (str): Path of the file to write, replaced if it exists
+        format (str): The export format, one of FORMATS
+
+    Returns:
+        int: The number of teams written
+    """
+
+    with open(filename, 'w', newline='') as file:
+        return write_teams(file, format)
@@ -1,50 +1,45 @@
-import csv
-import records
+import argparse
 import os
-
-#For all teams in the teamDB, get teamName and all users associated with it
-# TeamData = [Team ID, TeamName, Member1, Member2, Member3, Member4]
-
-HIGHEST_TEAM_ID = records.get_max_team_id()
-team_data_list = []
-
-for team_id in range(HIGHEST_TEAM_ID):
-    team_data = []
-    #If the team exists
-    if (records.team_exists(team_id)):
-        #Store id and name
-        team_data.append(team_id)
-        team_data.append(records.get_team_id) 
-
-        #Look for members
-        team_members = records.get_team_members(team_id)
-        for member in team_members:
-            team_data.append(member)
-
-        #Append to data list
-        team_data_list.append(team_data)
-
-#----------- Export Data to CSV ---------------#
-
-EXPORT_FILENAME = 'team_export.csv'
-
-#Remove file if it exists so it can be overwritten
-if os.path.isfile(EXPORT_FILENAME): os.remove(EXPORT_FILENAME)
-
-with open(EXPORT_FILENAME, 'w') as csv_file:
-
-    #Export Header Items
-    headers = ['Team ID', 'Team name', 'Member1', 'Member2', 'Member3', 'Member4']
-    writer = csv.writer(csv_file)
-    writer.writerow(headers)
-
-    #Add Rows of Data
-    for team in team_data_list:
-        writer.writerow(team)
-
-
-
-
-
+import sys
+import export
+import records
 
 
+'''
+Export all teams with their members and member emails.
+
+Example:
+    python exportData.py
+    python exportData.py --format jsonl --output teams.jsonl
+    python exportData.py --format csv --output -
+    python exportData.py --database /srv/hackathon/records.db
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export all teams with their members.')
+    parser.add_argument('--format', choices=export.FORMATS, default='csv',
+                        help='Export format (default: csv)')
+    parser.add_argument('--output',
+                        help='File to write, or - for standard output (default: team_export.<format>)')
+    parser.add_argument('--database', default='records.db',
+                        help='Records database file (default: records.db)')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        raise SystemExit(f'Database file "{args.database}" not found')
+    records.connect(args.database)
+
+    output = args.output or f'team_export.{args.format}'
+    if output == '-':
+        teams = export.write_teams(sys.stdout, args.format)
+        print(f'Exported {teams} teams', file=sys.stderr)
+    else:
+        teams = export.export_teams(output, args.format)
+        print(f'Exported {teams} teams to {output}')
+    records.close()
+
+
+if __name__ == '__main__':
+    main()
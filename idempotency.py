@@ -0,0 +1,68 @@
+"""Idempotency-Key handling for the push API, shared by its Flask (web.py)
+and aiohttp (aioweb.py) front ends.
+
+Pushes with an Idempotency-Key header get the response recorded for the
+first request with that key, rather than being handled again, so that a
+client can safely retry a push it got no response to. The responses are
+recorded with records.add_idempotent_response() for
+web.idempotency_key_ttl_hours; each front end looks them up and records
+them through its own records interface, and turns the errors raised here
+into HTTP responses.
+"""
+
+# Longest Idempotency-Key header accepted
+MAX_KEY_LENGTH = 255
+
+
+class KeyReused(ValueError):
+    """An Idempotency-Key sent again with a different request."""
+
+
+def check_key(key: str):
+    """Check an Idempotency-Key header before it is looked up.
+
+    Args:
+        key (str): The Idempotency-Key header
+
+    Raises:
+        ValueError: If the key is empty or longer than MAX_KEY_LENGTH
+    """
+
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ValueError('Invalid Idempotency-Key')
+
+
+def describe_request(method: str, path: str) -> str:
+    """Get what a request asks for, as recorded with its response.
+
+    Args:
+        method (str): The HTTP method
+        path (str): The request path
+
+    Returns:
+        str: The description to record and compare against
+    """
+
+    return f'{method} {path}'
+
+
+def replayed_response(recorded: tuple, request: str) -> str:
+    """Get the response to replay for a request whose Idempotency-Key has a
+    recorded response.
+
+    Args:
+        recorded (tuple[str, str]): The (request, response) recorded for the
+            key, from records.get_idempotent_response()
+        request (str): The request, from describe_request()
+
+    Raises:
+        KeyReused: If the key was recorded for a different request
+
+    Returns:
+        str: The response body recorded
+    """
+
+    recorded_request, body = recorded
+    if recorded_request != request:
+        raise KeyReused('Idempotency-Key was used for a different request')
+    return body
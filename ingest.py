@@ -0,0 +1,184 @@
+"""Parsing, validation, and recording of registration responses pushed to the
+web API in batches.
+
+A batch body is either a JSON array of entry objects, or NDJSON (one entry
+object per line) sent with an application/x-ndjson content type, which can be
+streamed by the sender. Each entry must have string "email" and
+"discord_username" fields. Invalid entries are reported individually and do
+not prevent the rest of the batch from being recorded.
+
+Organizers' bulk verification files are parsed here too, with the same
+approach to invalid rows.
+"""
+
+import csv
+import io
+import json
+import records
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson',
+                        'application/jsonl', 'application/x-jsonlines')
+
+# Maximum number of entries accepted in one batch
+MAX_BATCH_SIZE = 10000
+
+
+class InvalidEntry(ValueError):
+    """An entry in a batch that cannot be recorded."""
+
+
+def parse_batch(stream, content_type: str) -> list:
+    """Read the entries of a batch body.
+
+    Lines of an NDJSON body that are not valid JSON become InvalidEntry
+    items, so that they are reported in place rather than failing the batch.
+
+    Args:
+        stream (BinaryIO): The request body
+        content_type (str): The MIME type of the request body
+
+    Raises:
+        ValueError: If the body is not a JSON array or NDJSON, or holds more
+            than MAX_BATCH_SIZE entries
+
+    Returns:
+        list: The parsed entries, in order
+    """
+
+    if content_type in NDJSON_CONTENT_TYPES:
+        items = []
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as error:
+                items.append(InvalidEntry(f'Invalid JSON: {error}'))
+            if len(items) > MAX_BATCH_SIZE:
+                break
+    else:
+        items = json.load(stream)
+        if not isinstance(items, list):
+            raise ValueError('Batch body must be a JSON array or NDJSON')
+
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError(
+            f'Batch exceeds the maximum of {MAX_BATCH_SIZE} entries')
+    return items
+
+
+def validate_entry(item) -> tuple:
+    """Validate a single pushed entry.
+
+    Args:
+        item (Any): A parsed entry
+
+    Raises:
+        InvalidEntry: If the entry cannot be recorded
+
+    Returns:
+        tuple[str, str]: The (email, discord_username) of the entry
+    """
+
+    if isinstance(item, InvalidEntry):
+        raise item
+    if not isinstance(item, dict):
+        raise InvalidEntry('Entry must be a JSON object')
+
+    email = item.get('email')
+    discord_username = item.get('discord_username')
+    if not isinstance(email, str) or not email.strip():
+        raise InvalidEntry('Missing or empty "email"')
+    if not isinstance(discord_username, str) or not discord_username.strip():
+        raise InvalidEntry('Missing or empty "discord_username"')
+
+    return email.strip().lower(), discord_username.strip()
+
+
+def add_batch(role: str, items: list) -> dict:
+    """Record the valid entries of a batch in a single transaction.
+
+    Args:
+        role (str): The registration role, one of records.REGISTRATION_ROLES
+        items (list): Entries as returned by parse_batch
+
+    Returns:
+        dict: Counts of added, duplicate, and invalid entries, and a result for
+            each entry in order
+    """
+
+    results = []
+    entries = []
+    for item in items:
+        try:
+            email, discord_username = validate_entry(item)
+        except InvalidEntry as error:
+            results.append({'status': 'invalid', 'error': str(error)})
+            continue
+        entries.append((email, discord_username))
+        results.append({'email': email, 'discord_username': discord_username})
+
+    added = iter(records.try_add_response_entries(role, entries))
+    for result in results:
+        if 'error' not in result:
+            result['status'] = 'added' if next(added) else 'duplicate'
+
+    return {
+        'added': sum(result['status'] == 'added' for result in results),
+        'duplicate': sum(result['status'] == 'duplicate' for result in results),
+        'invalid': sum(result['status'] == 'invalid' for result in results),
+        'results': results,
+    }
+
+
+def parse_verification_csv(data: bytes) -> list:
+    """Read the rows of an organizer's bulk verification CSV file.
+
+    Each row is (Discord user, email, role), the role being one of
+    records.REGISTRATION_ROLES. A header row is skipped. Invalid rows become
+    InvalidEntry items, so that they are reported in place rather than
+    failing the file.
+
+    Args:
+        data (bytes): The file contents, UTF-8 encoded
+
+    Raises:
+        ValueError: If the file is not UTF-8, or holds more than
+            MAX_BATCH_SIZE rows
+
+    Returns:
+        list: For each row in order, a tuple of (line number, Discord user,
+            email, role), or an InvalidEntry
+    """
+
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError('File must be UTF-8 encoded CSV')
+
+    rows = []
+    reader = csv.reader(io.StringIO(text))
+    for row in reader:
+        line = reader.line_num
+        if not any(field.strip() for field in row):
+            continue
+        if len(row) != 3:
+            rows.append(InvalidEntry(f'Line {line}: expected 3 columns, found {len(row)}'))
+            continue
+        user, email, role = (field.strip() for field in row)
+        role = role.lower()
+        if role not in records.REGISTRATION_ROLES:
+            if line == 1:
+                # Header
+                continue
+            rows.append(InvalidEntry(f'Line {line}: unknown role "{role}"'))
+            continue
+        if not user or not email:
+            rows.append(InvalidEntry(f'Line {line}: missing Discord user or email'))
+            continue
+        rows.append((line, user, email.lower(), role))
+        if len(rows) > MAX_BATCH_SIZE:
+            raise ValueError(
+                f'File exceeds the maximum of {MAX_BATCH_SIZE} rows')
+    return rows
@@ -0,0 +1,315 @@
+"""Process metrics in the Prometheus text exposition format.
+
+Metrics are plain in-process counters, gauges and histograms, cheap enough to
+update on every command and query. Each process labels its samples with its
+name (see set_process()). The bot process, which has no HTTP server of its own
+in "process" web mode, periodically writes a snapshot of its metrics to a file
+(write_snapshot()), and the web process serves it from /metrics along with its
+own.
+"""
+
+import bisect
+import functools
+import itertools
+import json
+import math
+import os
+import threading
+import time
+
+# Latency buckets in seconds, from fast database queries to slow commands
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Content type of render()'s output
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []
+_process = 'main'
+
+
+def set_process(name: str):
+    """Set the process label added to every sample from this process.
+
+    Args:
+        name (str): Name of the process, e.g. "bot" or "web"
+    """
+
+    global _process
+    _process = name
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames=(), function=None):
+        """
+        Args:
+            name (str): Metric name
+            help (str): Description of the metric
+            labelnames ([str]): Label names, whose values are passed to each
+                update in the same order
+            function (Callable): Called when the metric is collected instead
+                of keeping values, returning the value, or a dict of values
+                keyed by tuples of label values
+        """
+
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _samples(self) -> list:
+        if self._function is None:
+            with self._lock:
+                values = dict(self._values)
+        else:
+            values = self._function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [('', dict(zip(self.labelnames, labels)), value)
+                for labels, value in values.items()]
+
+    def _family(self) -> dict:
+        return {'name': self.name, 'type': self.type, 'help': self.help,
+                'samples': [[suffix, dict(labels, process=_process), value]
+                            for suffix, labels, value in self._samples()]}
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        """Increment the counter.
+
+        Args:
+            *labels (str): Label values, in the order of the label names
+            amount (float): Amount to increment by
+        """
+
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value: float, *labels):
+        """Set the gauge.
+
+        Args:
+            value (float): New value
+            *labels (str): Label values, in the order of the label names
+        """
+
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """Counts of observed values in buckets, with their sum and count."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            name (str): Metric name
+            help (str): Description of the metric
+            labelnames ([str]): Label names, whose values are passed to each
+                observation in the same order
+            buckets ([float]): Upper bounds of the buckets, in increasing order
+        """
+
+        super().__init__(name, help, labelnames)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        """Record an observation.
+
+        Args:
+            value (float): Observed value
+            *labels (str): Label values, in the order of the label names
+        """
+
+        # Counts are kept per bucket and accumulated when collected
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self._buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _samples(self) -> list:
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        samples = []
+        for labels, counts in values.items():
+            labels = dict(zip(self.labelnames, labels))
+            total = 0
+            for bound, count in zip(self._buckets + (math.inf,), counts):
+                total += count
+                samples.append(('_bucket', dict(labels, le=_format_value(bound)), total))
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, total))
+        return samples
+
+
+def timed(histogram: Histogram, errors: Counter = None):
+    """Decorator recording the duration of each call to a coroutine function
+    in a histogram, labelled with the function's name.
+
+    Args:
+        histogram (Histogram): Histogram with a single label
+        errors (Counter): Counter with a single label, incremented when a call
+            raises
+
+    Returns:
+        Callable: The decorator
+    """
+
+    def decorator(function):
+        name = function.__name__
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except BaseException:
+                if errors is not None:
+                    errors.inc(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start_time, name)
+        return wrapper
+    return decorator
+
+
+_EVENT_LOOP_LAG = Histogram(
+    'event_loop_lag_seconds',
+    'How late event loop timer callbacks run',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+async def monitor_event_loop(interval: float = 0.5, snapshot_file: str = None, snapshot_interval: float = 15):
+    """Measure event loop lag until cancelled, optionally writing snapshots.
+
+    Args:
+        interval (float): Seconds between lag measurements
+        snapshot_file (str): File to write snapshots of this process's
+            metrics to, or None
+        snapshot_interval (float): Seconds between snapshots
+    """
+
+    # Imported here, since asyncio and its dependencies are slow to import
+    # and only the bot process runs an event loop
+    import asyncio
+
+    next_snapshot = 0
+    while True:
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        _EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start_time - interval))
+        if snapshot_file is not None and time.monotonic() >= next_snapshot:
+            next_snapshot = time.monotonic() + snapshot_interval
+            try:
+                write_snapshot(snapshot_file)
+            except OSError as error:
+                print(f'ERROR: Could not write metrics snapshot: {error}')
+
+
+def snapshot() -> list:
+    """Collect the current value of every metric in this process.
+
+    Returns:
+        [dict]: JSON serializable metric families
+    """
+
+    families = [metric._family() for metric in _metrics]
+    families.append({'name': 'metrics_snapshot_timestamp_seconds', 'type': 'gauge',
+                     'help': 'When the metrics were collected, as a Unix timestamp',
+                     'samples': [['', {'process': _process}, time.time()]]})
+    return families
+
+
+def write_snapshot(filename: str):
+    """Write a snapshot of this process's metrics to a file, replacing it
+    atomically.
+
+    Args:
+        filename (str): Path of the snapshot file
+    """
+
+    temporary_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary_filename, 'w') as file:
+        json.dump(snapshot(), file)
+    os.replace(temporary_filename, filename)
+
+
+def read_snapshot(filename: str) -> list:
+    """Read a snapshot written by write_snapshot() in another process.
+
+    Args:
+        filename (str): Path of the snapshot file
+
+    Returns:
+        [dict]: The metric families, or an empty list if there is no readable
+            snapshot
+    """
+
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return []
+
+
+def render(*other_snapshots) -> str:
+    """Render this process's metrics, and those of other processes, in the
+    Prometheus text format.
+
+    Args:
+        *other_snapshots ([dict]): Snapshots from read_snapshot()
+
+    Returns:
+        str: The metrics
+    """
+
+    # Families with the same name are merged, since each may only appear once
+    families = {}
+    for family in itertools.chain(snapshot(), *other_snapshots):
+        merged = families.setdefault(
+            family['name'], dict(family, samples=[]))
+        merged['samples'].extend(family['samples'])
+
+    lines = []
+    for family in families.values():
+        lines.append(f'# HELP {family["name"]} {family["help"]}')
+        lines.append(f'# TYPE {family["name"]} {family["type"]}')
+        for suffix, labels, value in family['samples']:
+            label_text = ','.join(
+                f'{name}="{_escape(str(label))}"' for name, label in labels.items())
+            lines.append(f'{family["name"]}{suffix}{{{label_text}}} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
@@ -0,0 +1,314 @@
+"""A rate-limit-aware queue for guild mutations.
+
+Every Discord API call that changes the guild (role changes, role and channel
+creation, edits, deletions) goes through a MutationQueue instead of being
+awaited directly. The queue
+
+- paces each route with a token bucket, so bursts (e.g. the kickoff
+  verification rush) are spread out instead of running into 429s,
+- serves each route's pending calls highest priority first, then in order,
+  so user-facing calls are not stuck behind cleanup,
+- merges pending role changes for the same member into a single
+  member.edit(roles=...) call, instead of one call per role added or removed,
+- waits out and retries calls that still get rate limited.
+"""
+
+import asyncio
+import collections
+import itertools
+import time
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+ROUTE_MEMBER_ROLES = 'member_roles'
+ROUTE_ROLES = 'roles'
+ROUTE_CHANNELS = 'channels'
+
+# Per route (requests per second, burst size, concurrent requests)
+DEFAULT_ROUTE_LIMITS = {
+    ROUTE_MEMBER_ROLES: (10, 10, 4),
+    ROUTE_ROLES: (5, 5, 2),
+    ROUTE_CHANNELS: (5, 5, 2),
+}
+
+# Times a rate limited call is retried before its error is raised
+_MAX_RATE_LIMIT_RETRIES = 5
+
+# Seconds for which the roles a member was last given by the queue are
+# trusted over the member's cached roles, which the gateway updates later
+_RECENT_ROLES_TTL = 30
+
+
+class _Job:
+    __slots__ = ('function', 'args', 'kwargs', 'futures', 'attempts')
+
+    def __init__(self, function, args, kwargs, future):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.attempts = 0
+
+
+class _RoleJob:
+    __slots__ = ('member', 'add', 'remove', 'futures', 'attempts', 'in_flight')
+
+    def __init__(self, member, future):
+        self.member = member
+        self.add = {}
+        self.remove = {}
+        self.futures = [future]
+        self.attempts = 0
+        self.in_flight = False
+
+    def merge(self, add: list, remove: list):
+        # Later changes win over earlier ones for the same role
+        for role in add:
+            self.remove.pop(role.id, None)
+            self.add[role.id] = role
+        for role in remove:
+            self.add.pop(role.id, None)
+            self.remove[role.id] = role
+
+
+class _Route:
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.queue = asyncio.PriorityQueue()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.calls = 0
+        self.rate_limited = 0
+        self.coalesced = 0
+
+    async def take_token(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, 'status', None) == 429
+
+
+def _retry_after(error: Exception) -> float:
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        retry_after = headers.get('Retry-After', 1)
+    return float(retry_after)
+
+
+class MutationQueue:
+    """Queue of guild mutations, paced and prioritized per route."""
+
+    def __init__(self, route_limits: dict = None):
+        """
+        Args:
+            route_limits (dict): Per route (requests per second, burst size,
+                concurrent requests), DEFAULT_ROUTE_LIMITS by default
+        """
+
+        self._route_limits = dict(DEFAULT_ROUTE_LIMITS)
+        self._route_limits.update(route_limits or {})
+        self._routes = {}
+        self._workers = []
+        self._sequence = itertools.count()
+        self._pending_role_jobs = {}
+        # Per member, (expiry time, role IDs) in order of expiry
+        self._recent_roles = collections.OrderedDict()
+        # Per member, [lock, number of jobs holding or waiting for it]
+        self._member_locks = {}
+
+    def _route(self, name: str) -> _Route:
+        route = self._routes.get(name)
+        if route is None:
+            route = _Route(name, *self._route_limits.get(
+                name, DEFAULT_ROUTE_LIMITS[ROUTE_CHANNELS]))
+            self._routes[name] = route
+            loop = asyncio.get_running_loop()
+            for _ in range(route.concurrency):
+                self._workers.append(loop.create_task(self._work(route)))
+        return route
+
+    def _enqueue(self, route: _Route, priority: int, job):
+        route.queue.put_nowait((priority, next(self._sequence), job))
+
+    async def submit(self, route: str, function, *args, priority: int = PRIORITY_NORMAL, **kwargs):
+        """Queue a call to a Discord API coroutine function and wait for its
+        result.
+
+        Args:
+            route (str): The rate limit route of the call, e.g. ROUTE_ROLES
+            function (Callable[..., Awaitable]): The coroutine function
+            *args: Positional arguments for the function
+            priority (int): PRIORITY_HIGH, PRIORITY_NORMAL, or PRIORITY_LOW
+            **kwargs: Keyword arguments for the function
+
+        Returns:
+            Any: The result of the call
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(self._route(route), priority,
+                      _Job(function, args, kwargs, future))
+        return await future
+
+    async def update_roles(self, member, add: list = (), remove: list = (), priority: int = PRIORITY_NORMAL):
+        """Queue role changes for a member and wait for them to be applied.
+
+        Changes queued for the same member before an earlier change has been
+        sent are merged into it, and all are applied with one API call.
+
+        Args:
+            member (nextcord.Member): The member
+            add ([nextcord.Role]): Roles to give the member
+            remove ([nextcord.Role]): Roles to take from the member
+            priority (int): PRIORITY_HIGH, PRIORITY_NORMAL, or PRIORITY_LOW
+        """
+
+        add = [role for role in add if role is not None]
+        remove = [role for role in remove if role is not None]
+        future = asyncio.get_running_loop().create_future()
+        key = (member.guild.id, member.id)
+        job = self._pending_role_jobs.get(key)
+        route = self._route(ROUTE_MEMBER_ROLES)
+        if job is None:
+            job = _RoleJob(member, future)
+            self._pending_role_jobs[key] = job
+            self._enqueue(route, priority, job)
+        else:
+            # Already queued; ride along with it. A higher priority request
+            # queues the merged job again at that priority, and whichever
+            # copy is dequeued first applies it.
+            job.futures.append(future)
+            route.coalesced += 1
+            self._enqueue(route, priority, job)
+        job.merge(add, remove)
+        await future
+
+    def stats(self) -> dict:
+        """Get call counters for each route.
+
+        Returns:
+            dict: Per route, the number of API calls made, calls that were
+                rate limited, role changes merged into another call, and calls
+                waiting
+        """
+
+        return {name: {'calls': route.calls,
+                       'rate_limited': route.rate_limited,
+                       'coalesced': route.coalesced,
+                       'queued': route.queue.qsize()}
+                for name, route in self._routes.items()}
+
+    def _member_role_ids(self, member) -> list:
+        key = (member.guild.id, member.id)
+        self._expire_recent_roles()
+        recent = self._recent_roles.get(key)
+        if recent is not None:
+            return list(recent[1])
+        return [role.id for role in member.roles if not role.is_default()]
+
+    def _expire_recent_roles(self):
+        # Entries all live for _RECENT_ROLES_TTL and are kept in the order
+        # they were set, so the expired ones are at the front
+        now = time.monotonic()
+        while self._recent_roles and next(iter(self._recent_roles.values()))[0] <= now:
+            self._recent_roles.popitem(last=False)
+
+    async def _apply_roles(self, route: _Route, job: _RoleJob):
+        key = (job.member.guild.id, job.member.id)
+        # Each edit replaces the member's whole role list, so edits for one
+        # member must not overlap, or one would undo the other. The lock is
+        # dropped once no job holds or waits for it.
+        entry = self._member_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._edit_roles(route, job)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._member_locks[key]
+
+    async def _edit_roles(self, route: _Route, job: _RoleJob):
+        member = job.member
+        current = self._member_role_ids(member)
+        roles = [role_id for role_id in current if role_id not in job.remove]
+        roles += [role_id for role_id in job.add if role_id not in roles]
+        if roles == current:
+            # Nothing to change, so no API call
+            return
+        await route.take_token()
+        route.calls += 1
+        roles = [job.add.get(role_id) or member.guild.get_role(role_id)
+                 for role_id in roles]
+        roles = [role for role in roles if role is not None]
+        await member.edit(roles=roles)
+        key = (member.guild.id, member.id)
+        self._recent_roles.pop(key, None)
+        self._recent_roles[key] = (
+            time.monotonic() + _RECENT_ROLES_TTL, [role.id for role in roles])
+
+    async def _work(self, route: _Route):
+        while True:
+            priority, _, job = await route.queue.get()
+            if isinstance(job, _RoleJob):
+                if job.in_flight or all(future.done() for future in job.futures):
+                    # Merged role job taken or applied from another queue entry
+                    continue
+                job.in_flight = True
+                key = (job.member.guild.id, job.member.id)
+                if self._pending_role_jobs.get(key) is job:
+                    del self._pending_role_jobs[key]
+
+            try:
+                if isinstance(job, _RoleJob):
+                    result = await self._apply_roles(route, job)
+                else:
+                    await route.take_token()
+                    route.calls += 1
+                    result = await job.function(*job.args, **job.kwargs)
+            except Exception as error:
+                if _is_rate_limit_error(error):
+                    route.rate_limited += 1
+                if _is_rate_limit_error(error) and job.attempts < _MAX_RATE_LIMIT_RETRIES:
+                    route.blocked_until = time.monotonic() + _retry_after(error)
+                    job.attempts += 1
+                    if isinstance(job, _RoleJob):
+                        key = (job.member.guild.id, job.member.id)
+                        pending = self._pending_role_jobs.get(key)
+                        if pending is not None:
+                            # Changes queued meanwhile join the retry
+                            job.merge(list(pending.add.values()), list(pending.remove.values()))
+                            job.futures += pending.futures
+                            pending.futures = []
+                        self._pending_role_jobs[key] = job
+                        job.in_flight = False
+                    self._enqueue(route, priority, job)
+                    continue
+                for future in job.futures:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for future in job.futures:
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,285 @@
+"""Reconciliation of records.db with the guild's members, roles and channels.
+
+The database and the guild drift apart when the bot is down while members
+join or leave, or when a Discord call fails partway through creating or
+deleting a team. reconcile() loads the whole database in one trip to the
+records worker thread, diffs it against the guild cache in one sweep, and
+then applies fixes:
+
+- members are given the roles their records call for, and lose team roles
+  and the team assigned role their records do not,
+- teams whose role and text channel are both gone are disbanded,
+- participants pointing at a team that no longer exists leave it,
+- team channels in team categories without a team record are deleted, along
+  with the team roles their permissions were granted to,
+- records of team categories that no longer exist are dropped, and channel
+  counts of the others recounted,
+- formation deadlines of teams that no longer exist are dropped.
+
+Problems that cannot be fixed safely from the database alone (such as a team
+missing only its role, or a member holding a verification role without a
+record) are reported but left alone.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import traceback
+import nextcord
+import async_records
+import config
+import mutations
+import records
+
+
+class Report:
+    """What a reconciliation pass changed, or would change in a dry run."""
+
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        # Number of fixes of each kind
+        self.fixes = collections.Counter()
+        # Fixes that raised an exception, by kind
+        self.failures = collections.Counter()
+        # Problems that were left alone
+        self.issues = []
+
+    def summary(self, limit: int = 20) -> str:
+        """Summarize the report.
+
+        Args:
+            limit (int): Maximum number of issues to list
+
+        Returns:
+            str: One line per kind of fix, then the issues
+        """
+
+        verb = 'Would fix' if self.dry_run else 'Fixed'
+        lines = [f'{verb} {count} x {kind}' + (f' ({self.failures[kind]} failed)' if self.failures[kind] else '')
+                 for kind, count in sorted(self.fixes.items())]
+        if not lines:
+            lines.append('Nothing to fix.')
+        if self.issues:
+            lines.append(f'{len(self.issues)} issues left alone:')
+            lines += [f'- {issue}' for issue in self.issues[:limit]]
+            if len(self.issues) > limit:
+                lines.append(f'- and {len(self.issues) - limit} more')
+        return '\n'.join(lines)
+
+
+class SharedLock:
+    """An asyncio lock held either by any number of holders at once (shared),
+    or by a single holder (exclusive).
+
+    Team commands hold it shared while they change teams, and reconciliation
+    holds it exclusively, so that it never sees a team halfway through being
+    created or changed. Waiting exclusive holders go first, so a steady stream
+    of team commands cannot hold off reconciliation.
+    """
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        """Hold the lock shared for the duration of an async with block."""
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._exclusive and not self._exclusive_waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._shared -= 1
+                self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        """Hold the lock exclusively for the duration of an async with block."""
+
+        async with self._condition:
+            self._exclusive_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._exclusive_waiting -= 1
+                # Shared waiters held off by this one may go ahead if it was
+                # cancelled
+                self._condition.notify_all()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+def _load() -> tuple:
+    # Runs on the records worker thread, so the snapshot is consistent with
+    # respect to the bot's own writes
+    return (records.get_participants(),
+            records.get_mentor_ids(),
+            records.get_judge_ids(),
+            records.get_all_teams(),
+            records.get_team_categories(),
+            [team_id for team_id, _ in records.get_team_deadlines()])
+
+
+async def reconcile(
+        guild: nextcord.Guild,
+        mutation_queue: mutations.MutationQueue,
+        dry_run: bool = False,
+        concurrency: int = 8) -> Report:
+    """Bring the guild and the database back in line with each other.
+
+    Must not run while teams are being created or changed, since their
+    channels and roles would look orphaned, their members' new roles
+    unexpected, and reserved category channel slots unused: callers hold the
+    SharedLock that team commands hold shared exclusively.
+
+    Args:
+        guild (nextcord.Guild): The event's guild, with its members cached
+        mutation_queue (mutations.MutationQueue): Queue for the guild changes,
+            which are made at low priority
+        dry_run (bool): Only report what would be changed
+        concurrency (int): Maximum number of fixes in progress at once
+
+    Returns:
+        Report: What was changed
+    """
+
+    report = Report(dry_run)
+    participants, mentor_ids, judge_ids, teams, categories, deadline_team_ids = \
+        await async_records.run(_load)
+    teams_by_id = {team.id: team for team in teams}
+    team_role_ids = {team.role_id for team in teams}
+    team_text_channel_ids = {team.text_channel_id for team in teams}
+    configured_role_ids = {
+        config.discord_organizer_role_id, config.discord_participant_role_id,
+        config.discord_mentor_role_id, config.discord_judge_role_id,
+        config.discord_team_assigned_role_id, config.discord_all_access_pass_role_id,
+        config.discord_verified_role_id}
+    verification_role_ids = {config.discord_participant_role_id,
+                             config.discord_mentor_role_id,
+                             config.discord_judge_role_id}
+    # (kind, coroutine function to call without arguments) for each fix
+    fixes = []
+
+    # Teams, against their role and text channel
+    disbanded_team_ids = set()
+    for team in teams:
+        role = guild.get_role(team.role_id)
+        text_channel = guild.get_channel(team.text_channel_id)
+        if role is None and text_channel is None:
+            disbanded_team_ids.add(team.id)
+            fixes.append(('teams without a role or channel', functools.partial(_disband_team, team)))
+        elif role is None:
+            report.issues.append(f'Team {team.id} "{team.name}" has no role')
+        elif text_channel is None:
+            report.issues.append(f'Team {team.id} "{team.name}" has no text channel')
+
+    # Roles each verified user should have, from their records
+    expected_role_ids = collections.defaultdict(set)
+    for discord_id, team_id in participants:
+        expected_role_ids[discord_id] |= {config.discord_participant_role_id,
+                                          config.discord_verified_role_id}
+        team = teams_by_id.get(team_id)
+        if team is not None and team.id not in disbanded_team_ids:
+            expected_role_ids[discord_id] |= {team.role_id,
+                                              config.discord_team_assigned_role_id}
+        elif team is None and team_id is not None:
+            fixes.append(('participants in a deleted team',
+                          functools.partial(async_records.remove_from_team, discord_id)))
+    for role_ids, role_id in ((mentor_ids, config.discord_mentor_role_id),
+                              (judge_ids, config.discord_judge_role_id)):
+        for discord_id in role_ids:
+            expected_role_ids[discord_id] |= {role_id,
+                                              config.discord_all_access_pass_role_id,
+                                              config.discord_verified_role_id}
+
+    # Members, against their records
+    member_ids = set()
+    managed_role_ids = team_role_ids | {config.discord_team_assigned_role_id}
+    for member in guild.members:
+        if member.bot:
+            continue
+        member_ids.add(member.id)
+        role_ids = {role.id for role in member.roles}
+        expected = expected_role_ids.get(member.id, set())
+        add = [guild.get_role(role_id) for role_id in expected - role_ids]
+        add = [role for role in add if role is not None]
+        remove = [role for role in member.roles
+                  if role.id in managed_role_ids and role.id not in expected]
+        if add or remove:
+            fixes.append(('members missing roles' if add else 'members with stale team roles',
+                          functools.partial(mutation_queue.update_roles, member, add=add, remove=remove,
+                                            priority=mutations.PRIORITY_LOW)))
+        for role_id in (role_ids & verification_role_ids) - expected:
+            report.issues.append(f'{member} has the role {guild.get_role(role_id)} without a record')
+    absent = len(expected_role_ids.keys() - member_ids)
+    if absent:
+        report.issues.append(f'{absent} verified users are not in the server')
+
+    # Team categories, against the team channels in them
+    orphaned_role_ids = set()
+    for category_channel_id, channel_count in categories:
+        category_channel = guild.get_channel(category_channel_id)
+        if category_channel is None:
+            fixes.append(('deleted team categories',
+                          functools.partial(async_records.remove_team_category, category_channel_id)))
+            continue
+        for text_channel in category_channel.text_channels:
+            if text_channel.id in team_text_channel_ids:
+                continue
+            fixes.append(('team channels without a team',
+                          functools.partial(mutation_queue.submit, mutations.ROUTE_CHANNELS, text_channel.delete,
+                                            priority=mutations.PRIORITY_LOW)))
+            # The team role is the one role the channel was opened up to
+            for target in text_channel.overwrites:
+                role = guild.get_role(target.id)
+                if role is not None and not role.is_default() and not role.managed \
+                        and role.id not in team_role_ids and role.id not in configured_role_ids:
+                    orphaned_role_ids.add(role.id)
+    for role_id in orphaned_role_ids:
+        role = guild.get_role(role_id)
+        if role is not None:
+            fixes.append(('team roles without a team',
+                          functools.partial(mutation_queue.submit, mutations.ROUTE_ROLES, role.delete,
+                                            priority=mutations.PRIORITY_LOW)))
+    counts = collections.Counter(team.category_channel_id for team in teams)
+    if any(counts[category_channel_id] != channel_count
+           for category_channel_id, channel_count in categories):
+        fixes.append(('team category counts', async_records.recount_team_categories))
+
+    stale_deadlines = [team_id for team_id in deadline_team_ids if team_id not in teams_by_id]
+    if stale_deadlines:
+        fixes.append(('deadlines of deleted teams',
+                      functools.partial(async_records.remove_team_deadlines, stale_deadlines)))
+
+    for kind, _ in fixes:
+        report.fixes[kind] += 1
+    if not dry_run:
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(_apply(semaphore, report, kind, fix) for kind, fix in fixes))
+    return report
+
+
+async def _apply(semaphore: asyncio.Semaphore, report: Report, kind: str, fix):
+    async with semaphore:
+        try:
+            await fix()
+        except Exception:
+            report.failures[kind] += 1
+            traceback.print_exc()
+
+
+async def _disband_team(team: records.Team):
+    for member_id in team.member_ids:
+        await async_records.remove_from_team(member_id)
+    await async_records.drop_team(team.id)
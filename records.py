@@ -1,5 +1,17 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import inspect
+import itertools
 import os
+import random
+import signal
 import sqlite3
+import sys
+import threading
+import time
+import metrics
 
 _DATABASE_FILE = 'records.db'
 
@@ -11,7 +23,151 @@ _PARTICIPANT_TABLE_NAME = 'participants'
 _MENTOR_TABLE_NAME = 'mentors'
 _JUDGE_TABLE_NAME = 'judges'
 
+# Verified user tables, keyed by registration role
+_VERIFIED_TABLE_NAMES = {
+    'participant': _PARTICIPANT_TABLE_NAME,
+    'mentor': _MENTOR_TABLE_NAME,
+    'judge': _JUDGE_TABLE_NAME,
+}
+
 _TEAM_TABLE_NAME = 'teams'
+_TEAM_CATEGORY_TABLE_NAME = 'team_categories'
+_TEAM_DEADLINE_TABLE_NAME = 'team_deadlines'
+_IDEMPOTENCY_KEY_TABLE_NAME = 'idempotency_keys'
+
+# Registration response tables, keyed by registration role
+_REG_RESPONSES_TABLE_NAMES = {
+    'participant': _PARTICIPANT_REG_RESPONSES_TABLE_NAME,
+    'mentor': _MENTOR_REG_RESPONSES_TABLE_NAME,
+    'judge': _JUDGE_REG_RESPONSES_TABLE_NAME,
+}
+
+REGISTRATION_ROLES = tuple(_REG_RESPONSES_TABLE_NAMES)
+
+_JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+# "file" queries the database file directly. "memory" loads it into an
+# in-memory database when connecting, and writes it back in snapshots (see
+# snapshot()), so queries never wait on the disk.
+_BACKENDS = ['file', 'memory']
+_SYNCHRONOUS_LEVELS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+# Base delay in seconds before retrying a statement on a locked database
+_RETRY_BACKOFF = 0.01
+
+# Cached participant state for Discord users that are not verified
+# participants, to tell them apart from verified participants without a team
+_NOT_VERIFIED = object()
+_MISSING = object()
+
+# Name of the bot command on whose behalf records functions are called, for
+# tracing. async_records runs functions in the caller's context, so setting it
+# around a command handler covers the queries the handler makes.
+calling_command = contextvars.ContextVar('calling_command', default=None)
+
+_CALL_DURATION = metrics.Histogram(
+    'records_call_duration_seconds',
+    'Time spent in each public records function',
+    ['function'])
+_QUERIES = metrics.Counter(
+    'records_queries_total',
+    'Database calls made by each public records function',
+    ['function'])
+
+
+def _cache_stat(name: str) -> dict:
+    # A counter of both caches, by cache label, for the metrics. The caches
+    # are replaced on connect(), so they are looked up on each collection.
+    return {('participants',): _participant_cache.stats()[name],
+            ('team_roles',): _team_role_cache.stats()[name]}
+
+
+metrics.Counter(
+    'records_cache_hits_total',
+    'Lookups served from the participant and team role caches',
+    ['cache'],
+    function=functools.partial(_cache_stat, 'hits'))
+metrics.Counter(
+    'records_cache_misses_total',
+    'Lookups in the participant and team role caches that queried the database',
+    ['cache'],
+    function=functools.partial(_cache_stat, 'misses'))
+metrics.Gauge(
+    'records_cache_entries',
+    'Entries held in the participant and team role caches',
+    ['cache'],
+    function=functools.partial(_cache_stat, 'size'))
+
+
+class Team:
+    """A snapshot of a team record and the Discord IDs of its members."""
+
+    __slots__ = ('id', 'name', 'category_channel_id', 'text_channel_id',
+                 'role_id', 'member_ids')
+
+    def __init__(
+            self,
+            id: int,
+            name: str,
+            category_channel_id: int,
+            text_channel_id: int,
+            role_id: int,
+            member_ids: list):
+        self.id = id
+        self.name = name
+        self.category_channel_id = category_channel_id
+        self.text_channel_id = text_channel_id
+        self.role_id = role_id
+        self.member_ids = member_ids
+
+    @property
+    def size(self) -> int:
+        """int: The number of members in the team"""
+
+        return len(self.member_ids)
+
+    def __repr__(self) -> str:
+        return f'Team(id={self.id}, name={self.name!r}, members={self.member_ids})'
+
+
+class _LRUCache:
+    """A bounded mapping that evicts its least recently used entry when full,
+    and counts lookup hits and misses."""
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self._capacity <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'capacity': self._capacity}
 
 
 def _initialize_db(cursor: sqlite3.Cursor):
@@ -35,43 +191,299 @@ def _initialize_db(cursor: sqlite3.Cursor):
     cursor.execute(f'CREATE TABLE {_TEAM_TABLE_NAME} ( id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, category_channel_id INTEGER NOT NULL, text_channel_id INTEGER NOT NULL, role_id INTEGER NOT NULL )')
 
 
-def add_participant_response_entry(email: str, discord_username: str):
-    """Add a participant registration response entry to the records.
+def _migrate_db(cursor: sqlite3.Cursor) -> dict:
+    # Schema changes are applied in order, each one bumping the SQLite
+    # user_version so that existing records.db files are upgraded in place.
+    # Runs in the caller's transaction, so the version read here cannot be
+    # changed by another process before the steps it calls for are applied.
+    # Returns the duplicate registration responses removed per role.
+    removed = {}
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+
+    if version < 1:
+        # Normalized lookup keys for registration responses, so that the
+        # *_response_exists() checks are index seeks instead of table scans
+        for table in _REG_RESPONSES_TABLE_NAMES.values():
+            cursor.execute(
+                f'ALTER TABLE {table} ADD COLUMN email_key TEXT')
+            cursor.execute(
+                f'ALTER TABLE {table} ADD COLUMN discord_username_key TEXT')
+            cursor.execute(
+                f'UPDATE {table} SET email_key=normalize_key(email), discord_username_key=normalize_key(discord_username)')
+            cursor.execute(
+                f'CREATE INDEX {table}_key_index ON {table} ( email_key, discord_username_key )')
+        cursor.execute('PRAGMA user_version = 1')
+
+    if version < 2:
+        # Team membership lookups (team size, members, team snapshots)
+        cursor.execute(
+            f'CREATE INDEX {_PARTICIPANT_TABLE_NAME}_team_id_index ON {_PARTICIPANT_TABLE_NAME} ( team_id )')
+        cursor.execute('PRAGMA user_version = 2')
+
+    if version < 3:
+        # Team category channels and how many team channels each one holds,
+        # so a category with space can be found without walking the teams
+        cursor.execute(
+            f'CREATE TABLE {_TEAM_CATEGORY_TABLE_NAME} ( category_channel_id INTEGER PRIMARY KEY, channel_count INTEGER NOT NULL )')
+        cursor.execute(
+            f'CREATE INDEX {_TEAM_CATEGORY_TABLE_NAME}_channel_count_index ON {_TEAM_CATEGORY_TABLE_NAME} ( channel_count )')
+        cursor.execute(
+            f'INSERT INTO {_TEAM_CATEGORY_TABLE_NAME} ( category_channel_id, channel_count ) SELECT category_channel_id, COUNT(*) FROM {_TEAM_TABLE_NAME} GROUP BY category_channel_id')
+        cursor.execute('PRAGMA user_version = 3')
+
+    if version < 4:
+        # Pending team formation deadlines, so they survive a bot restart
+        cursor.execute(
+            f'CREATE TABLE {_TEAM_DEADLINE_TABLE_NAME} ( team_id INTEGER PRIMARY KEY REFERENCES {_TEAM_TABLE_NAME}(id), deadline REAL NOT NULL )')
+        cursor.execute('PRAGMA user_version = 4')
+
+    if version < 5:
+        # One registration response per normalized (email, username) pair, so
+        # that adding one is an idempotent insert, and responses to push API
+        # requests by their Idempotency-Key, so that retries are answered the
+        # same way
+        removed = _delete_duplicate_responses(cursor)
+        for table in _REG_RESPONSES_TABLE_NAMES.values():
+            cursor.execute(f'DROP INDEX {table}_key_index')
+            cursor.execute(
+                f'CREATE UNIQUE INDEX {table}_key_unique_index ON {table} ( email_key, discord_username_key )')
+        cursor.execute(
+            f'CREATE TABLE {_IDEMPOTENCY_KEY_TABLE_NAME} ( key TEXT PRIMARY KEY, request TEXT NOT NULL, response TEXT NOT NULL, created REAL NOT NULL )')
+        cursor.execute(
+            f'CREATE INDEX {_IDEMPOTENCY_KEY_TABLE_NAME}_created_index ON {_IDEMPOTENCY_KEY_TABLE_NAME} ( created )')
+        cursor.execute('PRAGMA user_version = 5')
+
+    return removed
+
+
+def _delete_duplicate_responses(cursor: sqlite3.Cursor) -> dict:
+    # Keeps the first response recorded for each normalized pair
+    return {role: cursor.execute(
+        f'DELETE FROM {table} WHERE rowid NOT IN ( SELECT MIN(rowid) FROM {table} GROUP BY email_key, discord_username_key )').rowcount
+        for role, table in _REG_RESPONSES_TABLE_NAMES.items()}
+
+
+def normalize_key(value: str) -> str:
+    """Normalize an email address or Discord username the way the
+    registration response keys are, ignoring case and surrounding
+    whitespace, since registration forms and Discord do not agree on them.
+
+    Args:
+        value (str): The email address or Discord username
+
+    Returns:
+        str: The normalized key
+    """
+
+    return value.strip().lower()
+
+
+def _add_response_entry(table: str, email: str, discord_username: str) -> bool:
+    # Entries differing from a recorded one only in case or surrounding
+    # whitespace are the same entry, so there is nothing to update
+    return _execute(
+        f'INSERT INTO {table} ( email, discord_username, email_key, discord_username_key ) VALUES ( :email, :discord_username, :email_key, :discord_username_key ) ON CONFLICT ( email_key, discord_username_key ) DO NOTHING', {
+            'email': email,
+            'discord_username': discord_username,
+            'email_key': normalize_key(email),
+            'discord_username_key': normalize_key(discord_username)}).rowcount == 1
+
+
+def add_response_entries(role: str, entries) -> int:
+    """Add registration response entries to the records in a single
+    transaction, skipping entries that are already recorded.
+
+    Duplicates are detected on the normalized email address and Discord
+    username, both against existing records and within entries.
+
+    Args:
+        role (str): The registration role, one of REGISTRATION_ROLES
+        entries (Iterable[tuple[str, str]]): (email, discord_username) pairs
+
+    Returns:
+        int: The number of entries added
+    """
+
+    table = _REG_RESPONSES_TABLE_NAMES[role]
+    parameters = ({
+        'email': email,
+        'discord_username': discord_username,
+        'email_key': normalize_key(email),
+        'discord_username_key': normalize_key(discord_username)}
+        for email, discord_username in entries)
+    with _transaction():
+        return _executemany(
+            f'INSERT INTO {table} ( email, discord_username, email_key, discord_username_key ) VALUES ( :email, :discord_username, :email_key, :discord_username_key ) ON CONFLICT ( email_key, discord_username_key ) DO NOTHING',
+            parameters).rowcount
+
+
+def try_add_response_entries(role: str, entries) -> list:
+    """Add registration response entries to the records in a single
+    transaction, reporting for each entry whether it was added or skipped as
+    already recorded.
+
+    Args:
+        role (str): The registration role, one of REGISTRATION_ROLES
+        entries (Iterable[tuple[str, str]]): (email, discord_username) pairs
+
+    Returns:
+        [bool]: For each entry, if it was added
+    """
+
+    table = _REG_RESPONSES_TABLE_NAMES[role]
+    added = []
+    with _transaction():
+        for email, discord_username in entries:
+            added.append(_execute(
+                f'INSERT INTO {table} ( email, discord_username, email_key, discord_username_key ) VALUES ( :email, :discord_username, :email_key, :discord_username_key ) ON CONFLICT ( email_key, discord_username_key ) DO NOTHING', {
+                    'email': email,
+                    'discord_username': discord_username,
+                    'email_key': normalize_key(email),
+                    'discord_username_key': normalize_key(discord_username)}).rowcount == 1)
+    return added
+
+
+def get_response_entries_since(role: str, after_rowid: int = 0, limit: int = 10000) -> list:
+    """Get registration response entries added after a given one, in the order
+    they were added.
+
+    Lets an in-memory copy of the entries be loaded, then kept current by
+    asking only for the entries added since.
+
+    Args:
+        role (str): The registration role, one of REGISTRATION_ROLES
+        after_rowid (int): Row ID of the last entry already seen, 0 for all
+        limit (int): Maximum number of entries to return
+
+    Returns:
+        [tuple[int, str, str]]: (row ID, email, normalized Discord username)
+            for each entry
+    """
+
+    return _execute(
+        f'SELECT rowid, email, discord_username_key FROM {_REG_RESPONSES_TABLE_NAMES[role]} WHERE rowid > :after_rowid ORDER BY rowid LIMIT :limit', {
+            'after_rowid': after_rowid, 'limit': limit}).fetchall()
+
+
+def get_idempotent_response(key: str, max_age: float) -> tuple:
+    """Get the response recorded for a push API request by its Idempotency-Key.
+
+    Args:
+        key (str): The Idempotency-Key header
+        max_age (float): Seconds after which a recorded response is ignored
+
+    Returns:
+        tuple[str, str]: The (request, response) recorded, or None
+    """
+
+    return _execute(
+        f'SELECT request, response FROM {_IDEMPOTENCY_KEY_TABLE_NAME} WHERE key=:key AND created>=:created_after', {
+            'key': key, 'created_after': time.time() - max_age}).fetchone()
+
+
+def add_idempotent_response(key: str, request: str, response: str, max_age: float) -> bool:
+    """Record the response to a push API request by its Idempotency-Key,
+    unless one is already recorded and has not expired.
+
+    Responses that have expired are deleted at the same time, so the table
+    only holds those of the last max_age seconds.
+
+    Args:
+        key (str): The Idempotency-Key header
+        request (str): What was requested, e.g. the method and path
+        response (str): The response body
+        max_age (float): Seconds after which a recorded response is replaced
+
+    Returns:
+        bool: If the response was recorded
+    """
+
+    now = time.time()
+    with _transaction():
+        _execute(
+            f'DELETE FROM {_IDEMPOTENCY_KEY_TABLE_NAME} WHERE created<:created_after', {
+                'created_after': now - max_age})
+        return _execute(
+            f'INSERT INTO {_IDEMPOTENCY_KEY_TABLE_NAME} ( key, request, response, created ) VALUES ( :key, :request, :response, :created ) ON CONFLICT ( key ) DO NOTHING', {
+                'key': key, 'request': request, 'response': response, 'created': now}).rowcount == 1
+
+
+def remove_expired_idempotency_keys(max_age: float) -> int:
+    """Delete the responses recorded by Idempotency-Key that have expired.
+
+    Args:
+        max_age (float): Seconds after which a recorded response expires
+
+    Returns:
+        int: Number of responses deleted
+    """
+
+    return _execute(
+        f'DELETE FROM {_IDEMPOTENCY_KEY_TABLE_NAME} WHERE created<:created_after', {
+            'created_after': time.time() - max_age}).rowcount
+
+
+def vacuum():
+    """Rebuild the database file, returning the space left by deleted rows to
+    the file system. Must not be called inside a transaction.
+    """
+
+    _execute('VACUUM')
+
+
+def _response_exists(table: str, email: str, discord_username: str) -> bool:
+    return _execute(
+        f'SELECT EXISTS ( SELECT 1 FROM {table} WHERE email_key=:email_key AND discord_username_key=:discord_username_key )', {
+            'email_key': normalize_key(email),
+            'discord_username_key': normalize_key(discord_username)}).fetchone()[0] == 1
+
+
+def add_participant_response_entry(email: str, discord_username: str) -> bool:
+    """Add a participant registration response entry to the records, unless it is
+    already recorded.
 
     Args:
         email (str): The email address for the entry to add
         discord_username (str): The Discord username for the entry to add
+
+    Returns:
+        bool: If the entry was added
     """
 
-    _cursor.execute(
-        f'INSERT INTO {_PARTICIPANT_REG_RESPONSES_TABLE_NAME} ( email, discord_username ) VALUES ( :email, :discord_username )', {
-            'email': email, 'discord_username': discord_username})
+    return _add_response_entry(
+        _PARTICIPANT_REG_RESPONSES_TABLE_NAME, email, discord_username)
 
 
-def add_mentor_response_entry(email: str, discord_username: str):
-    """Add a mentor registration response entry to the records.
+def add_mentor_response_entry(email: str, discord_username: str) -> bool:
+    """Add a mentor registration response entry to the records, unless it is
+    already recorded.
 
     Args:
         email (str): The email address for the entry to add
         discord_username (str): The Discord username for the entry to add
+
+    Returns:
+        bool: If the entry was added
     """
 
-    _cursor.execute(
-        f'INSERT INTO {_MENTOR_REG_RESPONSES_TABLE_NAME} ( email, discord_username ) VALUES ( :email, :discord_username )', {
-            'email': email, 'discord_username': discord_username})
+    return _add_response_entry(
+        _MENTOR_REG_RESPONSES_TABLE_NAME, email, discord_username)
 
 
-def add_judge_response_entry(email: str, discord_username: str):
-    """Add a judge registration response entry to the records.
+def add_judge_response_entry(email: str, discord_username: str) -> bool:
+    """Add a judge registration response entry to the records, unless it is
+    already recorded.
 
     Args:
         email (str): The email address for the entry to add
         discord_username (str): The Discord username for the entry to add
+
+    Returns:
+        bool: If the entry was added
     """
 
-    _cursor.execute(
-        f'INSERT INTO {_JUDGE_REG_RESPONSES_TABLE_NAME} ( email, discord_username ) VALUES ( :email, :discord_username )', {
-            'email': email, 'discord_username': discord_username})
+    return _add_response_entry(
+        _JUDGE_REG_RESPONSES_TABLE_NAME, email, discord_username)
 
 
 def participant_response_exists(email: str, discord_username: str) -> bool:
@@ -86,11 +498,8 @@ def participant_response_exists(email: str, discord_username: str) -> bool:
         bool: If there is a record with the given email address and Discord username
     """
 
-    return _cursor.execute(
-        f'SELECT COUNT(*) FROM {_PARTICIPANT_REG_RESPONSES_TABLE_NAME} WHERE LOWER(email)=:email AND LOWER(discord_username)=:discord_username',
-        {
-            'email': email.lower(),
-            'discord_username': discord_username.lower()}).fetchone()[0] > 0
+    return _response_exists(
+        _PARTICIPANT_REG_RESPONSES_TABLE_NAME, email, discord_username)
 
 
 def mentor_response_exists(email: str, discord_username: str) -> bool:
@@ -105,11 +514,8 @@ def mentor_response_exists(email: str, discord_username: str) -> bool:
         bool: If there is a record with the given email address and Discord username
     """
 
-    return _cursor.execute(
-        f'SELECT COUNT(*) FROM {_MENTOR_REG_RESPONSES_TABLE_NAME} WHERE LOWER(email)=:email AND LOWER(discord_username)=:discord_username',
-        {
-            'email': email.lower(),
-            'discord_username': discord_username.lower()}).fetchone()[0] > 0
+    return _response_exists(
+        _MENTOR_REG_RESPONSES_TABLE_NAME, email, discord_username)
 
 
 def judge_response_exists(email: str, discord_username: str) -> bool:
@@ -124,11 +530,8 @@ def judge_response_exists(email: str, discord_username: str) -> bool:
         bool: If there is a record with the given email address and Discord username
     """
 
-    return _cursor.execute(
-        f'SELECT COUNT(*) FROM {_JUDGE_REG_RESPONSES_TABLE_NAME} WHERE LOWER(email)=:email AND LOWER(discord_username)=:discord_username',
-        {
-            'email': email.lower(),
-            'discord_username': discord_username.lower()}).fetchone()[0] > 0
+    return _response_exists(
+        _JUDGE_REG_RESPONSES_TABLE_NAME, email, discord_username)
 
 
 def add_participant(discord_id: int, email: str):
@@ -142,9 +545,10 @@ def add_participant(discord_id: int, email: str):
         email (str): Email address of the participant
     """
 
-    _cursor.execute(
+    _execute(
         f'INSERT INTO {_PARTICIPANT_TABLE_NAME} ( discord_id, email ) VALUES ( :discord_id, :email ) ', {
             'discord_id': discord_id, 'email': email})
+    _participant_cache.set(discord_id, None)
 
 
 def add_mentor(discord_id: int, email: str):
@@ -158,7 +562,7 @@ def add_mentor(discord_id: int, email: str):
         email (str): Email address of the mentor
     """
 
-    _cursor.execute(
+    _execute(
         f'INSERT INTO {_MENTOR_TABLE_NAME} ( discord_id, email ) VALUES ( :discord_id, :email ) ', {
             'discord_id': discord_id, 'email': email})
 
@@ -174,11 +578,69 @@ def add_judge(discord_id: int, email: str):
         email (str): Email address of the judge
     """
 
-    _cursor.execute(
+    _execute(
         f'INSERT INTO {_JUDGE_TABLE_NAME} ( discord_id, email ) VALUES ( :discord_id, :email ) ', {
             'discord_id': discord_id, 'email': email})
 
 
+def add_verified_users(entries) -> list:
+    """Add records for verified participants, mentors and judges in a single
+    transaction, skipping users already verified in the same role.
+
+    Args:
+        entries (Iterable[tuple[str, int, str]]): (role, Discord ID, email)
+            for each user, role being one of REGISTRATION_ROLES
+
+    Returns:
+        [bool]: For each entry, if it was added
+    """
+
+    entries = list(entries)
+    added = []
+    with _transaction():
+        for role, discord_id, email in entries:
+            added.append(_execute(
+                f'INSERT OR IGNORE INTO {_VERIFIED_TABLE_NAMES[role]} ( discord_id, email ) VALUES ( :discord_id, :email )', {
+                    'discord_id': discord_id, 'email': email}).rowcount == 1)
+    # Only once committed, so a rollback cannot leave the cache ahead
+    for (role, discord_id, _), was_added in zip(entries, added):
+        if role == 'participant' and was_added:
+            _participant_cache.set(discord_id, None)
+    return added
+
+
+def get_participants() -> list:
+    """Get every verified participant record.
+
+    Returns:
+        [tuple[int, int]]: (Discord ID, team ID or None) for each verified
+            participant
+    """
+
+    return _execute(
+        f'SELECT discord_id, team_id FROM {_PARTICIPANT_TABLE_NAME}').fetchall()
+
+
+def get_mentor_ids() -> list:
+    """Get the Discord IDs of every verified mentor.
+
+    Returns:
+        [int]: Discord IDs of the verified mentors
+    """
+
+    return [row[0] for row in _execute(f'SELECT discord_id FROM {_MENTOR_TABLE_NAME}')]
+
+
+def get_judge_ids() -> list:
+    """Get the Discord IDs of every verified judge.
+
+    Returns:
+        [int]: Discord IDs of the verified judges
+    """
+
+    return [row[0] for row in _execute(f'SELECT discord_id FROM {_JUDGE_TABLE_NAME}')]
+
+
 def is_verified_participant(discord_id: int) -> bool:
     """Check if a Discord user is verified as a participant.
 
@@ -189,9 +651,7 @@ def is_verified_participant(discord_id: int) -> bool:
         bool: If the Discord user is verified as a participant
     """
 
-    return _cursor.execute(
-        f'SELECT COUNT(*) FROM {_PARTICIPANT_TABLE_NAME} WHERE discord_id=:discord_id', {
-            'discord_id': discord_id}).fetchone()[0] > 0
+    return _get_participant_team_id(discord_id) is not _NOT_VERIFIED
 
 
 def is_verified_mentor(discord_id: int) -> bool:
@@ -204,7 +664,7 @@ def is_verified_mentor(discord_id: int) -> bool:
         bool: If the Discord user is verified as a mentor
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT COUNT(*) FROM {_MENTOR_TABLE_NAME} WHERE discord_id=:discord_id', {
             'discord_id': discord_id}).fetchone()[0] > 0
 
@@ -219,7 +679,7 @@ def is_verified_judge(discord_id: int) -> bool:
         bool: If the Discord user is verified as a judge
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT COUNT(*) FROM {_JUDGE_TABLE_NAME} WHERE discord_id=:discord_id', {
             'discord_id': discord_id}).fetchone()[0] > 0
 
@@ -230,7 +690,7 @@ def get_max_team_id() -> int:
         int: Max team_id in the table
     """
      
-    ans = _cursor.execute(f'SELECT MAX(id) FROM {_TEAM_TABLE_NAME}').fetchone()[0]
+    ans = _execute(f'SELECT MAX(id) FROM {_TEAM_TABLE_NAME}').fetchone()[0]
 
     last_id = ans if ans is not None else 0
     return last_id
@@ -239,8 +699,10 @@ def create_team(
         name: str,
         category_channel_id: int,
         text_channel_id: int,
-        role_id: int) -> int:
-    """Create a record for a new team.
+        role_id: int,
+        deadline: float = None) -> int:
+    """Create a record for a new team, and for its formation deadline in the
+    same transaction.
 
     Requires that no team record with the same name, category channel ID, text
     channele ID, or role ID exists.
@@ -250,14 +712,22 @@ def create_team(
         category_channel_id (int): The ID of the team's category channel
         text_channel_id (int): The ID of the team's text channel
         role_id (int): The ID of the team's role
+        deadline (float): When team formation times out, as a Unix timestamp,
+            or None if it does not
 
     Returns:
         int: The ID of the team record
     """
 
-    _cursor.execute(f'INSERT INTO {_TEAM_TABLE_NAME} ( name, category_channel_id, text_channel_id, role_id ) VALUES ( :name, :category_channel_id, :text_channel_id, :role_id )', {
-                    'name': name, 'category_channel_id': category_channel_id, 'text_channel_id': text_channel_id, 'role_id': role_id})
-    return _cursor.lastrowid
+    with _transaction():
+        team_id = _execute(f'INSERT INTO {_TEAM_TABLE_NAME} ( name, category_channel_id, text_channel_id, role_id ) VALUES ( :name, :category_channel_id, :text_channel_id, :role_id )', {
+                        'name': name, 'category_channel_id': category_channel_id, 'text_channel_id': text_channel_id, 'role_id': role_id}).lastrowid
+        if deadline is not None:
+            _execute(
+                f'INSERT INTO {_TEAM_DEADLINE_TABLE_NAME} ( team_id, deadline ) VALUES ( :team_id, :deadline )', {
+                    'team_id': team_id, 'deadline': deadline})
+    _team_role_cache.set(team_id, role_id)
+    return team_id
 
 
 def drop_team(team_id: int):
@@ -267,8 +737,155 @@ def drop_team(team_id: int):
         team_id (int): The ID of the team record
     """
 
-    _cursor.execute(
-        f'DELETE FROM {_TEAM_TABLE_NAME} WHERE id=:id', {'id': team_id})
+    with _transaction():
+        # Free the team's channel slot in its category
+        _execute(
+            f'UPDATE {_TEAM_CATEGORY_TABLE_NAME} SET channel_count=channel_count - 1 WHERE category_channel_id=( SELECT category_channel_id FROM {_TEAM_TABLE_NAME} WHERE id=:id )', {
+                'id': team_id})
+        _execute(
+            f'DELETE FROM {_TEAM_DEADLINE_TABLE_NAME} WHERE team_id=:id', {'id': team_id})
+        _execute(
+            f'DELETE FROM {_TEAM_TABLE_NAME} WHERE id=:id', {'id': team_id})
+    _team_role_cache.pop(team_id)
+
+
+def remove_team_deadlines(team_ids: list):
+    """Drop the team formation deadline records for teams, in a single
+    transaction.
+
+    Args:
+        team_ids ([int]): IDs of the team records
+    """
+
+    with _transaction():
+        _executemany(
+            f'DELETE FROM {_TEAM_DEADLINE_TABLE_NAME} WHERE team_id=:team_id',
+            ({'team_id': team_id} for team_id in team_ids))
+
+
+def get_team_deadlines() -> list:
+    """Get every pending team formation deadline.
+
+    Returns:
+        [tuple[int, float]]: (team ID, deadline) for each pending deadline
+    """
+
+    return _execute(
+        f'SELECT team_id, deadline FROM {_TEAM_DEADLINE_TABLE_NAME}').fetchall()
+
+
+def reserve_team_category(capacity: int) -> int:
+    """Reserve a channel slot in a team category channel that has space.
+
+    The fullest category with space is chosen, so that categories fill up
+    before new ones are needed. The slot is freed when the team using it is
+    dropped, or by release_team_category() if the team is never created.
+
+    Args:
+        capacity (int): Maximum number of team channels in a category
+
+    Returns:
+        int: The ID of the category channel, or None if every category is full
+    """
+
+    with _transaction():
+        row = _execute(
+            f'SELECT category_channel_id FROM {_TEAM_CATEGORY_TABLE_NAME} WHERE channel_count < :capacity ORDER BY channel_count DESC LIMIT 1', {
+                'capacity': capacity}).fetchone()
+        if row is None:
+            return None
+        _execute(
+            f'UPDATE {_TEAM_CATEGORY_TABLE_NAME} SET channel_count=channel_count + 1 WHERE category_channel_id=:category_channel_id', {
+                'category_channel_id': row[0]})
+    return row[0]
+
+
+def release_team_category(category_channel_id: int):
+    """Free a channel slot reserved by reserve_team_category() or
+    add_team_category() that ended up unused.
+
+    Args:
+        category_channel_id (int): The ID of the category channel
+    """
+
+    _execute(
+        f'UPDATE {_TEAM_CATEGORY_TABLE_NAME} SET channel_count=channel_count - 1 WHERE category_channel_id=:category_channel_id', {
+            'category_channel_id': category_channel_id})
+
+
+def add_team_category(category_channel_id: int):
+    """Add a record for a new team category channel, with one channel slot
+    reserved for the team it was created for.
+
+    Args:
+        category_channel_id (int): The ID of the category channel
+    """
+
+    _execute(
+        f'INSERT INTO {_TEAM_CATEGORY_TABLE_NAME} ( category_channel_id, channel_count ) VALUES ( :category_channel_id, 1 )', {
+            'category_channel_id': category_channel_id})
+
+
+def remove_team_category(category_channel_id: int, only_if_empty: bool = False) -> bool:
+    """Drop the record for a team category channel, e.g. one that no longer
+    exists in the Discord server.
+
+    Args:
+        category_channel_id (int): The ID of the category channel
+        only_if_empty (bool): Keep the record if any of the category's channel
+            slots is in use or reserved
+
+    Returns:
+        bool: If the record was dropped
+    """
+
+    return _execute(
+        f'DELETE FROM {_TEAM_CATEGORY_TABLE_NAME} WHERE category_channel_id=:category_channel_id{" AND channel_count=0" if only_if_empty else ""}', {
+            'category_channel_id': category_channel_id}).rowcount == 1
+
+
+def get_team_category_count() -> int:
+    """Get the number of team category channel records.
+
+    Returns:
+        int: The number of team category channels
+    """
+
+    return _execute(
+        f'SELECT COUNT(*) FROM {_TEAM_CATEGORY_TABLE_NAME}').fetchone()[0]
+
+
+def get_team_categories() -> list:
+    """Get every team category channel record.
+
+    Returns:
+        [tuple[int, int]]: (category channel ID, number of team channels) for
+            each team category channel
+    """
+
+    return _execute(
+        f'SELECT category_channel_id, channel_count FROM {_TEAM_CATEGORY_TABLE_NAME}').fetchall()
+
+
+def recount_team_categories():
+    """Reset the number of team channels recorded for each team category
+    channel to the number of team records in it.
+
+    Slots reserved by reserve_team_category() for teams that are still being
+    created are dropped too, so this is only safe while no team is being
+    created.
+    """
+
+    with _transaction():
+        # Counted in one pass over the teams, rather than one per category
+        counts = dict(_execute(
+            f'SELECT category_channel_id, COUNT(*) FROM {_TEAM_TABLE_NAME} GROUP BY category_channel_id').fetchall())
+        category_channel_ids = [row[0] for row in _execute(
+            f'SELECT category_channel_id FROM {_TEAM_CATEGORY_TABLE_NAME}').fetchall()]
+        _executemany(
+            f'UPDATE {_TEAM_CATEGORY_TABLE_NAME} SET channel_count=:channel_count WHERE category_channel_id=:category_channel_id',
+            ({'category_channel_id': category_channel_id, 'channel_count': counts.get(category_channel_id, 0)}
+             for category_channel_id in category_channel_ids))
 
 
 def is_team_name_used(name: str) -> bool:
@@ -281,7 +898,7 @@ def is_team_name_used(name: str) -> bool:
         bool: If there exists a team record with the given name
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT COUNT(*) FROM {_TEAM_TABLE_NAME} WHERE name=:name', {
             'name': name}).fetchone()[0] > 0
 
@@ -298,9 +915,7 @@ def is_participant_in_team(discord_id: int) -> bool:
         bool: If the participant is in a team
     """
 
-    return _cursor.execute(
-        f'SELECT team_id FROM {_PARTICIPANT_TABLE_NAME} WHERE discord_id=:discord_id', {
-            'discord_id': discord_id}).fetchone()[0] is not None
+    return _get_participant_team_id(discord_id) not in (None, _NOT_VERIFIED)
 
 
 def get_team_id(discord_id: int) -> int:
@@ -316,9 +931,16 @@ def get_team_id(discord_id: int) -> int:
         int: The ID of the participant's team
     """
 
-    return _cursor.execute(
-        f'SELECT team_id FROM {_PARTICIPANT_TABLE_NAME} WHERE discord_id=:discord_id', {
-            'discord_id': discord_id}).fetchone()[0]
+    team_id = _get_participant_team_id(discord_id)
+    return None if team_id is _NOT_VERIFIED else team_id
+
+
+def _update_participant_cache(discord_id: int, team_id: int, updated: int):
+    # Only a participant whose record was updated is known to be verified
+    if updated == 1:
+        _participant_cache.set(discord_id, team_id)
+    else:
+        _participant_cache.pop(discord_id)
 
 
 def add_to_team(discord_id: int, team_id: int):
@@ -332,23 +954,39 @@ def add_to_team(discord_id: int, team_id: int):
         team_id (int): ID of the team record
     """
 
-    _cursor.execute(
+    updated = _execute(
         f'UPDATE {_PARTICIPANT_TABLE_NAME} SET team_id=:team_id WHERE discord_id=:discord_id', {
-            'discord_id': discord_id, 'team_id': team_id})
+            'discord_id': discord_id, 'team_id': team_id}).rowcount
+    _update_participant_cache(discord_id, team_id, updated)
 
 
-def remove_from_team(discord_id: int):
+def remove_from_team(discord_id: int) -> int:
     """Remove a participant from their team.
 
     Requires that discord_id is the Discord ID of a verified participant record.
 
     Args:
         discord_id (int): Discord ID of the participant
+
+    Returns:
+        int: The number of members left in the team, counted in the same
+            transaction, or None if the participant was not in a team
     """
 
-    _cursor.execute(
-        f'UPDATE {_PARTICIPANT_TABLE_NAME} SET team_id=NULL WHERE discord_id=:discord_id', {
-            'discord_id': discord_id})
+    remaining = None
+    with _transaction():
+        row = _execute(
+            f'SELECT team_id FROM {_PARTICIPANT_TABLE_NAME} WHERE discord_id=:discord_id', {
+                'discord_id': discord_id}).fetchone()
+        updated = _execute(
+            f'UPDATE {_PARTICIPANT_TABLE_NAME} SET team_id=NULL WHERE discord_id=:discord_id', {
+                'discord_id': discord_id}).rowcount
+        if row is not None and row[0] is not None:
+            remaining = _execute(
+                f'SELECT COUNT(*) FROM {_PARTICIPANT_TABLE_NAME} WHERE team_id=:team_id', {
+                    'team_id': row[0]}).fetchone()[0]
+    _update_participant_cache(discord_id, None, updated)
+    return remaining
 
 
 def get_team_size(team_id: int) -> int:
@@ -360,7 +998,7 @@ def get_team_size(team_id: int) -> int:
         team_id (int): ID of the team record
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT COUNT(*) FROM {_PARTICIPANT_TABLE_NAME} WHERE team_id=:team_id', {
             'team_id': team_id}).fetchone()[0]
 
@@ -377,7 +1015,7 @@ def get_team_name(team_id: int) -> str:
         str: Name of the team
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT name FROM {_TEAM_TABLE_NAME} WHERE id=:team_id', {
             'team_id': team_id}).fetchone()[0]
 
@@ -394,9 +1032,13 @@ def get_team_role_id(team_id: int) -> int:
         int: ID of the team role
     """
 
-    return _cursor.execute(
-        f'SELECT role_id FROM {_TEAM_TABLE_NAME} WHERE id=:team_id', {
-            'team_id': team_id}).fetchone()[0]
+    role_id = _team_role_cache.get(team_id)
+    if role_id is _MISSING:
+        role_id = _execute(
+            f'SELECT role_id FROM {_TEAM_TABLE_NAME} WHERE id=:team_id', {
+                'team_id': team_id}).fetchone()[0]
+        _team_role_cache.set(team_id, role_id)
+    return role_id
 
 
 def get_team_category_channel_id(team_id: int) -> int:
@@ -411,7 +1053,7 @@ def get_team_category_channel_id(team_id: int) -> int:
         int: ID of the team category channel
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT category_channel_id FROM {_TEAM_TABLE_NAME} WHERE id=:team_id', {
             'team_id': team_id}).fetchone()[0]
 
@@ -428,7 +1070,7 @@ def get_team_text_channel_id(team_id: int) -> int:
         int: ID of the team text channel
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT text_channel_id FROM {_TEAM_TABLE_NAME} WHERE id=:team_id', {
             'team_id': team_id}).fetchone()[0]
 
@@ -445,7 +1087,7 @@ def get_team_text_channel_id(team_id: int) -> int:
 #         int: ID of the team voice channel
 #     """
 
-#     return _cursor.execute(
+#     return _execute(
 #         f'SELECT voice_channel_id FROM {_TEAM_TABLE_NAME} WHERE id=:team_id', {
 #             'team_id': team_id}).fetchone()[0]
 
@@ -460,7 +1102,7 @@ def team_exists(team_id: int) -> bool:
         bool: If there exists a team with ID team_id
     """
 
-    return _cursor.execute(
+    return _execute(
         f'SELECT COUNT(*) FROM {_TEAM_TABLE_NAME} WHERE id=:team_id', {
             'team_id': team_id}).fetchone()[0] > 0
 
@@ -478,12 +1120,633 @@ def get_team_members(team_id):
         [int]: List of participant IDs
     """
 
-    return _cursor.execute(f'SELECT discord_id FROM {_PARTICIPANT_TABLE_NAME} WHERE team_id=:team_id', {'team_id': team_id}).fetchall()
+    return _execute(f'SELECT discord_id FROM {_PARTICIPANT_TABLE_NAME} WHERE team_id=:team_id', {'team_id': team_id}).fetchall()
+
+
+def get_team(team_id: int) -> Team:
+    """Get a snapshot of a team and its members in a single query.
+
+    Args:
+        team_id (int): ID of the team record
+
+    Returns:
+        Team: The team, or None if there is no team record with ID team_id
+    """
+
+    return _team_from_rows(_execute(
+        f'SELECT t.id, t.name, t.category_channel_id, t.text_channel_id, t.role_id, p.discord_id FROM {_TEAM_TABLE_NAME} t LEFT JOIN {_PARTICIPANT_TABLE_NAME} p ON p.team_id = :team_id WHERE t.id=:team_id', {
+            'team_id': team_id}).fetchall())
+
+
+def get_team_for_member(discord_id: int) -> Team:
+    """Get a snapshot of a participant's team and its members in a single
+    query.
+
+    Args:
+        discord_id (int): Discord ID of the participant
+
+    Returns:
+        Team: The participant's team, or None if the Discord user is not a
+            verified participant in a team
+    """
+
+    return _team_from_rows(_execute(
+        f'SELECT t.id, t.name, t.category_channel_id, t.text_channel_id, t.role_id, p.discord_id FROM {_PARTICIPANT_TABLE_NAME} m JOIN {_TEAM_TABLE_NAME} t ON t.id = m.team_id LEFT JOIN {_PARTICIPANT_TABLE_NAME} p ON p.team_id = m.team_id WHERE m.discord_id=:discord_id', {
+            'discord_id': discord_id}).fetchall())
+
+
+def iter_team_members() -> iter:
+    """Stream every team with its members, in order of team ID, from a single
+    query.
+
+    Rows are read from the database as they are consumed, so memory use does
+    not grow with the number of teams. Teams without members yield a single
+    row with None member fields.
+
+    Yields:
+        tuple[int, str, int, int, str]: (team ID, team name, team role ID,
+            member Discord ID, member email) for each member of each team
+    """
+
+    # A separate cursor, so other queries can run while this one is consumed.
+    # +t.id drops the column's INTEGER affinity so that the comparison with
+    # the untyped participants.team_id can use its index.
+    if _connection is None:
+        connect()
+    cursor = _connection.execute(
+        f'SELECT t.id, t.name, t.role_id, p.discord_id, p.email FROM {_TEAM_TABLE_NAME} t LEFT JOIN {_PARTICIPANT_TABLE_NAME} p ON p.team_id = +t.id ORDER BY t.id, p.discord_id')
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def get_teams(team_ids: list) -> list:
+    """Get snapshots of several teams and their members in a single query.
+
+    Args:
+        team_ids ([int]): IDs of the team records
+
+    Returns:
+        [Team]: The teams that exist, in order of team ID
+    """
+
+    team_ids = list(team_ids)
+    if not team_ids:
+        return []
+
+    placeholders = ', '.join('?' * len(team_ids))
+    rows = _execute(
+        f'SELECT t.id, t.name, t.category_channel_id, t.text_channel_id, t.role_id, p.discord_id FROM {_TEAM_TABLE_NAME} t LEFT JOIN {_PARTICIPANT_TABLE_NAME} p ON p.team_id = +t.id WHERE t.id IN ( {placeholders} ) ORDER BY t.id',
+        team_ids).fetchall()
+    return [_team_from_rows(list(team_rows))
+            for _, team_rows in itertools.groupby(rows, key=lambda row: row[0])]
+
+
+def get_all_teams() -> list:
+    """Get snapshots of every team and its members in a single query.
+
+    Returns:
+        [Team]: Every team, in order of team ID
+    """
+
+    rows = _execute(
+        f'SELECT t.id, t.name, t.category_channel_id, t.text_channel_id, t.role_id, p.discord_id FROM {_TEAM_TABLE_NAME} t LEFT JOIN {_PARTICIPANT_TABLE_NAME} p ON p.team_id = +t.id ORDER BY t.id').fetchall()
+    return [_team_from_rows(list(team_rows))
+            for _, team_rows in itertools.groupby(rows, key=lambda row: row[0])]
+
+
+def _team_from_rows(rows: list) -> Team:
+    # Rows of (team columns..., member discord_id), one per member, or a
+    # single row with a NULL member for a team without members. The member
+    # joins compare against participants.team_id values or parameters rather
+    # than teams.id, since participants.team_id has no type affinity and a
+    # comparison with the INTEGER column would rule out its index.
+    if not rows:
+        return None
+
+    team = Team(*rows[0][:5], [row[5] for row in rows if row[5] is not None])
+    _team_role_cache.set(team.id, team.role_id)
+    for member_id in team.member_ids:
+        _participant_cache.set(member_id, team.id)
+    return team
+
+
+def _get_participant_team_id(discord_id: int):
+    # The team ID of a verified participant (None when not in a team), or
+    # _NOT_VERIFIED, served from the cache when possible
+    team_id = _participant_cache.get(discord_id)
+    if team_id is _MISSING:
+        row = _execute(
+            f'SELECT team_id FROM {_PARTICIPANT_TABLE_NAME} WHERE discord_id=:discord_id', {
+                'discord_id': discord_id}).fetchone()
+        team_id = _NOT_VERIFIED if row is None else row[0]
+        _participant_cache.set(discord_id, team_id)
+    return team_id
+
+
+def cache_stats() -> dict:
+    """Get hit, miss, and size counters for the participant and team role
+    caches.
+
+    Returns:
+        dict: Counters for each cache, keyed by cache name
+    """
+
+    return {'participants': _participant_cache.stats(),
+            'team_roles': _team_role_cache.stats()}
+
+
+class _Tracer:
+    """Aggregated statement and function statistics, and the slow query log,
+    while tracing is enabled."""
+
+    def __init__(self, slow_query_threshold: float, log):
+        self.slow_query_threshold = slow_query_threshold
+        self.log = log
+        # Per statement template: [count, total seconds, max seconds]
+        self.statements = {}
+        # Per public function: [calls, total seconds, max seconds, statements]
+        self.functions = {}
+        # Statements run per calling command
+        self.commands = collections.Counter()
+        self.function = None
+        self.last_statement = None
+        self._lock = threading.Lock()
+
+    def trace(self, statement: str):
+        # The trace callback: every statement SQLite runs, with parameters
+        # expanded, including each execution of an executemany()
+        self.last_statement = statement
+        with self._lock:
+            self.commands[calling_command.get()] += 1
+
+    def record_statement(self, sql: str, duration: float):
+        with self._lock:
+            stats = self.statements.setdefault(sql, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        if duration >= self.slow_query_threshold:
+            self.log(f'SLOW QUERY: {duration * 1000:.1f}ms in {self.function} '
+                     f'(command {calling_command.get()}): {self.last_statement}')
+
+    def record_call(self, name: str, duration: float, statements: int):
+        with self._lock:
+            stats = self.functions.setdefault(name, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3] += statements
+
+
+def enable_tracing(slow_query_threshold: float = 100, log=print):
+    """Start tracing statements and public function calls.
+
+    Statement and call counts and times are aggregated for trace_stats(), and
+    statements slower than the threshold are logged with their parameters,
+    the records function that ran them and the calling command (see
+    calling_command). Tracing adds a little overhead to every statement, so it
+    is off unless enabled.
+
+    Args:
+        slow_query_threshold (float): Milliseconds above which a statement is
+            logged
+        log (Callable[[str], None]): Called with each slow query log line
+    """
+
+    global _tracer
+    _tracer = _Tracer(slow_query_threshold / 1000, log)
+    if _connection is not None:
+        _connection.set_trace_callback(_tracer.trace)
+
+
+def disable_tracing():
+    """Stop tracing and discard the collected statistics."""
+
+    global _tracer
+    _tracer = None
+    if _connection is not None:
+        _connection.set_trace_callback(None)
+
+
+def trace_stats() -> dict:
+    """Get the statistics collected since tracing was enabled.
+
+    Returns:
+        dict: 'statements' and 'functions', lists of dicts with count, total
+            and maximum milliseconds (and statements run, for functions),
+            slowest in total first, and 'commands', statements run per
+            calling command. Empty if tracing is not enabled.
+    """
+
+    tracer = _tracer
+    if tracer is None:
+        return {}
+
+    with tracer._lock:
+        statements = [{'sql': sql, 'count': count, 'total_ms': total * 1000, 'max_ms': maximum * 1000}
+                      for sql, (count, total, maximum) in tracer.statements.items()]
+        functions = [{'function': name, 'count': count, 'total_ms': total * 1000,
+                      'max_ms': maximum * 1000, 'statements': statement_count}
+                     for name, (count, total, maximum, statement_count) in tracer.functions.items()]
+        commands = dict(tracer.commands)
+    statements.sort(key=lambda stats: stats['total_ms'], reverse=True)
+    functions.sort(key=lambda stats: stats['total_ms'], reverse=True)
+    return {'statements': statements, 'functions': functions, 'commands': commands}
+
+
+def dump_trace_stats(file=None, limit: int = 20):
+    """Print the statistics collected since tracing was enabled.
+
+    Args:
+        file (TextIO): Where to print, stdout by default
+        limit (int): Number of statements and functions to print, slowest in
+            total first
+    """
+
+    file = sys.stdout if file is None else file
+    stats = trace_stats()
+    if not stats:
+        print('STATUS: Tracing is not enabled', file=file)
+        return
+
+    print(f'{"count":>8} {"total ms":>10} {"max ms":>8}  statement', file=file)
+    for statement in stats['statements'][:limit]:
+        print(f'{statement["count"]:>8} {statement["total_ms"]:>10.1f} '
+              f'{statement["max_ms"]:>8.1f}  {statement["sql"]}', file=file)
+    print(f'{"count":>8} {"total ms":>10} {"max ms":>8} {"queries":>8}  function', file=file)
+    for function in stats['functions'][:limit]:
+        print(f'{function["count"]:>8} {function["total_ms"]:>10.1f} {function["max_ms"]:>8.1f} '
+              f'{function["statements"]:>8}  {function["function"]}', file=file)
+    print(f'{"queries":>8}  command', file=file)
+    for command, count in sorted(stats['commands'].items(), key=lambda item: -item[1]):
+        print(f'{count:>8}  {command}', file=file)
+    file.flush()
+
+
+def connect(
+        database_file: str = _DATABASE_FILE,
+        journal_mode: str = 'WAL',
+        synchronous: str = 'NORMAL',
+        busy_timeout: int = 5000,
+        max_retries: int = 5,
+        cache_size: int = 10000,
+        backend: str = 'file'):
+    """Open the records database, creating and migrating it if needed.
+
+    Replaces any connection opened by a previous call. The bot and the web
+    server run in separate processes against the same database file, so WAL
+    journaling is the default: readers no longer block the writer, and
+    writers wait up to busy_timeout for each other before retrying.
+
+    With the "memory" backend, the database file is copied into memory and
+    only written back by snapshot() and close(). Nothing else may write to
+    the file meanwhile, since the next snapshot replaces it, so the web server
+    must run in the same process and scripts that write the records must not
+    run while it is open. The journal mode, synchronous level and busy
+    timeout then only apply to loading the file.
+
+    Args:
+        database_file (str): Path of the SQLite database file
+        journal_mode (str): SQLite journal mode, one of _JOURNAL_MODES
+        synchronous (str): SQLite synchronous level, one of _SYNCHRONOUS_LEVELS
+        busy_timeout (int): Milliseconds to wait on a locked database before
+            failing a statement
+        max_retries (int): Number of times a statement that failed on a
+            locked database is retried, with exponential backoff
+        cache_size (int): Maximum number of entries in each of the participant
+            and team role caches, 0 to disable caching
+        backend (str): Where queries run, one of _BACKENDS
+
+    Returns:
+        dict: Number of duplicate registration responses removed by upgrading
+            the database to unique responses, by registration role, empty
+            if it needed no such upgrade
+    """
+
+    global _connection, _cursor, _max_retries, _participant_cache, _team_role_cache, \
+        _snapshot_file, _snapshot_changes
+
+    journal_mode = journal_mode.upper()
+    synchronous = synchronous.upper()
+    if journal_mode not in _JOURNAL_MODES:
+        raise ValueError(f'Unknown journal mode "{journal_mode}"')
+    if synchronous not in _SYNCHRONOUS_LEVELS:
+        raise ValueError(f'Unknown synchronous level "{synchronous}"')
+    if backend not in _BACKENDS:
+        raise ValueError(f'Unknown backend "{backend}"')
+
+    close()
+
+    db_file_exists = os.path.isfile(database_file)
+    # check_same_thread is off so that async_records can hand the connection
+    # to its worker thread; callers must not use it from two threads at once
+    if backend == 'memory':
+        _connection = sqlite3.connect(
+            ':memory:', isolation_level=None, check_same_thread=False)
+        if db_file_exists:
+            _load_database_file(database_file, journal_mode, synchronous, busy_timeout)
+        _snapshot_file = database_file
+        # Migrations are not counted in total_changes, so the first snapshot
+        # is always written
+        _snapshot_changes = -1
+    else:
+        _connection = sqlite3.connect(
+            database_file,
+            isolation_level=None,
+            timeout=busy_timeout / 1000,
+            check_same_thread=False)
+    _connection.create_function(
+        'normalize_key', 1, normalize_key, deterministic=True)
+    _cursor = _connection.cursor()
+    if _tracer is not None:
+        _connection.set_trace_callback(_tracer.trace)
+    _max_retries = max_retries
+    _participant_cache = _LRUCache(cache_size)
+    _team_role_cache = _LRUCache(cache_size)
+
+    _execute(f'PRAGMA journal_mode = {journal_mode}')
+    _execute(f'PRAGMA synchronous = {synchronous}')
+
+    # The bot and the web server can connect to a new or outdated database at
+    # the same time, so the schema is checked and changed under the write
+    # lock, each process seeing the changes made by the ones before it
+    with _transaction():
+        if _cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name", {
+                    'name': _PARTICIPANT_REG_RESPONSES_TABLE_NAME}).fetchone() is None:
+            _initialize_db(_cursor)
+        removed = _migrate_db(_cursor)
+    if any(removed.values()):
+        print(f'STATUS: Removed {sum(removed.values())} duplicate registration responses '
+              f'({", ".join(f"{role}: {count}" for role, count in removed.items())})')
+    return removed
+
+
+def close():
+    """Close the records database, if open.
+
+    Processes that fork must close it first, since an SQLite connection
+    cannot be used from a child process. The next query opens it again with
+    the default settings, unless connect() is called first. An in-memory
+    database is written to its file first.
+    """
+
+    global _connection, _cursor, _snapshot_file
+
+    if _connection is not None:
+        snapshot()
+        _connection.close()
+    _connection = None
+    _cursor = None
+    _snapshot_file = None
+
+
+def connect_configured(settings) -> dict:
+    """Open the records database with the configured settings, and start
+    tracing if configured, with kill -USR1 <pid> printing the statistics
+    collected so far.
+
+    Args:
+        settings (module): The loaded config module, which records does not
+            import itself, so that the command line tools run without a
+            config.ini
+
+    Returns:
+        dict: As connect()
+    """
+
+    removed = connect(
+        settings.database_file,
+        settings.database_journal_mode,
+        settings.database_synchronous,
+        settings.database_busy_timeout,
+        settings.database_max_retries,
+        settings.database_cache_size,
+        settings.database_backend)
+    if settings.database_trace:
+        enable_tracing(settings.database_slow_query_ms)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, _dump_trace_stats_in_thread)
+    return removed
+
+
+def _dump_trace_stats_in_thread(signum, frame):
+    # Signal handlers run on the main thread between bytecodes, possibly while
+    # it holds the tracer's lock in the middle of a query, so the statistics
+    # are printed from another thread once the lock is released
+    threading.Thread(target=dump_trace_stats, daemon=True).start()
+
+
+def _load_database_file(database_file: str, journal_mode: str, synchronous: str, busy_timeout: int):
+    # Copies the database file into the in-memory connection. The file is
+    # switched out of WAL journaling, since snapshots replace it and a
+    # write-ahead log left beside it would be applied to the new file.
+    disk_connection = sqlite3.connect(
+        database_file, isolation_level=None, timeout=busy_timeout / 1000)
+    try:
+        disk_connection.execute(f'PRAGMA synchronous = {synchronous}')
+        disk_connection.execute(
+            f'PRAGMA journal_mode = {"DELETE" if journal_mode == "WAL" else journal_mode}')
+        disk_connection.backup(_connection)
+    finally:
+        disk_connection.close()
+
+
+def take_snapshot() -> sqlite3.Connection:
+    """Copy the in-memory database, for write_snapshot() to persist.
+
+    The copy is made in memory, so it is quick and touches no disk, but it
+    uses the records connection: call it on the records worker thread from
+    an event loop, and leave write_snapshot() to another thread.
+
+    Returns:
+        sqlite3.Connection: An in-memory copy of the database, or None with
+            the "file" backend or if nothing changed since the last snapshot
+    """
+
+    global _snapshot_changes
+
+    if _snapshot_file is None or _connection.total_changes == _snapshot_changes:
+        return None
+    copy = sqlite3.connect(':memory:', check_same_thread=False)
+    _connection.backup(copy)
+    _snapshot_changes = _connection.total_changes
+    return copy
 
 
-_db_file_exists = os.path.isfile(_DATABASE_FILE)
-_connection = sqlite3.connect(_DATABASE_FILE, isolation_level=None)
-_cursor = _connection.cursor()
+def write_snapshot(copy: sqlite3.Connection):
+    """Write a copy made by take_snapshot() to the database file, replacing
+    it atomically, and close the copy.
+
+    Does not use the records connection, so can run on any thread.
+
+    Args:
+        copy (sqlite3.Connection): The copy
+    """
+
+    global _snapshot_changes
+
+    database_file = _snapshot_file
+    try:
+        with _snapshot_lock:
+            temporary_file = f'{database_file}.tmp'
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+            # Written with a rollback journal and synchronous=FULL, so the
+            # file is on disk before it replaces the previous snapshot
+            disk_connection = sqlite3.connect(temporary_file)
+            try:
+                copy.backup(disk_connection)
+            finally:
+                disk_connection.close()
+            os.replace(temporary_file, database_file)
+    except BaseException:
+        # Written again by the next snapshot, even if nothing changes
+        _snapshot_changes = -1
+        raise
+    finally:
+        copy.close()
+
+
+def snapshot() -> bool:
+    """Write the in-memory database to its file, if it changed since the
+    last snapshot.
+
+    Returns:
+        bool: If a snapshot was written, False with the "file" backend
+    """
 
-if not _db_file_exists:
-    _initialize_db(_cursor)
+    copy = take_snapshot()
+    if copy is None:
+        return False
+    write_snapshot(copy)
+    return True
+
+
+def _execute(sql: str, parameters={}) -> sqlite3.Cursor:
+    # busy_timeout covers most contention between the bot and web processes,
+    # but SQLite can still give up early (e.g. on a WAL checkpoint or a
+    # long-running writer), so locked statements are retried with backoff
+    global _query_count
+    if _connection is None:
+        connect()
+    _query_count += 1
+    attempt = 0
+    while True:
+        try:
+            if _tracer is None:
+                return _cursor.execute(sql, parameters)
+            start_time = time.perf_counter()
+            cursor = _cursor.execute(sql, parameters)
+            _tracer.record_statement(sql, time.perf_counter() - start_time)
+            return cursor
+        except sqlite3.OperationalError as error:
+            if attempt >= _max_retries or not _is_locked_error(error):
+                raise
+            time.sleep(_RETRY_BACKOFF * 2 ** attempt *
+                       random.uniform(0.5, 1.5))
+            attempt += 1
+
+
+def _executemany(sql: str, parameters) -> sqlite3.Cursor:
+    # _execute() for a statement run once per set of parameters, each run
+    # counted as a query. Only used within _transaction(), which holds the
+    # write lock already, so there is nothing to retry, and the parameters
+    # are streamed rather than read up front.
+    def counted(parameters):
+        global _query_count
+        for row in parameters:
+            _query_count += 1
+            yield row
+
+    if _tracer is None:
+        return _cursor.executemany(sql, counted(parameters))
+    start_time = time.perf_counter()
+    cursor = _cursor.executemany(sql, counted(parameters))
+    _tracer.record_statement(sql, time.perf_counter() - start_time)
+    return cursor
+
+
+@contextlib.contextmanager
+def _transaction():
+    # The connection is in autocommit mode, so multi-statement writes are
+    # grouped explicitly. BEGIN IMMEDIATE takes the write lock up front (with
+    # the usual retries), so the statements inside cannot fail on a lock
+    # upgrade halfway through.
+    _execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        _cursor.execute('ROLLBACK')
+        raise
+    _cursor.execute('COMMIT')
+
+
+def _is_locked_error(error: sqlite3.OperationalError) -> bool:
+    message = str(error)
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def _timed(function):
+    # Records the duration and number of statements of each call in the
+    # metrics, and in the trace statistics when tracing. Calls into other
+    # public functions are counted in both.
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        tracer = _tracer
+        if tracer is not None:
+            calling_function = tracer.function
+            tracer.function = name
+        query_count = _query_count
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start_time
+            _CALL_DURATION.observe(duration, name)
+            _QUERIES.inc(name, amount=_query_count - query_count)
+            if tracer is not None:
+                tracer.record_call(name, duration, _query_count - query_count)
+                tracer.function = calling_function
+    return wrapper
+
+
+_connection = None
+_cursor = None
+_max_retries = 0
+# Database file of the "memory" backend, None with the "file" backend
+_snapshot_file = None
+# Connection.total_changes at the last snapshot
+_snapshot_changes = -1
+# Snapshots from different threads must not write the file at once
+_snapshot_lock = threading.Lock()
+# Statements run through _execute(), for the metrics
+_query_count = 0
+_tracer = None
+
+# Write-through caches of verification and team state, kept in step with
+# every write made through this module. Only the bot process writes the
+# participant and team tables, so its caches never go stale.
+_participant_cache = _LRUCache(0)
+_team_role_cache = _LRUCache(0)
+
+# Public functions that do not query the database
+_UNTIMED = {'connect', 'connect_configured', 'close', 'normalize_key',
+            'take_snapshot', 'write_snapshot', 'snapshot', 'enable_tracing',
+            'disable_tracing', 'trace_stats', 'dump_trace_stats'}
+
+# Every public function that queries the database is timed. Generators are
+# left out, since their work happens after the call returns.
+for _name, _function in list(globals().items()):
+    if not _name.startswith('_') and _name not in _UNTIMED \
+            and inspect.isfunction(_function) and _function.__module__ == __name__ \
+            and not inspect.isgeneratorfunction(_function):
+        globals()[_name] = _timed(_function)
+
+# The database is opened on first use, with the default settings, unless
+# connect() is called first. Importing this module stays cheap for scripts
+# and processes that never query it.
@@ -0,0 +1,240 @@
+"""An in-memory index of registration responses by Discord username, email,
+and trigrams of both.
+
+Lets the bot match a member who joins the server against the registrations,
+and find the registrations closest to details that did not match (typically a
+typo in the email or username), without a database query. The index is loaded
+once at startup, then kept current by asking the database only for the entries
+added since it last looked: every poll interval, or right away when
+request_refresh() is called after a push in the same process (aioweb in "bot"
+web mode). The index is only read and changed on the event loop.
+"""
+
+import asyncio
+import collections
+import time
+import traceback
+import async_records
+import records
+
+# Trigrams found in more entries than this (e.g. those of "gmail.com") say
+# little about which entry is meant, and are skipped when looking for
+# candidates once rarer trigrams have been counted
+_COMMON_TRIGRAM_ENTRIES = 500
+
+# Number of entries with the most trigrams in common that are scored exactly
+_CANDIDATES = 20
+
+# Entries fetched and added at a time when refreshing, so that adding a page
+# only holds up the event loop briefly
+_PAGE_SIZE = 500
+
+# Set to wake every running index for a refresh
+_refresh_requested = asyncio.Event()
+
+
+def request_refresh():
+    """Have every running RegistrationIndex pick up new entries now, rather
+    than at its next poll."""
+
+    _refresh_requested.set()
+
+
+def _trigrams(text: str) -> set:
+    # Padded, so that short strings and the start of a string count too
+    text = f'  {text} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _similarity(a: set, b: set) -> float:
+    # Dice coefficient of two trigram sets
+    if not a and not b:
+        return 1.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class Match:
+    """A registration close to given details."""
+
+    __slots__ = ('role', 'email', 'discord_username', 'email_similarity',
+                 'discord_username_similarity')
+
+    def __init__(
+            self,
+            role: str,
+            email: str,
+            discord_username: str,
+            email_similarity: float,
+            discord_username_similarity: float):
+        """
+        Args:
+            role (str): Registration role
+            email (str): Registered email address
+            discord_username (str): Registered Discord username, normalized
+            email_similarity (float): Similarity of the email address, from 0
+                to 1, or None if no email address was looked for
+            discord_username_similarity (float): Similarity of the Discord
+                username, from 0 to 1, or None if no username was looked for
+        """
+
+        self.role = role
+        self.email = email
+        self.discord_username = discord_username
+        self.email_similarity = email_similarity
+        self.discord_username_similarity = discord_username_similarity
+
+    @property
+    def similarity(self) -> float:
+        """float: Similarity of the details looked for, from 0 to 1"""
+
+        similarities = [similarity for similarity in (self.email_similarity, self.discord_username_similarity)
+                        if similarity is not None]
+        return sum(similarities) / len(similarities)
+
+    def __repr__(self) -> str:
+        return (f'Match(role={self.role!r}, email={self.email!r}, '
+                f'discord_username={self.discord_username!r}, similarity={self.similarity:.2f})')
+
+
+class RegistrationIndex:
+    """Registration response entries keyed by normalized Discord username,
+    with trigram postings of usernames and emails for approximate matching."""
+
+    def __init__(self, roles=records.REGISTRATION_ROLES):
+        """
+        Args:
+            roles ([str]): Registration roles to index
+        """
+
+        self._roles = tuple(roles)
+        # (role, email, normalized username) for each entry, by entry number
+        self._entries = []
+        # Normalized username to {(role, email)}
+        self._by_username = {}
+        # Trigram to [entry number], for emails and usernames
+        self._email_postings = collections.defaultdict(list)
+        self._username_postings = collections.defaultdict(list)
+        self._last_rowids = dict.fromkeys(self._roles, 0)
+        self._refresh_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _add(self, role: str, email: str, discord_username_key: str):
+        entry = len(self._entries)
+        email_key = records.normalize_key(email)
+        self._entries.append((role, email, discord_username_key))
+        self._by_username.setdefault(discord_username_key, set()).add((role, email))
+        for trigram in _trigrams(email_key):
+            self._email_postings[trigram].append(entry)
+        for trigram in _trigrams(discord_username_key):
+            self._username_postings[trigram].append(entry)
+
+    def lookup(self, discord_username: str) -> set:
+        """Get the registrations made with a Discord username.
+
+        Args:
+            discord_username (str): The Discord username
+
+        Returns:
+            {tuple[str, str]}: (role, email) for each registration
+        """
+
+        return set(self._by_username.get(records.normalize_key(discord_username), ()))
+
+    def closest(
+            self,
+            email: str,
+            discord_username: str,
+            role: str = None,
+            limit: int = 3,
+            min_similarity: float = 0.5,
+            budget: float = 0.001) -> list:
+        """Find the registrations closest to an email address and Discord
+        username, e.g. ones that did not match any registration exactly.
+
+        Candidates are the entries sharing the most trigrams with the email
+        or the username, rarest trigrams first. Counting stops once the time
+        budget is spent, so a lookup stays fast on large indexes at the cost
+        of possibly missing a match.
+
+        Args:
+            email (str): The email address, or None to match the username only
+            discord_username (str): The Discord username, or None to match the
+                email address only
+            role (str): Only match registrations for this role
+            limit (int): Maximum number of matches
+            min_similarity (float): Minimum Match.similarity of a match
+            budget (float): Seconds to spend looking for candidates
+
+        Returns:
+            [Match]: The closest registrations, most similar first
+        """
+
+        deadline = time.perf_counter() + budget
+        email_trigrams = None if email is None else _trigrams(records.normalize_key(email))
+        username_trigrams = None if discord_username is None else _trigrams(records.normalize_key(discord_username))
+
+        postings = [self._email_postings.get(trigram, ()) for trigram in email_trigrams or ()]
+        postings += [self._username_postings.get(trigram, ()) for trigram in username_trigrams or ()]
+        postings.sort(key=len)
+        counts = collections.Counter()
+        for entries in postings:
+            if counts and (len(entries) > _COMMON_TRIGRAM_ENTRIES or time.perf_counter() > deadline):
+                break
+            counts.update(entries)
+
+        matches = []
+        for entry, _ in counts.most_common(_CANDIDATES):
+            entry_role, entry_email, entry_username = self._entries[entry]
+            if role is not None and entry_role != role:
+                continue
+            match = Match(
+                entry_role, entry_email, entry_username,
+                None if email_trigrams is None else
+                _similarity(email_trigrams, _trigrams(records.normalize_key(entry_email))),
+                None if username_trigrams is None else
+                _similarity(username_trigrams, _trigrams(entry_username)))
+            if match.similarity >= min_similarity:
+                matches.append(match)
+        matches.sort(key=lambda match: match.similarity, reverse=True)
+        return matches[:limit]
+
+    async def refresh(self):
+        """Add the entries recorded since the last refresh.
+
+        Only the queries run on the records worker thread. The entries are
+        added on the event loop, a page at a time, so lookups never see the
+        index while it changes.
+        """
+
+        # Concurrent refreshes would add the same entries twice
+        async with self._refresh_lock:
+            for role in self._roles:
+                while True:
+                    rows = await async_records.get_response_entries_since(
+                        role, self._last_rowids[role], _PAGE_SIZE)
+                    if not rows:
+                        break
+                    for rowid, email, discord_username_key in rows:
+                        self._add(role, email, discord_username_key)
+                    self._last_rowids[role] = rows[-1][0]
+
+    async def run(self, poll_interval: float):
+        """Refresh the index until cancelled.
+
+        Args:
+            poll_interval (float): Seconds between refreshes when none is
+                requested
+        """
+
+        while True:
+            try:
+                await asyncio.wait_for(_refresh_requested.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            _refresh_requested.clear()
+            try:
+                await self.refresh()
+            except Exception:
+                traceback.print_exc()
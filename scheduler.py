@@ -0,0 +1,103 @@
+"""A deadline scheduler driven by a single timer task."""
+
+import asyncio
+import heapq
+import time
+import traceback
+
+
+class DeadlineScheduler:
+    """Calls a coroutine function with batches of keys whose deadlines have
+    passed.
+
+    Deadlines are Unix timestamps, so that deadlines stored before a restart
+    can be scheduled again afterwards; any already past are handled as soon as
+    the scheduler runs. All deadlines share one timer task and a heap, rather
+    than one sleeping coroutine each.
+    """
+
+    def __init__(self, callback, batch_size: int = 50):
+        """
+        Args:
+            callback (Callable[[list], Awaitable]): Called with a list of keys
+                whose deadlines have passed
+            batch_size (int): Maximum number of keys passed to each call
+        """
+
+        self._callback = callback
+        self._batch_size = batch_size
+        self._heap = []
+        self._deadlines = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        """int: The number of scheduled deadlines that have not been handled"""
+
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline: float):
+        """Schedule a deadline, replacing any deadline already scheduled for
+        the key.
+
+        Args:
+            key (Hashable): The key passed to the callback
+            deadline (float): Unix timestamp of the deadline
+        """
+
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if self._heap[0] == (deadline, key):
+            self._wakeup.set()
+
+    def cancel(self, key):
+        """Cancel the deadline scheduled for a key, if any.
+
+        Args:
+            key (Hashable): The key
+        """
+
+        # Heap entries are discarded lazily, when they reach the top
+        self._deadlines.pop(key, None)
+
+    def start(self):
+        """Start the timer task on the running event loop, if it is not
+        already running."""
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _discard_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    async def _run(self):
+        while True:
+            self._discard_stale()
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self._batch_size:
+                deadline, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    batch.append(key)
+
+            if batch:
+                try:
+                    await self._callback(batch)
+                except Exception:
+                    traceback.print_exc()
@@ -1,9 +1,56 @@
+import argparse
 import multiprocessing
-import discord
-import web
+import config
+
+
+'''
+Start the bot, the web server, or both.
+
+Each component imports its dependencies (nextcord, or Flask and eventlet) in
+the process that runs it, so neither pays for the other's.
+
+Example:
+    python start.py
+    python start.py bot
+    python start.py web
+'''
+
+
+def _start_bot():
+    import discord
+    discord.start()
+
+
+def _start_web():
+    import web
+    web.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Start the bot, the web server, or both.')
+    parser.add_argument('component', nargs='?', choices=('all', 'bot', 'web'), default='all',
+                        help='What to start (default: all, the web server only in "process" web mode)')
+    args = parser.parse_args()
+
+    # Fail on a bad config before starting anything
+    config.load()
+
+    if args.component == 'bot':
+        _start_bot()
+    elif args.component == 'web':
+        if config.web_mode != 'process':
+            print('ERROR: The web server is served by the bot in "bot" web mode')
+            exit(1)
+        _start_web()
+    else:
+        discord_process = multiprocessing.Process(target=_start_bot)
+        discord_process.start()
+        # In "bot" mode the push API is served from the bot process instead
+        if config.web_mode == 'process':
+            web_process = multiprocessing.Process(target=_start_web)
+            web_process.start()
+
 
 if __name__ == "__main__":
-    discord_process = multiprocessing.Process(target=discord.start)
-    web_process = multiprocessing.Process(target=web.start)
-    discord_process.start()
-    web_process.start()
+    main()
@@ -1,19 +1,92 @@
-from flask import Flask, abort, jsonify, request
-from eventlet import wsgi
+from flask import Flask, Response, abort, jsonify, request
+from eventlet import greenio, wsgi
 import eventlet
+import functools
+import os
+import signal
+import socket
+import time
+import traceback
 import config
+import idempotency
+import ingest
+import metrics
 import records
+import writebehind
 
 _app = Flask(__name__)
 
+_ADD_RESPONSE_ENTRY = {
+    'participant': records.add_participant_response_entry,
+    'mentor': records.add_mentor_response_entry,
+    'judge': records.add_judge_response_entry,
+}
+
+# Log that single pushes are acknowledged from, with write-behind
+_write_behind = None
+
+# Number of this worker process when served by workers, which each write a
+# snapshot of their metrics for the others to serve
+_worker_index = None
+
+# Workers that exit within this many seconds of starting (e.g. failing on
+# startup) are restarted after the same delay, rather than right away
+_MIN_WORKER_UPTIME = 1
+
+# Seconds between checks of a worker for a shutdown request
+_WORKER_POLL_INTERVAL = 0.2
+
+_SUPERVISOR_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+
+def _idempotent(view):
+    # Replays the recorded response to a repeated Idempotency-Key (see
+    # idempotency.py)
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if request.headers.get('api-key') != config.web_api_key:
+            abort(403)
+        try:
+            idempotency.check_key(key)
+        except ValueError as error:
+            abort(400, description=str(error))
+
+        request_description = idempotency.describe_request(request.method, request.path)
+        recorded = records.get_idempotent_response(key, config.web_idempotency_key_ttl)
+        if recorded is not None:
+            try:
+                body = idempotency.replayed_response(recorded, request_description)
+            except idempotency.KeyReused as error:
+                abort(422, description=str(error))
+            return Response(body, content_type='application/json',
+                            headers={'Idempotent-Replayed': 'true'})
+
+        response = _app.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            records.add_idempotent_response(
+                key, request_description, response.get_data(as_text=True), config.web_idempotency_key_ttl)
+        return response
+    return wrapper
+
+
+def _add_response_entry(role: str, email: str, discord_username: str):
+    # Through the write-behind log if enabled, otherwise in its own transaction
+    if _write_behind is None:
+        _ADD_RESPONSE_ENTRY[role](email, discord_username)
+    elif _write_behind.append(role, email, discord_username):
+        _write_behind.flush()
+
 
 @_app.post('/push/participant')
+@_idempotent
 def push_participant():
     if request.headers.get('api-key') == config.web_api_key:
         data = request.get_json()
         try:
-            records.add_participant_response_entry(
-                str(data['email']).lower(), data['discord_username'])
+            _add_response_entry(
+                'participant', str(data['email']).lower(), data['discord_username'])
             return jsonify(
                 {'email': str(data['email']).lower(), 'discord_username': data['discord_username'].lower()})
         except BaseException:
@@ -24,12 +97,13 @@ def push_participant():
 
 
 @_app.post('/push/mentor')
+@_idempotent
 def push_mentor():
     if request.headers.get('api-key') == config.web_api_key:
         data = request.get_json()
         try:
-            records.add_mentor_response_entry(
-                str(data['email']).lower(), data['discord_username'])
+            _add_response_entry(
+                'mentor', str(data['email']).lower(), data['discord_username'])
             return jsonify(
                 {'email': str(data['email']).lower(), 'discord_username': data['discord_username'].lower()})
         except BaseException:
@@ -40,12 +114,13 @@ def push_mentor():
 
 
 @_app.post('/push/judge')
+@_idempotent
 def push_judge():
     if request.headers.get('api-key') == config.web_api_key:
         data = request.get_json()
         try:
-            records.add_judge_response_entry(
-                str(data['email']).lower(), data['discord_username'])
+            _add_response_entry(
+                'judge', str(data['email']).lower(), data['discord_username'])
             return jsonify(
                 {'email': str(data['email']).lower(), 'discord_username': data['discord_username'].lower()})
         except BaseException:
@@ -55,5 +130,217 @@ def push_judge():
         abort(403)
 
 
+@_app.post('/push/<role>/batch')
+@_idempotent
+def push_batch(role: str):
+    if request.headers.get('api-key') == config.web_api_key:
+        if role not in records.REGISTRATION_ROLES:
+            abort(404)
+        try:
+            items = ingest.parse_batch(request.stream, request.mimetype)
+        except ValueError as error:
+            abort(400, description=str(error))
+        return jsonify(ingest.add_batch(role, items))
+
+    else:
+        abort(403)
+
+
+@_app.get('/metrics')
+def get_metrics():
+    # This process's metrics, and the bot process's and other workers' from
+    # their last snapshots, whichever worker the scrape lands on
+    snapshots = [metrics.read_snapshot(config.metrics_snapshot_file)]
+    if _worker_index is not None:
+        snapshots += [metrics.read_snapshot(_worker_metrics_file(index))
+                      for index in range(config.web_workers) if index != _worker_index]
+    return Response(metrics.render(*snapshots), content_type=metrics.CONTENT_TYPE)
+
+
+def _worker_metrics_file(index: int) -> str:
+    return f'{config.metrics_snapshot_file}.web{index}'
+
+
+def _write_worker_metrics():
+    while True:
+        try:
+            metrics.write_snapshot(_worker_metrics_file(_worker_index))
+        except OSError as error:
+            print(f'ERROR: Could not write metrics snapshot: {error}')
+        eventlet.sleep(config.metrics_snapshot_interval)
+
+
+def _connect():
+    records.connect_configured(config)
+
+
+def _flush_write_behind_log():
+    while True:
+        eventlet.sleep(config.web_write_behind_interval)
+        try:
+            _write_behind.flush()
+        except Exception:
+            traceback.print_exc()
+
+
+def _start_write_behind(filename: str):
+    global _write_behind
+    _write_behind = writebehind.WriteBehindLog(
+        filename, config.web_write_behind_max_rows, config.web_write_behind_fsync)
+    eventlet.spawn(_flush_write_behind_log)
+
+
+def _stop_write_behind():
+    if _write_behind is not None:
+        _write_behind.flush()
+        _write_behind.close()
+
+
+def _serve_worker(listener: socket.socket, log_output: bool):
+    # Serve from a forked worker until SIGTERM (or SIGINT), then stop
+    # accepting and finish the requests in progress
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, _SUPERVISOR_SIGNALS)
+
+    # The eventlet hub is created here, so no worker shares the parent's
+    server = eventlet.spawn(wsgi.server, greenio.GreenSocket(listener), _app, log_output=log_output)
+    eventlet.spawn(_write_worker_metrics)
+    while not stopping and not server.dead:
+        eventlet.sleep(_WORKER_POLL_INTERVAL)
+    # wsgi.server() handles SystemExit by draining its connections
+    server.kill(SystemExit)
+    try:
+        server.wait()
+    finally:
+        _stop_write_behind()
+
+
+def _supervise(address: tuple, workers: int, connect=_connect, log_output: bool = True,
+               write_behind_log: str = None):
+    """Serve the push API from worker processes sharing one listening socket,
+    until SIGTERM or SIGINT.
+
+    Each worker opens its own database connection, so a blocking query only
+    stalls its own worker. Workers that exit are restarted; SIGHUP restarts
+    them all, one at a time, each finishing its requests in progress first.
+
+    Args:
+        address (tuple): (host, port) to listen on
+        workers (int): Number of worker processes
+        connect (Callable): Opens the records database, in the supervisor to
+            create or migrate it before forking, then in each worker
+        log_output (bool): Log each request
+        write_behind_log (str): Path of the write-behind log, or None to
+            record each single push in its own transaction. Worker n logs to
+            write_behind_log.n.
+    """
+
+    listener = socket.create_server(address, backlog=socket.SOMAXCONN)
+    connect()
+    if write_behind_log is not None:
+        # Including the logs of workers beyond the current number
+        writebehind.replay_all(write_behind_log)
+    records.close()
+
+    # PID to (worker number, start time)
+    processes = {}
+    # PIDs still to restart after a SIGHUP, and the one being restarted
+    restart_queue = []
+    restarting = [None]
+    stopping = []
+
+    def spawn(index: int):
+        global _worker_index
+        # Signals are held until the worker has installed its own handlers
+        signal.pthread_sigmask(signal.SIG_BLOCK, _SUPERVISOR_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                _worker_index = index
+                metrics.set_process(f'web{index}')
+                connect()
+                if write_behind_log is not None:
+                    _start_write_behind(f'{write_behind_log}.{index}')
+                _serve_worker(listener, log_output)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        processes[pid] = (index, time.monotonic())
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, _SUPERVISOR_SIGNALS)
+
+    def terminate(pid: int):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def restart_next():
+        # Workers that exited meanwhile have been restarted already
+        restarting[0] = None
+        while restart_queue and restarting[0] is None:
+            pid = restart_queue.pop(0)
+            if pid in processes:
+                restarting[0] = pid
+                terminate(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in processes:
+            terminate(pid)
+
+    def restart(signum, frame):
+        if stopping or restarting[0] is not None:
+            return
+        restart_queue[:] = processes
+        restart_next()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, restart)
+
+    for index in range(workers):
+        spawn(index)
+    print(f'STATUS: Serving the push API on port {address[1]} with {workers} workers')
+
+    while processes:
+        # Retried after the signal handlers run
+        pid, status = os.wait()
+        if pid not in processes:
+            continue
+        index, start_time = processes.pop(pid)
+        if stopping:
+            continue
+        if pid != restarting[0]:
+            print(f'ERROR: Web worker {index} (PID {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting')
+            if time.monotonic() - start_time < _MIN_WORKER_UPTIME:
+                time.sleep(_MIN_WORKER_UPTIME)
+                # A worker spawned after stop() would never be terminated
+                if stopping:
+                    continue
+        spawn(index)
+        if pid == restarting[0]:
+            restart_next()
+    listener.close()
+
+
 def start():
-    wsgi.server(eventlet.listen(('0.0.0.0', config.web_port)), _app)
+    metrics.set_process('web')
+    write_behind_log = config.web_write_behind_log if config.web_write_behind else None
+    if config.web_workers > 1:
+        _supervise(('0.0.0.0', config.web_port), config.web_workers,
+                   write_behind_log=write_behind_log)
+        return
+    _connect()
+    if write_behind_log is not None:
+        writebehind.replay_all(write_behind_log)
+        _start_write_behind(write_behind_log)
+    try:
+        wsgi.server(eventlet.listen(('0.0.0.0', config.web_port)), _app)
+    finally:
+        _stop_write_behind()
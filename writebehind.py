@@ -0,0 +1,196 @@
+"""Write-behind buffering of registration responses pushed one at a time.
+
+Recording each pushed entry in its own transaction limits the push rate to
+the number of commits the database can make per second. With write-behind,
+a push is acknowledged as soon as its entry is appended to a local log, and
+the logged entries are recorded in one transaction per role (a group commit)
+every few milliseconds, or as soon as enough of them are pending. A flush
+moves the log aside for the entries it records, which are dropped with it
+once recorded, while new entries go to a fresh log.
+
+Entries still in the log when the process stops, cleanly or not, are
+recorded by replay() on the next start. Adding an entry is idempotent, so an
+entry that was recorded just before a crash, but not yet dropped from the
+log, is only recorded once.
+
+Appends are flushed to the operating system before they are acknowledged, so
+they survive a crash of the process. Like the database in WAL mode with
+synchronous=NORMAL, the latest ones can still be lost on power failure,
+unless each append is also synced to disk (fsync).
+"""
+
+import collections
+import glob
+import json
+import os
+import threading
+import records
+
+
+def _record(entries: list) -> int:
+    # One transaction per role
+    by_role = collections.defaultdict(list)
+    for role, email, discord_username in entries:
+        by_role[role].append((email, discord_username))
+    return sum(records.add_response_entries(role, role_entries)
+               for role, role_entries in by_role.items())
+
+
+def _recording_filename(filename: str) -> str:
+    # Where a flush moves the log while recording its entries
+    return f'{filename}.recording'
+
+
+def replay(filename: str) -> int:
+    """Record the entries left in a log by a previous run, including those
+    of a flush it did not finish, then delete it.
+
+    A last line cut short by a crash is skipped, since its push was never
+    acknowledged.
+
+    Args:
+        filename (str): Path of the log
+
+    Returns:
+        int: Number of entries added, not counting those already recorded
+    """
+
+    filenames = [name for name in (_recording_filename(filename), filename) if os.path.isfile(name)]
+    if not filenames:
+        return 0
+    entries = []
+    for name in filenames:
+        with open(name, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    role, email, discord_username = json.loads(line)
+                except (ValueError, TypeError):
+                    continue
+                if role in records.REGISTRATION_ROLES:
+                    entries.append((role, email, discord_username))
+    added = _record(entries)
+    for name in filenames:
+        os.remove(name)
+    if entries:
+        print(f'STATUS: Replayed {len(entries)} logged entries from {filename}, {added} of them new')
+    return added
+
+
+def replay_all(filename: str) -> int:
+    """Replay a log and the logs of numbered workers sharing its name
+    (filename.0, filename.1, ...).
+
+    Args:
+        filename (str): Path of the log
+
+    Returns:
+        int: Number of entries added, not counting those already recorded
+    """
+
+    filenames = [filename] + sorted(
+        name for name in glob.glob(glob.escape(filename) + '.*')
+        if name.rpartition('.')[2].isdigit())
+    return sum(replay(name) for name in filenames)
+
+
+class WriteBehindLog:
+    """An append-only log of pushed entries waiting to be recorded."""
+
+    def __init__(self, filename: str, max_rows: int = 500, fsync: bool = False):
+        """
+        Replays the log first if a previous run left entries in it.
+
+        Args:
+            filename (str): Path of the log
+            max_rows (int): Number of pending entries at which append()
+                reports that a flush is due
+            fsync (bool): Sync each append to disk before acknowledging it
+        """
+
+        replay(filename)
+        self._filename = filename
+        self._max_rows = max_rows
+        self._fsync = fsync
+        # Appends and flushes run on different threads
+        self._lock = threading.Lock()
+        self._pending = []
+        self._file = open(filename, 'a', encoding='utf-8')
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def append(self, role: str, email: str, discord_username: str) -> bool:
+        """Log an entry to be recorded by a later flush().
+
+        Args:
+            role (str): The registration role, one of
+                records.REGISTRATION_ROLES
+            email (str): The email address
+            discord_username (str): The Discord username
+
+        Raises:
+            ValueError: If the role is unknown
+            TypeError: If the email or username is not a string, since the
+                entry could then never be recorded
+
+        Returns:
+            bool: If max_rows entries are pending, so a flush is due
+        """
+
+        if role not in records.REGISTRATION_ROLES:
+            raise ValueError(f'Unknown registration role "{role}"')
+        if not isinstance(email, str) or not isinstance(discord_username, str):
+            raise TypeError('Email and Discord username must be strings')
+        line = json.dumps([role, email, discord_username]) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+            self._pending.append((role, email, discord_username))
+            return len(self._pending) >= self._max_rows
+
+    def flush(self) -> int:
+        """Record the pending entries, and drop them from the log.
+
+        Appends only wait for the log to be moved aside, not for the entries
+        to be recorded. Calls must not overlap, and query the database
+        directly, so must run on the records worker thread when called from
+        an event loop.
+
+        Returns:
+            int: Number of entries added, not counting those already recorded
+        """
+
+        recording_filename = _recording_filename(self._filename)
+        with self._lock:
+            entries = self._pending
+            if not entries:
+                return 0
+            self._pending = []
+            # The entries stay on disk in the moved log until recorded, and
+            # new ones go to a fresh log
+            self._file.close()
+            os.replace(self._filename, recording_filename)
+            self._file = open(self._filename, 'a', encoding='utf-8')
+        try:
+            added = _record(entries)
+        except BaseException:
+            # Back in the log, so retried by the next flush or replay
+            lines = ''.join(json.dumps(entry) + '\n' for entry in entries)
+            with self._lock:
+                self._pending[:0] = entries
+                self._file.write(lines)
+                self._file.flush()
+                if self._fsync:
+                    os.fsync(self._file.fileno())
+            os.remove(recording_filename)
+            raise
+        os.remove(recording_filename)
+        return added
+
+    def close(self):
+        """Close the log, leaving any pending entries in it to be replayed."""
+
+        with self._lock:
+            self._file.close()